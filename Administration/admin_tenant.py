@@ -22,7 +22,7 @@ from django.utils.translation import gettext_lazy as _
 from AuthBillet.models import HumanUser, SuperHumanUser, TermUser
 from AuthBillet.utils import get_client_ip
 from BaseBillet.models import Configuration, Event, OptionGenerale, Product, Price, Reservation, LigneArticle, Ticket, \
-    Paiement_stripe, ProductSold, PriceSold, Membership, ExternalApiKey, Webhook, Tag
+    Paiement_stripe, ProductSold, PriceSold, Membership, ExternalApiKey, Webhook, Tag, EventOccurrence
 from django.contrib.auth.admin import UserAdmin
 from Customers.models import Client
 
@@ -392,6 +392,12 @@ class EventAdmin(admin.ModelAdmin):
                 'minimum_cashless_required',
             )
         }),
+        ("File d'attente", {
+            'fields': (
+                'waiting_room',
+                'waiting_room_rate',
+            )
+        }),
     )
 
     list_display = [
@@ -432,6 +438,30 @@ class EventAdmin(admin.ModelAdmin):
 staff_admin_site.register(Event, EventAdmin)
 
 
+class EventOccurrenceAdmin(admin.ModelAdmin):
+    # Dates générées automatiquement depuis la récurrence de l'évènement : on ne modifie que jauge et statut.
+    list_display = [
+        'datetime',
+        'event',
+        'capacity',
+        'sold',
+        'status',
+    ]
+    list_editable = ['capacity', 'status']
+    list_filter = ['event', 'status']
+    fields = ['event', 'datetime', 'capacity', 'held', 'sold', 'status']
+    readonly_fields = ['event', 'datetime', 'held', 'sold']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('event')
+
+    def has_add_permission(self, request):
+        return False
+
+
+staff_admin_site.register(EventOccurrence, EventOccurrenceAdmin)
+
+
 # class OptionGeneraleAdmin(admin.ModelAdmin):
 #     list_display = (
 #         'name',
@@ -493,7 +523,10 @@ class EventFilter(SimpleListFilter):
 
 
 def valider_ticket(modeladmin, request, queryset):
-    queryset.update(status=Ticket.SCANNED)
+    # save() et pas update() : les signaux tiennent à jour les compteurs de l'évènement
+    for ticket in queryset.exclude(status=Ticket.SCANNED):
+        ticket.status = Ticket.SCANNED
+        ticket.save()
 
 
 valider_ticket.short_description = "Valider le/les tickets"
@@ -554,8 +587,12 @@ class TicketAdmin(admin.ModelAdmin):
         return custom_urls + urls
 
     def scanner(self, request, ticket_pk, *arg, **kwarg):
-        print(ticket_pk)
-        ticket = Ticket.objects.get(pk=ticket_pk)
+        # Uuid (QR code) ou scan_code (code barre)
+        ticket = Ticket.objects.filter(Ticket.code_filter([ticket_pk])).first()
+        if not ticket:
+            messages.add_message(request, messages.ERROR, f"Ticket inconnu.")
+            return HttpResponseRedirect(reverse("staff_admin:BaseBillet_ticket_changelist"))
+
         ticket.status = Ticket.SCANNED
         ticket.save()
         messages.add_message(
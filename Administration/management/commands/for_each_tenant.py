@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from Customers.executor import run_per_tenant, THREAD, PROCESS
+from Customers.models import Client
+
+
+class Command(BaseCommand):
+    help = "Lance une fonction sur chaque tenant en parallèle (Customers.executor). " \
+           "Ex : ./manage.py for_each_tenant BaseBillet.tasks.ma_fonction --workers 8"
+
+    def add_arguments(self, parser):
+        parser.add_argument('callable', type=str, help="Chemin python de la fonction, appelée avec le tenant")
+        parser.add_argument('--workers', type=int, help="Nombre de worker en parallèle")
+        parser.add_argument('--processes', action='store_true', help="Process au lieu de thread (tâches CPU)")
+        parser.add_argument('--schemas', nargs='+', help="Limite aux schémas donnés")
+        parser.add_argument('--categories', nargs='+', help="Limite aux catégories de tenant (S, F, A, ...)")
+
+    def handle(self, *args, **options):
+        func = import_string(options['callable'])
+
+        tenants = Client.objects.exclude(schema_name='public')
+        if options['schemas']:
+            tenants = tenants.filter(schema_name__in=options['schemas'])
+        if options['categories']:
+            tenants = tenants.filter(categorie__in=options['categories'])
+
+        def progress(done, total, result):
+            state = "OK" if result.ok else "ERREUR"
+            self.stdout.write(f"[{done}/{total}] {result.schema_name} {state} {result.duration:.2f}s")
+
+        results = run_per_tenant(
+            func,
+            tenants=tenants,
+            workers=options['workers'],
+            mode=PROCESS if options['processes'] else THREAD,
+            progress=progress,
+        )
+
+        errors = [result for result in results if not result.ok]
+        for result in errors:
+            self.stderr.write(f"{result.schema_name} :\n{result.error}")
+        self.stdout.write(f"{len(results) - len(errors)} tenants OK, {len(errors)} en erreur")
+        if errors:
+            raise CommandError(f"{len(errors)} tenants en erreur")
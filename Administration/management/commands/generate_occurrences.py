@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from BaseBillet.models import EventOccurrence, Event
+from Customers.executor import run_per_tenant
+from Customers.models import Client
+from MetaBillet.models import PublicEventIndex
+
+
+def generate_occurrences(tenant):
+    created = EventOccurrence.generate_all()
+    # La prochaine date des évènements récurrents change chaque jour : on rafraîchit leur carte de l'index public
+    refreshed = 0
+    for event in Event.objects.with_counters().filter(recurrent__isnull=False, published=True).distinct() \
+            .prefetch_related('products__prices', 'recurrent'):
+        if PublicEventIndex.refresh_live(event, tenant):
+            refreshed += 1
+    return f"{created} dates créées, {refreshed} cartes rafraîchies"
+
+
+class Command(BaseCommand):
+    help = "Génère les dates des évènements récurrents (BaseBillet.EventOccurrence) sur la fenêtre OCCURRENCE_WINDOW_DAYS " \
+           "et rafraîchit leur carte de l'index public (MetaBillet.PublicEventIndex). " \
+           "A lancer chaque jour, l'API occurrences génère aussi les dates au premier appel de la journée."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Nombre de tenant traités en parallèle")
+
+    def handle(self, *args, **options):
+        results = run_per_tenant(
+            generate_occurrences,
+            tenants=Client.objects.filter(categorie__in=[Client.SALLE_SPECTACLE, Client.FESTIVAL]),
+            workers=options['workers'],
+        )
+        for result in results:
+            self.stdout.write(f"{result.schema_name} : {result.result if result.ok else result.error}")
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from BaseBillet.models import Event
+from Customers.executor import run_per_tenant
+from Customers.models import Client
+from MetaBillet.models import PublicEventIndex
+
+
+def rebuild_index(tenant):
+    indexed = []
+    for event in Event.objects.filter(published=True).prefetch_related('products', 'tag', 'recurrent'):
+        if PublicEventIndex.index_event(event, tenant):
+            indexed.append(event.uuid)
+    # Evènements supprimés ou dépubliés sans passer par les signaux
+    deleted, _ = PublicEventIndex.objects.filter(place=tenant).exclude(event_uuid__in=indexed).delete()
+    return f"{len(indexed)} indexés, {deleted} retirés"
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'index public des évènements (MetaBillet.PublicEventIndex). Normalement maintenu par les signaux."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Nombre de tenant traités en parallèle")
+
+    def handle(self, *args, **options):
+        results = run_per_tenant(
+            rebuild_index,
+            tenants=Client.objects.filter(categorie__in=PublicEventIndex.INDEXED_PLACES),
+            workers=options['workers'],
+        )
+        for result in results:
+            self.stdout.write(f"{result.schema_name} : {result.result if result.ok else result.error}")
+
+        # Lieux sortis de l'index (changement de catégorie)
+        deleted, _ = PublicEventIndex.objects.exclude(place__categorie__in=PublicEventIndex.INDEXED_PLACES).delete()
+        self.stdout.write(f"{deleted} évènements de lieux non indexés retirés")
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from BaseBillet.models import Configuration
+from Customers.executor import run_per_tenant
+from Customers.models import Client
+from fedow_connect.models import FedowConfig
+from MetaBillet.models import PlaceDirectory
+
+
+def rebuild_place(tenant):
+    place_dir = PlaceDirectory.update_place(
+        tenant,
+        config=Configuration.get_solo(),
+        fedow_config=FedowConfig.get_solo(),
+    )
+    return f"{place_dir.organisation} - {place_dir.fedow_place_uuid}"
+
+
+class Command(BaseCommand):
+    help = "Reconstruit l'annuaire public des lieux et artistes (MetaBillet.PlaceDirectory). Normalement maintenu par les signaux."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Nombre de tenant traités en parallèle")
+
+    def handle(self, *args, **options):
+        categories = [Client.SALLE_SPECTACLE, Client.FESTIVAL, Client.ARTISTE]
+        results = run_per_tenant(
+            rebuild_place,
+            tenants=Client.objects.filter(categorie__in=categories),
+            workers=options['workers'],
+        )
+        for result in results:
+            self.stdout.write(f"{result.schema_name} : {result.result if result.ok else result.error}")
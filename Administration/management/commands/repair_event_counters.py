@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from BaseBillet.models import Event, EventInventory
+from Customers.executor import run_per_tenant
+from Customers.models import Client
+
+
+def repair_counters(tenant):
+    repaired = 0
+    for event in Event.objects.with_counters():
+        inventory = EventInventory.recount(event)
+        if (inventory.sold, inventory.scanned, inventory.held) != (event.sold_count, event.scanned_count, event.held_count):
+            repaired += 1
+    return f"{repaired} compteurs corrigés"
+
+
+class Command(BaseCommand):
+    help = "Recalcule les compteurs de billets des évènements (BaseBillet.EventInventory). Normalement maintenus par les signaux."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help="Nombre de tenant traités en parallèle")
+
+    def handle(self, *args, **options):
+        results = run_per_tenant(
+            repair_counters,
+            tenants=Client.objects.filter(categorie__in=[Client.SALLE_SPECTACLE, Client.FESTIVAL]),
+            workers=options['workers'],
+        )
+        for result in results:
+            self.stdout.write(f"{result.schema_name} : {result.result if result.ok else result.error}")
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum, F, DecimalField
+from django.utils import timezone
+
+from BaseBillet.models import Ticket, Membership, LigneArticle
+from Customers.aggregates import cross_schema_aggregate
+from Customers.models import Client
+
+
+class Command(BaseCommand):
+    help = "Chiffres de toute l'instance par tenant : billets vendus, adhésions actives, chiffre d'affaire. " \
+           "Une requête UNION ALL par paquet de schémas (Customers.aggregates)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-cache', action='store_true', help="Ignore le cache des agrégats")
+
+    def handle(self, *args, **options):
+        cache_timeout = 0 if options['no_cache'] else None
+        tenants = Client.objects.exclude(categorie__in=[Client.META, Client.ROOT]).exclude(schema_name='public')
+
+        tickets = cross_schema_aggregate(
+            Ticket.objects.filter(status__in=[Ticket.NOT_SCANNED, Ticket.SCANNED]),
+            {'tickets': Count('uuid')},
+            tenants=tenants, cache_timeout=cache_timeout,
+        )
+        memberships = cross_schema_aggregate(
+            Membership.objects.filter(last_contribution__gte=timezone.localdate() - timedelta(days=365)),
+            {'memberships': Count('id')},
+            tenants=tenants, cache_timeout=cache_timeout,
+        )
+        revenue = cross_schema_aggregate(
+            LigneArticle.objects.filter(status__in=[LigneArticle.PAID, LigneArticle.VALID]),
+            {'revenue': Sum(F('qty') * F('pricesold__prix'), output_field=DecimalField(max_digits=12, decimal_places=2))},
+            tenants=tenants, cache_timeout=cache_timeout,
+        )
+
+        report = {}
+        for rows in [tickets, memberships, revenue]:
+            for row in rows:
+                report.setdefault(row.pop('schema_name'), {}).update(row)
+
+        for schema_name, numbers in sorted(report.items()):
+            self.stdout.write(f"{schema_name} : {numbers.get('tickets', 0)} billets, "
+                              f"{numbers.get('memberships', 0)} adhésions actives, "
+                              f"{numbers.get('revenue') or 0} €")
@@ -1,12 +1,15 @@
 import datetime
 import logging
 import uuid
+from uuid import UUID
 from decimal import Decimal
 
 import requests
 import stripe
 from PIL import Image
-from django.db import connection
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 from django_tenants.utils import tenant_context
@@ -16,10 +19,12 @@ from rest_framework.generics import get_object_or_404
 from AuthBillet.models import TibilletUser
 from AuthBillet.utils import get_or_create_user
 from BaseBillet.models import Event, Price, Product, Reservation, Configuration, LigneArticle, Ticket, Paiement_stripe, \
-    PriceSold, ProductSold, Artist_on_event, OptionGenerale, Membership, Tag, Weekday
+    PriceSold, ProductSold, Artist_on_event, OptionGenerale, Membership, Tag, Weekday, EventInventory, \
+    EventOccurrence
+from BaseBillet.tasks import check_checkout_expiration
 from Customers.models import Client
 from MetaBillet.models import WaitingConfiguration
-from PaiementStripe.views import CreationPaiementStripe
+from PaiementStripe.views import CreationPaiementStripe, CHECKOUT_EXPIRATION_MARGIN
 # from QrcodeCashless.models import CarteCashless, Detail
 from root_billet.models import RootConfiguration
 
@@ -457,7 +462,8 @@ class ArtistEventCreateSerializer(serializers.Serializer):
 
 
 class Artist_on_eventSerializer(serializers.ModelSerializer):
-    configuration = ConfigurationSerializer()
+    # Même contenu que ConfigurationSerializer, lu dans l'annuaire public sans tenant_context
+    configuration = serializers.SerializerMethodField()
 
     class Meta:
         model = Artist_on_event
@@ -466,6 +472,10 @@ class Artist_on_eventSerializer(serializers.ModelSerializer):
             'configuration',
         ]
 
+    def get_configuration(self, obj):
+        # L'annuaire ajoute l'uuid du tenant (api /place), absent de la sortie de ConfigurationSerializer
+        return {key: value for key, value in obj.presentation().items() if key != 'uuid'}
+
 
 class EventCreateSerializer(serializers.Serializer):
     name = serializers.CharField(required=False, max_length=200)
@@ -600,6 +610,22 @@ class EventCreateSerializer(serializers.Serializer):
         return event
 
 
+def set_event_live_fields(representation, event):
+    # Champs de la carte qui bougent à chaque vente ou chaque jour.
+    # Aussi utilisé pour rafraîchir l'index public sans tout resérialiser (PublicEventIndex.refresh_live).
+    representation['reservations'] = event.reservations()
+    representation['complet'] = event.complet()
+    representation['next_datetime'] = [date_time.isoformat() for date_time in event.next_datetime()]
+
+    # Places restantes des tarifs à stock limité
+    prices = [price for product in event.products.all() for price in product.prices.all()]
+    stocks = PriceSold.stocks_available(prices, event=event)
+    for product in representation['products']:
+        for price in product['prices']:
+            price['stock_available'] = stocks.get(UUID(f"{price['uuid']}"))
+    return representation
+
+
 class EventSerializer(serializers.ModelSerializer):
     products = ProductSerializer(many=True)
     options_radio = OptionsSerializer(many=True)
@@ -633,8 +659,9 @@ class EventSerializer(serializers.ModelSerializer):
             'reservation_solo',
             'recurrent',
             'booking',
+            'waiting_room',
         ]
-        read_only_fields = ['uuid', 'reservations']
+        read_only_fields = ['uuid', 'reservations', 'waiting_room']
         depth = 1
 
     def validate(self, attrs):
@@ -685,9 +712,7 @@ class EventSerializer(serializers.ModelSerializer):
         #     instance.products.add(free_reservation)
 
         representation = super().to_representation(instance)
-
-        representation['next_datetime'] = [date_time.isoformat() for date_time in instance.next_datetime()]
-
+        set_event_live_fields(representation, instance)
         representation['url'] = f"https://{connection.tenant.get_primary_domain().domain}/event/{instance.slug}/"
         representation['place'] = Configuration.get_solo().organisation
 
@@ -734,6 +759,7 @@ class TicketSerializer(serializers.ModelSerializer):
             # 'pricesold',
             'status',
             'seat',
+            'scan_code',
             # 'event_name',
             # 'pdf_url',
         ]
@@ -959,20 +985,29 @@ def get_near_event_by_date():
         return None
 
 
-def create_ticket(pricesold, customer, reservation):
+def build_ticket(pricesold, customer, reservation):
+    # Ticket non sauvegardé, pour bulk_create
     statut = Ticket.CREATED
 
     if pricesold.price.product.categorie_article == Product.FREERES:
         statut = Ticket.NOT_ACTIV
 
-    ticket = Ticket.objects.create(
+    ticket = Ticket(
         status=statut,
         reservation=reservation,
+        occurrence_id=reservation.occurrence_id,
         pricesold=pricesold,
         first_name=customer.get('first_name'),
         last_name=customer.get('last_name'),
     )
+    # bulk_create ne passe pas par Ticket.save
+    ticket.scan_code = Ticket.make_scan_code(ticket.uuid)
+    return ticket
+
 
+def create_ticket(pricesold, customer, reservation):
+    ticket = build_ticket(pricesold, customer, reservation)
+    ticket.save()
     return ticket
 
 
@@ -1013,6 +1048,26 @@ def get_or_create_price_sold(price: Price, event: Event =None):
     return pricesold
 
 
+def get_or_create_prices_sold(prices, event: Event = None) -> dict:
+    """
+    get_or_create_price_sold pour tous les tarifs d'une commande.
+    Les PriceSold déja créés pour l'event sont lus en une requête,
+    seuls les manquants passent par get_or_create_price_sold (et Stripe).
+    """
+    existing = {
+        (pricesold.price_id, pricesold.prix): pricesold
+        for pricesold in PriceSold.objects.filter(productsold__event=event, price__in=prices)
+        .select_related('productsold__product', 'price__product')
+    }
+    prices_sold = {}
+    for price in prices:
+        pricesold = existing.get((price.pk, price.prix))
+        if pricesold is None:
+            pricesold = get_or_create_price_sold(price, event=event)
+        prices_sold[price.pk] = pricesold
+    return prices_sold
+
+
 def line_article_recharge(carte, qty):
     product, created = Product.objects.get_or_create(
         name=f"Recharge Carte {carte.detail.origine.name} v{carte.detail.generation}",
@@ -1159,10 +1214,14 @@ class ReservationValidator(serializers.Serializer):
     options = serializers.PrimaryKeyRelatedField(queryset=OptionGenerale.objects.all(), many=True, allow_null=True)
     prices = serializers.JSONField(required=True)
     datetime = serializers.DateTimeField(required=False)
+    # Evènement récurrent : la date réservée (ou datetime, qui la désigne)
+    occurrence = serializers.PrimaryKeyRelatedField(queryset=EventOccurrence.objects.all(), required=False,
+                                                    allow_null=True)
 
     def validate_event(self, value):
         event: Event = value
-        if event.complet():
+        # La jauge d'un évènement récurrent est celle de chaque date, vérifiée dans validate
+        if not event.recurrent.exists() and event.complet():
             raise serializers.ValidationError(_(f'Jauge atteinte : Evenement complet.'))
         return value
 
@@ -1190,10 +1249,14 @@ class ReservationValidator(serializers.Serializer):
 
         self.nbr_ticket = 0
         self.prices_list = []
+        # Tous les tarifs en une requête
+        prices = Price.objects.select_related('product').in_bulk([entry.get('uuid') for entry in value])
         for entry in value:
             logger.info(f"price entry : {entry}")
             try:
-                price = Price.objects.get(pk=entry['uuid'])
+                price = prices.get(UUID(f"{entry['uuid']}"))
+                if price is None:
+                    raise Price.DoesNotExist(entry['uuid'])
                 product = price.product
                 price_object = {
                     'price': price,
@@ -1252,14 +1315,9 @@ class ReservationValidator(serializers.Serializer):
         options = attrs.get('options')
         to_mail: bool = attrs.get('to_mail')
 
-        resas = event.reservations()
-
         if self.nbr_ticket > event.max_per_user:
             raise serializers.ValidationError(_(f'Quantitée de réservations suppérieure au maximum autorisé'))
 
-        if resas + self.nbr_ticket > event.jauge_max:
-            raise serializers.ValidationError(_(f'Il ne reste que {resas} places disponibles'))
-
         # On check que les prices sont bien dans l'event original.
         product_list = [product for product in event.products.all()]
         for product in product_list:
@@ -1296,51 +1354,105 @@ class ReservationValidator(serializers.Serializer):
                     logger.warning(_(f"L'utilisateur n'est pas membre"))
                     raise serializers.ValidationError(_(f"L'utilisateur n'est pas membre"))
 
+        occurrence: EventOccurrence = attrs.get('occurrence')
+        if not occurrence and attrs.get('datetime') and event.recurrent.exists():
+            occurrence = event.occurrences.filter(datetime=attrs.get('datetime')).first()
+        if occurrence:
+            if occurrence.event_id != event.pk or occurrence.status != EventOccurrence.OPEN \
+                    or occurrence.datetime < timezone.now():
+                raise serializers.ValidationError(_(f'Date non disponible'))
+        elif event.recurrent.exists():
+            raise serializers.ValidationError(_(f'Date requise pour un évènement récurrent'))
+
+        # On tient les places de façon atomique avant de créer quoi que ce soit.
+        # Elles sont rendues si la suite échoue, ou si le paiement expire / est annulé (BaseBillet.signals)
+        nbr_ticket = int(self.nbr_ticket)
+        if occurrence:
+            if not EventOccurrence.acquire(occurrence.pk, nbr_ticket):
+                occurrence.refresh_from_db()
+                raise serializers.ValidationError(
+                    _(f'Il ne reste que {occurrence.available()} places disponibles'))
+        elif not EventInventory.acquire(event, nbr_ticket):
+            raise serializers.ValidationError(
+                _(f'Il ne reste que {EventInventory.available(event)} places disponibles'))
+
         # on construit l'object reservation.
         reservation = Reservation.objects.create(
             user_commande=self.user_commande,
             to_mail=to_mail,
             event=event,
+            occurrence=occurrence,
+            seats_held=nbr_ticket,
         )
+        self.reservation = reservation
+
+        self.lines_created = []
+        try:
+            return self.create_lines_and_checkout(attrs, reservation)
+        except Exception:
+            reservation.release_seats()
+            for line_article in self.lines_created:
+                line_article.release_stock()
+            raise
+
+    def create_lines_and_checkout(self, attrs, reservation: Reservation):
+        event: Event = attrs.get('event')
+        options = attrs.get('options')
 
         if options:
             for option in options:
                 reservation.options.add(option)
 
-        self.reservation = reservation
         # Ici, on construit :
         #   price_sold pour lier l'event à la vente
         #   ligne article pour envoi en paiement
         #   Ticket nominatif
 
+        # PriceSold résolus une fois pour toute la commande
+        prices_sold = get_or_create_prices_sold([price_object['price'] for price_object in self.prices_list], event)
+
         list_line_article_sold = []
+        tickets = []
         total_checkout = 0
-        for price_object in self.prices_list:
-            price_generique: Price = price_object['price']
-            product: Product = price_generique.product
-            qty = price_object.get('qty')
-            total_checkout += Decimal(qty) * price_generique.prix
-
-            pricesold: PriceSold = get_or_create_price_sold(price_generique, event=event)
-
-            # les lignes articles pour la vente
-            line_article = LigneArticle.objects.create(
-                pricesold=pricesold,
-                qty=qty,
-            )
-            list_line_article_sold.append(line_article)
-
-            # Création de tickets si article est un billet
-            if product.categorie_article in [Product.BILLET, Product.FREERES]:
-                if product.nominative:
-                    for customer in price_object.get('customers'):
-                        create_ticket(pricesold, customer, reservation)
-                else:
-                    for i in range(int(qty)):
-                        create_ticket(
-                            pricesold,
-                            {'first_name': f'{self.user_commande.email}', 'last_name': f'Billet non nominatif {i}'},
-                            reservation)
+        # Une seule transaction : stocks tenus, lignes et billets (bulk_create) sont créés ou annulés ensemble
+        with transaction.atomic():
+            for price_object in self.prices_list:
+                price_generique: Price = price_object['price']
+                product: Product = price_generique.product
+                qty = price_object.get('qty')
+                total_checkout += Decimal(qty) * price_generique.prix
+
+                pricesold: PriceSold = prices_sold[price_generique.pk]
+
+                # Stock d'un tarif limité tenu de façon atomique, rendu à l'expiration du paiement.
+                # Tarif illimité : rien à tenir, la ligne est comptée au paiement (ensure_stock).
+                stock_held = 0
+                if price_generique.stock is not None:
+                    if not pricesold.acquire_stock(int(qty)):
+                        raise serializers.ValidationError(_(f'Plus assez de place pour le tarif {price_generique.name}'))
+                    stock_held = int(qty)
+
+                # les lignes articles pour la vente
+                list_line_article_sold.append(LigneArticle(
+                    pricesold=pricesold,
+                    qty=qty,
+                    stock_held=stock_held,
+                ))
+
+                # Création de tickets si article est un billet
+                if product.categorie_article in [Product.BILLET, Product.FREERES]:
+                    if product.nominative:
+                        customers = price_object.get('customers')
+                    else:
+                        customers = [
+                            {'first_name': f'{self.user_commande.email}', 'last_name': f'Billet non nominatif {i}'}
+                            for i in range(int(qty))]
+                    tickets += [build_ticket(pricesold, customer, reservation) for customer in customers]
+
+            # bulk_create : pas de signaux, aucune transition n'existe à la création de ces objets
+            LigneArticle.objects.bulk_create(list_line_article_sold)
+            Ticket.objects.bulk_create(tickets)
+        self.lines_created = list_line_article_sold
 
         print(f"total_checkout : {total_checkout}")
         self.checkout_session = None
@@ -1366,6 +1478,12 @@ class ReservationValidator(serializers.Serializer):
 
                 reservation.tickets.all().update(status=Ticket.NOT_ACTIV)
 
+                # Si personne ne revient de Stripe, on vérifie à l'expiration pour rendre les places
+                check_checkout_expiration.apply_async(
+                    (f"{paiement_stripe.uuid}",),
+                    countdown=settings.RESERVATION_CHECKOUT_EXPIRATION + 2 * CHECKOUT_EXPIRATION_MARGIN,
+                )
+
                 reservation.paiement = paiement_stripe
                 reservation.status = Reservation.UNPAID
                 reservation.save()
@@ -1381,13 +1499,15 @@ class ReservationValidator(serializers.Serializer):
 
         # La validation de la reservation doit se fait uniquement si l'user possède un mail vérifié
         elif total_checkout == 0:
-            # On passe les reservations gratuites en payées automatiquement :
-            for line_price in list_line_article_sold:
-                line_price: LigneArticle
-                if line_price.pricesold.productsold.product.categorie_article == Product.FREERES:
-                    if line_price.status != LigneArticle.VALID:
-                        line_price.status = LigneArticle.FREERES
-                        line_price.save()
+            # On passe les reservations gratuites en payées automatiquement.
+            # Pas de transition depuis CREATED vers FREERES : un seul UPDATE suffit.
+            LigneArticle.objects.filter(
+                pk__in=[line_price.pk for line_price in list_line_article_sold],
+                pricesold__productsold__product__categorie_article=Product.FREERES,
+            ).exclude(status=LigneArticle.VALID).update(status=LigneArticle.FREERES)
+            # Pas de paiement pour compter les tarifs illimités : on les compte maintenant
+            for line_article in list_line_article_sold:
+                line_article.ensure_stock()
 
             if reservation:
                 # Si l'utilisateur est actif, il a vérifié son email.
@@ -1414,6 +1534,39 @@ class ReservationValidator(serializers.Serializer):
         return representation
 
 
+class EventOccurrenceSerializer(serializers.ModelSerializer):
+    # queryset : EventOccurrence.upcoming(), qui annote available
+    available = serializers.IntegerField(read_only=True)
+    event_name = serializers.CharField(source='event.name', read_only=True)
+    event_slug = serializers.CharField(source='event.slug', read_only=True)
+
+    class Meta:
+        model = EventOccurrence
+        fields = [
+            'uuid',
+            'event',
+            'event_name',
+            'event_slug',
+            'datetime',
+            'capacity',
+            'available',
+            'status',
+        ]
+        read_only_fields = fields
+
+
+class TicketScanSerializer(serializers.Serializer):
+    uuid = serializers.UUIDField()
+    code = serializers.CharField(max_length=200)
+    scanned_at = serializers.DateTimeField()
+    device = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+
+
+class ScanSyncValidator(serializers.Serializer):
+    # Lot de scans envoyé par un scanner de porte, voir BaseBillet.models.TicketScan.sync
+    scans = TicketScanSerializer(many=True, allow_empty=False, max_length=1000)
+
+
 # class PaiementStripeSerializer(serializers.ModelSerializer):
 #     class Meta:
 #         model = Paiement_stripe
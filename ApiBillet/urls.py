@@ -1,7 +1,7 @@
 from django.urls import include, path, re_path
 from ApiBillet import views as api_view
 from rest_framework import routers
-from ApiBillet.views import TicketPdf, Webhook_stripe, Gauge, CancelSubscription,  \
+from ApiBillet.views import TicketPdf, Webhook_stripe, Gauge, CancelSubscription, WaitingRoom, ScanManifest, ScanSync, \
     ZReportPDF, Onboard_laboutik, Get_user_pub_pem
 
 router = routers.DefaultRouter()
@@ -10,6 +10,7 @@ router = routers.DefaultRouter()
 router.register(r'here', api_view.HereViewSet, basename='here')
 router.register(r'events', api_view.EventsViewSet, basename='event')
 router.register(r'eventslug', api_view.EventsSlugViewSet, basename='eventslug')
+router.register(r'occurrences', api_view.OccurrencesViewSet, basename='occurrence')
 router.register(r'products', api_view.ProductViewSet, basename='product')
 router.register(r'prices', api_view.TarifBilletViewSet, basename='price')
 router.register(r'reservations', api_view.ReservationViewset, basename='reservation')
@@ -35,6 +36,9 @@ urlpatterns = [
     path('webhook_stripe/', Webhook_stripe.as_view()),
     path('webhook_stripe/<uuid:uuid_paiement>/', Webhook_stripe.as_view()),
     path('gauge/', Gauge.as_view()),
+    path('waiting_room/<uuid:event_uuid>/', WaitingRoom.as_view()),
+    path('scan/<uuid:event_uuid>/manifest/', ScanManifest.as_view()),
+    path('scan/<uuid:event_uuid>/sync/', ScanSync.as_view()),
     path('cancel_sub/', CancelSubscription.as_view()),
     # path('LoadCardsFromCsv/', LoadCardsFromCsv.as_view()),
     # path('LoadCardsFromDict/', LoadCardsFromD.as_view()),
@@ -4,16 +4,22 @@ import decimal
 import json
 import logging
 from datetime import datetime, timedelta
+from uuid import UUID
 
 import pytz
+import redis
 import requests
 import stripe
 from cryptography.fernet import Fernet
 from django.contrib import messages
 from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.exceptions import ValidationError
 from django.db import connection
+from django.db.models import Sum
 from django.http import HttpResponseRedirect, Http404, HttpResponse
 from django.utils import timezone
+from django.utils.http import parse_etags
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django_tenants.utils import schema_context, tenant_context
@@ -26,18 +32,20 @@ from rest_framework.views import APIView
 
 from ApiBillet.serializers import EventSerializer, PriceSerializer, ProductSerializer, ReservationSerializer, \
     ReservationValidator, ConfigurationSerializer, EventCreateSerializer, TicketSerializer, \
-    OptionsSerializer,  ProductCreateSerializer
+    OptionsSerializer,  ProductCreateSerializer, ScanSyncValidator, EventOccurrenceSerializer
 from AuthBillet.models import TenantAdminPermission, TibilletUser, TenantAdminPermissionWithRequest
 from AuthBillet.utils import user_apikey_valid
 from BaseBillet.models import Event, Price, Product, Reservation, Configuration, Ticket, Paiement_stripe, \
-    OptionGenerale, Membership
+    OptionGenerale, Membership, PriceSold, TicketScan, EventOccurrence
+from BaseBillet import waiting_room
 from BaseBillet.tasks import create_ticket_pdf, report_to_pdf, report_celery_mailer
 from Customers.models import Client
-from MetaBillet.models import EventDirectory, ProductDirectory
+from MetaBillet.models import EventDirectory, ProductDirectory, PublicEventIndex, PlaceDirectory
 from PaiementStripe.views import new_entry_from_stripe_invoice
 from TiBillet import settings
 from fedow_connect.fedow_api import FedowAPI
 from fedow_connect.utils import rsa_decrypt_string, rsa_encrypt_string, get_public_key, data_to_b64
+from root_billet.metrics import instrumented_request, INTEGRATION_LABOUTIK
 
 logger = logging.getLogger(__name__)
 
@@ -135,35 +143,32 @@ class ProductViewSet(viewsets.ViewSet):
         return get_permission_Api_LR_Any(self)
 
 
+def etag_response(request, etag, data):
+    # Réponse conditionnelle : 304 sans corps si le client a déja la bonne version.
+    # Comparaison faible (RFC 9110) : W/"x" == "x"
+    client_etags = [e.removeprefix('W/') for e in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    if etag in client_etags or '*' in client_etags:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(data, headers={'ETag': etag})
+
+
 class TenantViewSet(viewsets.ViewSet):
+    # Lu depuis l'annuaire public (MetaBillet.PlaceDirectory) maintenu par signal sur Configuration :
+    # plus de tenant_context par lieu.
     def list(self, request):
-        places_serialized_with_uuid = []
-        configurations = []
-        categories = []
         if 'place' in request.get_full_path():
-            categories = [Client.SALLE_SPECTACLE, Client.FESTIVAL]
-        if 'artist' in request.get_full_path():
-            categories = [Client.ARTISTE]
-
-        for tenant in Client.objects.filter(categorie__in=categories):
-            with tenant_context(tenant):
-                places_serialized_with_uuid.append({"uuid": f"{tenant.uuid}"})
-                configurations.append(Configuration.get_solo())
-
-        places_serialized = ConfigurationSerializer(configurations, context={'request': request}, many=True)
-
-        for key, value in enumerate(places_serialized.data):
-            places_serialized_with_uuid[key].update(value)
-
-        return Response(places_serialized_with_uuid)
+            etag, places_serialized = PlaceDirectory.get_listing('place')
+        elif 'artist' in request.get_full_path():
+            etag, places_serialized = PlaceDirectory.get_listing('artist')
+        else:
+            return Response([])
+        return etag_response(request, etag, places_serialized)
 
     def retrieve(self, request, pk=None):
-        tenant = get_object_or_404(Client.objects.filter(categorie__in=['S', 'F']), pk=pk)
-        with tenant_context(tenant):
-            place_serialized = ConfigurationSerializer(Configuration.get_solo(), context={'request': request})
-            place_serialized_with_uuid = {'uuid': f"{tenant.uuid}"}
-            place_serialized_with_uuid.update(place_serialized.data)
-        return Response(place_serialized_with_uuid)
+        place_dir = get_object_or_404(
+            PlaceDirectory.objects.filter(categorie__in=PlaceDirectory.LISTINGS['place']).exclude(serialized={}),
+            place__pk=pk)
+        return etag_response(request, PlaceDirectory.make_etag(place_dir.serialized), place_dir.serialized)
 
     def get_permissions(self):
         if self.action == 'create':
@@ -193,15 +198,41 @@ class HereViewSet(viewsets.ViewSet):
             products_serializer = ProductSerializer(products_adhesion, many=True)
             dict_return['membership_products'] = products_serializer.data
 
+            # Places restantes des adhésions à stock limité
+            prices = [price for product in products_adhesion for price in product.prices.all()]
+            stocks = PriceSold.stocks_available(prices)
+            for product in dict_return['membership_products']:
+                for price in product['prices']:
+                    price['stock_available'] = stocks.get(UUID(f"{price['uuid']}"))
+
         return Response(dict_return)
 
     def get_permissions(self):
         return get_permission_Api_LR_Any(self)
 
 
+class OccurrencesViewSet(viewsets.ViewSet):
+    # Prochaines dates des évènements récurrents avec les places restantes, en une requête.
+    # ?event=<uuid> pour un seul évènement.
+    def list(self, request):
+        EventOccurrence.extend_window()
+        queryset = EventOccurrence.upcoming().filter(event__published=True)
+        event = request.query_params.get('event')
+        if event:
+            try:
+                queryset = queryset.filter(event__pk=UUID(event))
+            except ValueError:
+                return Response(_("event doit être un uuid"), status=status.HTTP_400_BAD_REQUEST)
+        serializer = EventOccurrenceSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+    def get_permissions(self):
+        return get_permission_Api_LR_Any(self)
+
+
 class EventsSlugViewSet(viewsets.ViewSet):
     def retrieve(self, request, pk=None):
-        queryset = Event.objects.filter(published=True).order_by('-datetime')
+        queryset = Event.objects.for_listing().filter(published=True).order_by('-datetime')
         # import ipdb; ipdb.set_trace()
         # try :
         #     date_slug = re.search(r"\d{6}-\d{4}", pk).group()
@@ -225,7 +256,7 @@ class EventsViewSet(viewsets.ViewSet):
 
         production_places = [Client.SALLE_SPECTACLE, Client.FESTIVAL]
         if tenant.categorie in production_places:
-            queryset = Event.objects.filter(
+            queryset = Event.objects.for_listing().filter(
                 published=True,
                 datetime__gte=four_hour_before_now,
             ).order_by('datetime')
@@ -250,7 +281,7 @@ class EventsViewSet(viewsets.ViewSet):
 
             for place in directory:
                 with tenant_context(place):
-                    queryset = Event.objects.filter(
+                    queryset = Event.objects.for_listing().filter(
                         published=True,
                         uuid__in=directory[place],
                     )
@@ -261,21 +292,27 @@ class EventsViewSet(viewsets.ViewSet):
             return Response(events_serialized_data)
 
         elif tenant.categorie == Client.META:
-            events_serialized_data = []
-            tenants = Client.objects.filter(categorie=Client.SALLE_SPECTACLE)
-            for other_tenant in tenants:
-                with tenant_context(other_tenant):
-                    queryset = Event.objects.filter(
-                        published=True,
-                        datetime__gte=four_hour_before_now
-                    ).order_by('datetime')
-                    events_serialized = EventSerializer(queryset, many=True, context={'request': request})
-                    for data in events_serialized.data:
-                        events_serialized_data.append(data)
-            return Response(events_serialized_data)
+            # Index public maintenu par signaux : une seule requête, quelque soit le nombre de lieux.
+            # Pagination optionnelle : ?limit=20&offset=40
+            queryset = PublicEventIndex.objects.filter(
+                place__categorie__in=PublicEventIndex.INDEXED_PLACES,
+                datetime__gte=four_hour_before_now,
+            ).order_by('datetime').values_list('card', flat=True)
+
+            try:
+                offset = int(request.query_params.get('offset', 0))
+                limit = request.query_params.get('limit')
+                if limit is not None:
+                    queryset = queryset[offset:offset + int(limit)]
+                elif offset:
+                    queryset = queryset[offset:]
+            except ValueError:
+                return Response(_("limit et offset doivent être des entiers"), status=status.HTTP_400_BAD_REQUEST)
+
+            return Response(list(queryset))
 
     def retrieve(self, request, pk=None):
-        queryset = Event.objects.all().order_by('-datetime')
+        queryset = Event.objects.for_listing().order_by('-datetime')
         event = get_object_or_404(queryset, pk=pk)
         serializer = EventSerializer(event)
         return Response(serializer.data)
@@ -416,12 +453,46 @@ class ReservationViewset(viewsets.ViewSet):
         # import ipdb; ipdb.set_trace()
         logger.info(f"ReservationViewset CREATE : {request.data}")
 
-        validator = ReservationValidator(data=request.data, context={'request': request})
-        if validator.is_valid():
-            return Response(validator.data, status=status.HTTP_201_CREATED)
-
-        logger.error(f"ReservationViewset CREATE ERROR : {validator.errors}")
-        return Response(validator.errors, status=status.HTTP_400_BAD_REQUEST)
+        # File d'attente active : jeton d'admission obligatoire,
+        # vérifié avant de créer quoi que ce soit (utilisateur, réservation, checkout Stripe)
+        try:
+            event = Event.objects.filter(pk=request.data.get('event'), waiting_room=True).first()
+        except ValidationError:
+            # uuid invalide : ReservationValidator renverra l'erreur
+            event = None
+        position = None
+        if event:
+            position = waiting_room.check_admission(
+                event, request.data.get('admission') or request.headers.get('X-Admission-Token'))
+            if position is None:
+                return Response(_("File d'attente : jeton d'admission manquant ou expiré"),
+                                status=status.HTTP_403_FORBIDDEN)
+            try:
+                if not waiting_room.consume_admission(event, position):
+                    return Response(_("File d'attente : jeton d'admission déjà utilisé"),
+                                    status=status.HTTP_403_FORBIDDEN)
+            except redis.RedisError as e:
+                logger.error(f"ReservationViewset consume_admission {event.uuid} : {e}")
+                return Response(_("File d'attente indisponible, réessayez"),
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        # Le jeton n'est dépensé que si la réservation est créée :
+        # rendu sur tout autre chemin, exceptions comprises (Stripe, CreationPaiementStripe...)
+        created = False
+        try:
+            validator = ReservationValidator(data=request.data, context={'request': request})
+            if validator.is_valid():
+                created = True
+                return Response(validator.data, status=status.HTTP_201_CREATED)
+
+            logger.error(f"ReservationViewset CREATE ERROR : {validator.errors}")
+            return Response(validator.errors, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            if position is not None and not created:
+                try:
+                    waiting_room.release_admission(event, position)
+                except redis.RedisError as e:
+                    logger.error(f"ReservationViewset release_admission {event.uuid} : {e}")
 
     def get_permissions(self):
         return get_permission_Api_LR_Admin(self)
@@ -491,6 +562,32 @@ class CancelSubscription(APIView):
         return Response('Pas de renouvellement automatique sur cette adhésion.', status=status.HTTP_406_NOT_ACCEPTABLE)
 
 
+class WaitingRoom(APIView):
+    # File d'attente des mises en vente.
+    # POST : on prend une place. GET ?place=<jeton> : où en est-on ? Jeton d'admission quand c'est notre tour.
+    permission_classes = [AllowAny]
+
+    def post(self, request, event_uuid):
+        event = get_object_or_404(Event, pk=event_uuid, published=True)
+        if not event.waiting_room:
+            return Response({'active': False}, status=status.HTTP_200_OK)
+        try:
+            return Response({'active': True, **waiting_room.join(event)}, status=status.HTTP_201_CREATED)
+        except redis.RedisError as e:
+            logger.error(f"WaitingRoom join {event_uuid} : {e}")
+            return Response(_("File d'attente indisponible, réessayez"), status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def get(self, request, event_uuid):
+        # Polling : Redis et signature seulement, pas de requête en base
+        try:
+            return Response({'active': True, **waiting_room.status(event_uuid, request.query_params.get('place', ''))})
+        except signing.BadSignature:
+            return Response(_("Place invalide ou expirée"), status=status.HTTP_400_BAD_REQUEST)
+        except redis.RedisError as e:
+            logger.error(f"WaitingRoom status {event_uuid} : {e}")
+            return Response(_("File d'attente indisponible, réessayez"), status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 @permission_classes([TenantAdminPermission])
 class Gauge(APIView):
 
@@ -498,21 +595,47 @@ class Gauge(APIView):
     def get(self, request):
         config = Configuration.get_solo()
         debut_jour, lendemain_quatre_heure = borne_temps_4h()
-        queryset = Ticket.objects.filter(
-            reservation__event__datetime__gte=debut_jour,
-            reservation__event__datetime__lte=lendemain_quatre_heure,
-            status__in=[Ticket.NOT_SCANNED, Ticket.SCANNED]
-        )
+        # Compteurs maintenus par les transitions de Ticket : pas de COUNT sur la table des billets
+        counters = Event.objects.with_counters().filter(
+            datetime__gte=debut_jour,
+            datetime__lte=lendemain_quatre_heure,
+        ).aggregate(all_tickets=Sum('sold_count'), scanned_tickets=Sum('scanned_count'))
 
         data = {
             "gauge_max": config.jauge_max,
-            "all_tickets": queryset.count(),
-            "scanned_tickets": queryset.filter(status=Ticket.SCANNED).count()
+            "all_tickets": counters['all_tickets'] or 0,
+            "scanned_tickets": counters['scanned_tickets'] or 0,
         }
 
         return Response(data, status=status.HTTP_200_OK)
 
 
+@permission_classes([TenantAdminPermission])
+class ScanManifest(APIView):
+    # Billets valides de l'évènement pour les scanners hors ligne.
+    # ETag : un scanner qui a déja la bonne version reçoit un 304 sans corps.
+    def get(self, request, event_uuid):
+        event = get_object_or_404(Event, pk=event_uuid)
+        data = {
+            'event': f"{event.uuid}",
+            'fields': ['uuid', 'scan_code', 'status', 'first_name', 'last_name', 'price'],
+            'tickets': TicketScan.manifest(event),
+        }
+        return etag_response(request, PlaceDirectory.make_etag(data), data)
+
+
+@permission_classes([TenantAdminPermission])
+class ScanSync(APIView):
+    # Scans en lot, rejouables sans risque : chaque scan porte un uuid choisi par le scanner.
+    def post(self, request, event_uuid):
+        event = get_object_or_404(Event, pk=event_uuid)
+        validator = ScanSyncValidator(data=request.data)
+        if not validator.is_valid():
+            return Response(validator.errors, status=status.HTTP_400_BAD_REQUEST)
+        results = TicketScan.sync(event, validator.validated_data['scans'])
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
 class TicketViewset(viewsets.ViewSet):
     def list(self, request):
         debut_jour, lendemain_quatre_heure = borne_temps_4h()
@@ -527,8 +650,9 @@ class TicketViewset(viewsets.ViewSet):
         return Response(serializer.data)
 
     def retrieve(self, request, pk=None):
-        queryset = Ticket.objects.all()
-        ticket = get_object_or_404(queryset, pk=pk)
+        # pk : uuid du billet (QR code) ou code barre
+        queryset = Ticket.objects.filter(Ticket.code_filter([pk]))
+        ticket = get_object_or_404(queryset)
         serializer = TicketSerializer(ticket)
         return Response(serializer.data)
 
@@ -602,7 +726,8 @@ def request_for_data_cashless(user: TibilletUser):
             if settings.DEBUG:
                 verify = False
 
-            response = requests.request("POST",
+            response = instrumented_request(INTEGRATION_LABOUTIK,
+                                        "POST",
                                         f"{configuration.server_cashless}/api/membre_check",
                                         headers={"Authorization": f"Api-Key {configuration.key_cashless}"},
                                         data={"email": user.email},
@@ -662,7 +787,8 @@ class ZReportPDF(View):
         configuration = Configuration.get_solo()
         if configuration.server_cashless and configuration.key_cashless:
             try:
-                response = requests.request("GET",
+                response = instrumented_request(INTEGRATION_LABOUTIK,
+                                            "GET",
                                             f"{configuration.server_cashless}/rapport/TicketZapi/{pk_uuid}",
                                             headers={"Authorization": f"Api-Key {configuration.key_cashless}"},
                                             verify=bool(not settings.DEBUG), )
@@ -1,4 +1,7 @@
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from uuid import uuid4
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
@@ -27,18 +30,23 @@ class RootPermission(permissions.BasePermission):
 # Mis à l'extérieur pour pouvoir être utilisé
 # tout seul dans les class view de Django sans RESTframework
 def TenantAdminPermissionWithRequest(request):
-    if request.user.is_authenticated:
+    return is_tenant_admin(request.user, connection.tenant)
+
+
+# Sans request : utilisé aussi par les consumers websocket (wsocket)
+def is_tenant_admin(user, tenant):
+    if user.is_authenticated:
         return any([
             all([
-                connection.tenant in request.user.client_admin.all(),
-                request.user.is_staff,
-                request.user.is_active,
-                request.user.espece == TibilletUser.TYPE_HUM
+                tenant in user.client_admin.all(),
+                user.is_staff,
+                user.is_active,
+                user.espece == TibilletUser.TYPE_HUM
             ]),
             # Pour l'user ROOT qui peut tout faire
             all([
-                request.user.client_source.categorie == Client.ROOT,
-                request.user.is_superuser,
+                user.client_source.categorie == Client.ROOT,
+                user.is_superuser,
             ]),
         ])
     else:
@@ -114,6 +122,57 @@ class TibilletManager(BaseUserManager):
         user.groups.add(staff_group)
 
 
+class LoadedRsaKeyCache():
+    """
+    LRU + TTL des clés RSA déja chargées, par process.
+    load_pem_private_key déchiffre le PEM avec la SECRET_KEY (KDF) : c'est plus long que la signature elle-même.
+    Clé du cache : RsaKey.pk. Une rotation crée un nouvel RsaKey, donc une nouvelle entrée.
+    """
+
+    def __init__(self, maxsize=1024, ttl=900):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pk):
+        with self._lock:
+            entry = self._keys.get(pk)
+            if entry is None:
+                return None
+            expire_at, key = entry
+            if expire_at < time.monotonic():
+                del self._keys[pk]
+                return None
+            self._keys.move_to_end(pk)
+            return key
+
+    def set(self, pk, key):
+        with self._lock:
+            self._keys[pk] = (time.monotonic() + self.ttl, key)
+            self._keys.move_to_end(pk)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def evict(self, pk):
+        with self._lock:
+            self._keys.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+private_keys_cache = LoadedRsaKeyCache(
+    maxsize=getattr(settings, 'RSA_KEY_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'RSA_KEY_CACHE_TTL', 900),
+)
+public_keys_cache = LoadedRsaKeyCache(
+    maxsize=getattr(settings, 'RSA_KEY_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'RSA_KEY_CACHE_TTL', 900),
+)
+
+
 class RsaKey(models.Model):
     private_pem = models.CharField(max_length=2048, editable=False)
     public_pem = models.CharField(max_length=512, editable=False)
@@ -147,6 +206,40 @@ class RsaKey(models.Model):
             public_pem=public_pem.decode('utf-8'),
         )
 
+    def evict_loaded_keys(self):
+        private_keys_cache.evict(self.pk)
+        public_keys_cache.evict(self.pk)
+
+    def save(self, *args, **kwargs):
+        # Normalement jamais modifié, mais si c'est le cas on ne garde pas l'ancienne clé en mémoire.
+        if self.pk:
+            self.evict_loaded_keys()
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self.evict_loaded_keys()
+        return super().delete(*args, **kwargs)
+
+    def private_key(self):
+        private_key = private_keys_cache.get(self.pk)
+        if private_key is None:
+            private_key = serialization.load_pem_private_key(
+                self.private_pem.encode('utf-8'),
+                password=settings.SECRET_KEY.encode('utf-8'),
+            )
+            private_keys_cache.set(self.pk, private_key)
+        return private_key
+
+    def public_key(self):
+        public_key = public_keys_cache.get(self.pk)
+        if public_key is None:
+            public_key = serialization.load_pem_public_key(
+                self.public_pem.encode('utf-8'),
+                backend=default_backend()
+            )
+            public_keys_cache.set(self.pk, public_key)
+        return public_key
+
 
 class Wallet(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False, db_index=True)
@@ -262,12 +355,7 @@ class TibilletUser(AbstractUser):
         if not self.rsa_key:
             self.rsa_key = RsaKey.generate()
             self.save()
-
-        private_key = serialization.load_pem_private_key(
-            self.rsa_key.private_pem.encode('utf-8'),
-            password=settings.SECRET_KEY.encode('utf-8'),
-        )
-        return private_key
+        return self.rsa_key.private_key()
 
     def get_public_pem(self):
         if not self.rsa_key:
@@ -277,11 +365,19 @@ class TibilletUser(AbstractUser):
 
     def get_public_key(self):
         # Charger la clé publique au format PEM
-        public_key = serialization.load_pem_public_key(
-            self.get_public_pem().encode('utf-8'),
-            backend=default_backend()
-        )
-        return public_key
+        if not self.rsa_key:
+            self.rsa_key = RsaKey.generate()
+            self.save()
+        return self.rsa_key.public_key()
+
+    def rotate_rsa_key(self):
+        # Nouvelle paire de clé, l'ancienne est retirée du cache mémoire
+        old_key = self.rsa_key
+        self.rsa_key = RsaKey.generate()
+        self.save()
+        if old_key:
+            old_key.delete()
+        return self.rsa_key
 
     def __str__(self):
         return self.email
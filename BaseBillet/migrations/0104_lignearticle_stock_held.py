@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:23
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def count_sold_stock(apps, schema_editor):
+    # qty_solded n'était jamais maintenu : on le recalcule depuis les lignes payées,
+    # et ces lignes sont marquées comme comptées pour ne pas l'être une seconde fois.
+    LigneArticle = apps.get_model('BaseBillet', 'LigneArticle')
+    PriceSold = apps.get_model('BaseBillet', 'PriceSold')
+    sold_status = ['P', 'F', 'V']
+
+    sold = LigneArticle.objects.filter(status__in=sold_status).values('pricesold').annotate(total=Sum('qty'))
+    for row in sold:
+        PriceSold.objects.filter(pk=row['pricesold']).update(qty_solded=row['total'])
+
+    LigneArticle.objects.filter(status__in=sold_status, qty__gt=0).update(stock_held=models.F('qty'))
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0103_eventinventory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lignearticle',
+            name='stock_held',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(count_sold_stock, reverse_func),
+    ]
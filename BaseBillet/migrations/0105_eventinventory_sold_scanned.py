@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:26
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def count_event_tickets(apps, schema_editor):
+    # Un compteur par évènement, calculé une seule fois depuis les billets existants.
+    Event = apps.get_model('BaseBillet', 'Event')
+    EventInventory = apps.get_model('BaseBillet', 'EventInventory')
+    Reservation = apps.get_model('BaseBillet', 'Reservation')
+    sold_status = ['K', 'S']
+
+    events = Event.objects.annotate(
+        sold=Count('reservation__tickets', filter=Q(reservation__tickets__status__in=sold_status)),
+        scanned=Count('reservation__tickets', filter=Q(reservation__tickets__status='S')),
+        legacy=Count('reservation__tickets', filter=Q(
+            reservation__tickets__status__in=sold_status,
+            reservation__seats_held=0,
+        )),
+    )
+    for event in events:
+        inventory, created = EventInventory.objects.get_or_create(event=event)
+        inventory.sold = event.sold
+        inventory.scanned = event.scanned
+        if created:
+            held = Reservation.objects.filter(event=event).aggregate(held=Sum('seats_held'))['held'] or 0
+            inventory.held = event.legacy + held
+        inventory.save()
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0104_lignearticle_stock_held'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventinventory',
+            name='scanned',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='eventinventory',
+            name='sold',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_event_tickets, reverse_func),
+    ]
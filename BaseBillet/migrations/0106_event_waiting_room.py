@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:28
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0105_eventinventory_sold_scanned'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='waiting_room',
+            field=models.BooleanField(default=False, help_text="Pour les grosses mises en vente : les acheteurs sont admis à la réservation au fil de l'eau.", verbose_name="File d'attente"),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='waiting_room_rate',
+            field=models.PositiveSmallIntegerField(default=60, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Admissions par minute'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0106_event_waiting_room'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketScan',
+            fields=[
+                ('uuid', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('code', models.CharField(max_length=64)),
+                ('device', models.CharField(blank=True, max_length=100)),
+                ('scanned_at', models.DateTimeField()),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('result', models.CharField(choices=[('A', 'Accepté'), ('C', 'Déja scanné'), ('I', 'Billet non valide'), ('U', 'Billet inconnu')], max_length=1)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scans', to='BaseBillet.event')),
+                ('ticket', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='scans', to='BaseBillet.ticket')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ticket', 'result'], name='BaseBillet__ticket__327431_idx')],
+            },
+        ),
+    ]
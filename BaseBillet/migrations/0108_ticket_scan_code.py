@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:40
+
+from django.db import migrations, models
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import urlsafe_base64_encode
+
+
+def fill_scan_code(apps, schema_editor):
+    # Même calcul que Ticket.make_scan_code : le code barre déja imprimé sur les billets
+    Ticket = apps.get_model('BaseBillet', 'Ticket')
+    tickets = []
+    for ticket in Ticket.objects.filter(scan_code__isnull=True).only('uuid').iterator(chunk_size=2000):
+        ticket.scan_code = force_str(urlsafe_base64_encode(force_bytes(f"{ticket.uuid}".split('-')[4])))
+        tickets.append(ticket)
+        if len(tickets) >= 2000:
+            Ticket.objects.bulk_update(tickets, ['scan_code'])
+            tickets = []
+    Ticket.objects.bulk_update(tickets, ['scan_code'])
+
+
+def reverse_func(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0107_ticketscan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='scan_code',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+        migrations.RunPython(fill_scan_code, reverse_func),
+        migrations.AlterField(
+            model_name='ticket',
+            name='scan_code',
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BaseBillet', '0108_ticket_scan_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventOccurrence',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('datetime', models.DateTimeField(db_index=True)),
+                ('capacity', models.PositiveSmallIntegerField(verbose_name='Jauge maximale')),
+                ('held', models.PositiveIntegerField(default=0)),
+                ('sold', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('O', 'Ouverte'), ('C', 'Fermée'), ('X', 'Annulée')], default='O', max_length=1)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='BaseBillet.event')),
+            ],
+            options={
+                'verbose_name': 'Date',
+                'verbose_name_plural': 'Dates',
+                'ordering': ('datetime',),
+                'unique_together': {('event', 'datetime')},
+            },
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='occurrence',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='reservations', to='BaseBillet.eventoccurrence'),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='occurrence',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='tickets', to='BaseBillet.eventoccurrence'),
+        ),
+    ]
@@ -5,16 +5,23 @@ import uuid
 from uuid import uuid4
 from datetime import timedelta, datetime
 from decimal import Decimal
+from django.utils.encoding import force_bytes, force_str
 from django.utils.html import format_html
+from django.utils.http import urlsafe_base64_encode
 
 import requests
 import stripe
+from asgiref.local import Local
 from dateutil.relativedelta import relativedelta
-from django.db import connection
+from django.db import connection, transaction
 from django.db import models
 from django.db.models import JSONField
 # Create your models here.
-from django.db.models import Q
+from django.db.models import Q, F, Sum
+from django.db.models.functions import Greatest, Coalesce
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.core.validators import MinValueValidator
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.urls import reverse
@@ -31,10 +38,11 @@ from stripe.error import InvalidRequestError
 
 import AuthBillet.models
 from Customers.models import Client
-from MetaBillet.models import EventDirectory, ProductDirectory
+from MetaBillet.models import EventDirectory, ProductDirectory, PlaceDirectory
 from QrcodeCashless.models import CarteCashless
 from TiBillet import settings
 from root_billet.models import RootConfiguration
+from root_billet.metrics import instrumented_request, INTEGRATION_LABOUTIK
 
 logger = logging.getLogger(__name__)
 
@@ -99,7 +107,86 @@ def poids_option_generale(sender, instance: OptionGenerale, created, **kwargs):
         instance.save()
 
 
-class Configuration(SingletonModel):
+### SINGLETON PAR TENANT EN CACHE ###
+
+# Mémo local à la requête : ouvert par request_started, fermé par request_finished.
+# Hors requête (celery, shell) pas de mémo, on passe par le cache partagé.
+_request_memo = Local()
+
+
+@receiver(request_started)
+def open_singleton_memo(**kwargs):
+    _request_memo.singletons = {}
+
+
+@receiver(request_finished)
+def close_singleton_memo(**kwargs):
+    _request_memo.singletons = None
+
+
+class TenantCachedSingletonModel(SingletonModel):
+    """
+    get_solo() sans requête SQL :
+    mémo de requête -> cache partagé (clé préfixée par le schéma) -> base.
+    Chaque save réécrit l'entrée du cache partagé : tous les workers voient le changement au prochain get_solo.
+    Un queryset.update() ne passe pas par save : appeler clear_cache() derrière.
+    """
+    cache_timeout = 3600
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_cache_key(cls):
+        return f"solo_{connection.schema_name}_{cls.__name__.lower()}"
+
+    @classmethod
+    def _memo(cls):
+        return getattr(_request_memo, 'singletons', None)
+
+    def set_to_cache(self):
+        key = self.get_cache_key()
+        try:
+            cache.set(key, self, self.cache_timeout)
+        except Exception as e:
+            logger.error(f"set_to_cache {key} : {e}")
+        memo = self._memo()
+        if memo is not None:
+            memo[key] = self
+
+    @classmethod
+    def clear_cache(cls):
+        key = cls.get_cache_key()
+        try:
+            cache.delete(key)
+        except Exception as e:
+            logger.error(f"clear_cache {key} : {e}")
+        memo = cls._memo()
+        if memo is not None:
+            memo.pop(key, None)
+
+    @classmethod
+    def get_solo(cls):
+        key = cls.get_cache_key()
+        memo = cls._memo()
+        if memo is not None and key in memo:
+            return memo[key]
+
+        try:
+            obj = cache.get(key)
+        except Exception as e:
+            logger.warning(f"get_solo {key} : {e} - from db")
+            obj = None
+
+        if obj is None:
+            obj, created = cls.objects.get_or_create(pk=cls.singleton_instance_id)
+            obj.set_to_cache()
+        elif memo is not None:
+            memo[key] = obj
+        return obj
+
+
+class Configuration(TenantCachedSingletonModel):
     def uuid(self):
         return connection.tenant.pk
 
@@ -209,10 +296,10 @@ class Configuration(SingletonModel):
     def logo_variations(self):
         if self.logo:
             return {
-                'fhd': self.img.fhd.url,
-                'hdr': self.img.hdr.url,
-                'med': self.img.med.url,
-                'thumbnail': self.img.thumbnail.url,
+                'fhd': self.logo.fhd.url,
+                'hdr': self.logo.hdr.url,
+                'med': self.logo.med.url,
+                'thumbnail': self.logo.thumbnail.url,
             }
         else:
             return []
@@ -258,8 +345,11 @@ class Configuration(SingletonModel):
         if self.server_cashless and self.key_cashless:
             sess = requests.Session()
             try:
-                r = sess.get(
+                r = instrumented_request(
+                    INTEGRATION_LABOUTIK,
+                    'GET',
                     f'{self.server_cashless}/api/check_apikey',
+                    session=sess,
                     headers={
                         'Authorization': f'Api-Key {self.key_cashless}',
                         'Origin': self.domain(),
@@ -607,6 +697,23 @@ class Price(models.Model):
         verbose_name_plural = _('Tarifs')
 
 
+class EventQuerySet(models.QuerySet):
+    def with_counters(self):
+        # Compteurs maintenus (EventInventory) en une jointure : plus de COUNT par évènement dans les listes.
+        return self.annotate(
+            sold_count=Coalesce(F('inventory__sold'), 0),
+            scanned_count=Coalesce(F('inventory__scanned'), 0),
+            held_count=Coalesce(F('inventory__held'), 0),
+        )
+
+    def for_listing(self):
+        # Tout ce que lit EventSerializer, chargé en une requête par relation et non par évènement
+        return self.with_counters().prefetch_related(
+            'products__prices', 'options_radio', 'options_checkbox',
+            'artists__artist', 'tag', 'recurrent',
+        )
+
+
 class Event(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True, db_index=True)
 
@@ -682,6 +789,12 @@ class Event(models.Model):
                                   help_text=_(
                                       "Si activé, l'évènement sera visible en haut de la page d'accueil, l'utilisateur pourra selectionner une date."))
 
+    waiting_room = models.BooleanField(default=False, verbose_name=_("File d'attente"),
+                                       help_text=_(
+                                           "Pour les grosses mises en vente : les acheteurs sont admis à la réservation au fil de l'eau."))
+    waiting_room_rate = models.PositiveSmallIntegerField(default=60, validators=[MinValueValidator(1)],
+                                                         verbose_name=_("Admissions par minute"))
+
     def reservation_solo(self):
         if self.max_per_user == 1:
             if self.products.all().count() == 1:
@@ -704,27 +817,15 @@ class Event(models.Model):
                 'crop': self.img.crop.url,
             }
         elif self.artists.all().count() > 0:
+            # Image de l'artiste depuis l'annuaire public : pas de changement de schéma
             artist_on_event: Artist_on_event = self.artists.all()[0]
-            tenant: Client = artist_on_event.artist
-            with tenant_context(tenant):
-                img = Configuration.get_solo().img
-
-            return {
-                'fhd': img.fhd.url,
-                'hdr': img.hdr.url,
-                'med': img.med.url,
-                'thumbnail': img.thumbnail.url,
-                'crop_hdr': img.crop_hdr.url,
-                'crop': img.crop.url,
-
-            }
+            return artist_on_event.presentation().get('img_variations') or {}
         else:
             return {}
 
-    def reservations(self):
+    def count_reservations(self):
         """
-        Renvoie toutes les réservations valide d'un évènement.
-        Compte les billets achetés/réservés.
+        COUNT des billets achetés/réservés. Uniquement pour réparer le compteur (EventInventory.recount).
         """
 
         return Ticket.objects.filter(reservation__event__pk=self.pk) \
@@ -732,15 +833,23 @@ class Event(models.Model):
             .exclude(status=Ticket.NOT_ACTIV) \
             .count()
 
+    def reservations(self):
+        """
+        Nombre de billets achetés/réservés.
+        Compteur maintenu par les transitions de Ticket (BaseBillet.signals),
+        annoté en masse par Event.objects.with_counters().
+        """
+        if hasattr(self, 'sold_count'):
+            return self.sold_count
+        return EventInventory.get_for_event(self).sold
+
     def complet(self):
         """
         Un booléen pour savoir si l'évènement est complet ou pas.
+        Compte aussi les places tenues par les paiements en cours.
         """
-
-        if self.reservations() >= self.jauge_max:
-            return True
-        else:
-            return False
+        held = self.held_count if hasattr(self, 'held_count') else EventInventory.get_for_event(self).held
+        return held >= self.jauge_max
 
     # def check_serveur_cashless(self):
     #     config = Configuration.get_solo()
@@ -758,6 +867,19 @@ class Event(models.Model):
 
         return [self.datetime, ]
 
+    def occurrence_datetimes(self, start, end):
+        # Dates de récurrence entre start et end (dates), la date de l'évènement étant la fin de la récurrence.
+        days = [day.day for day in self.recurrent.all()]
+        local = timezone.localtime(self.datetime)
+        end = min(end, local.date())
+        dates = []
+        date = start
+        while date <= end:
+            if date.weekday() in days:
+                dates.append(timezone.make_aware(datetime.combine(date, local.time())))
+            date += timedelta(days=1)
+        return dates
+
     def save(self, *args, **kwargs):
         """
         Transforme le titre de l'evenemennt en slug, pour en faire une url lisible
@@ -774,6 +896,8 @@ class Event(models.Model):
         verbose_name = _('Evenement')
         verbose_name_plural = _('Evenements')
 
+    objects = EventQuerySet.as_manager()
+
 
 @receiver(post_save, sender=Event)
 def add_to_public_event_directory(sender, instance: Event, created, **kwargs):
@@ -806,6 +930,192 @@ def add_to_public_event_directory(sender, instance: Event, created, **kwargs):
             logger.info(f"pricesold {pricesold.price.name} created : {created} - {pricesold.get_id_price_stripe()}")
 
 
+class EventInventory(models.Model):
+    """
+    Places tenues sur un évènement : billets vendus + paniers en attente de paiement.
+    Toujours modifié par un UPDATE conditionnel (held + n <= jauge_max) :
+    deux réservations concurrentes ne peuvent pas dépasser la jauge.
+    """
+    event = models.OneToOneField(Event, on_delete=models.CASCADE, primary_key=True, related_name='inventory')
+    held = models.PositiveIntegerField(default=0)
+    # Billets actifs (non scannés + scannés) et billets scannés, maintenus par les transitions de Ticket
+    sold = models.PositiveIntegerField(default=0)
+    scanned = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def seed_count(cls, event):
+        # Billets vendus avant la mise en place du compteur + places tenues par les réservations
+        # Les réservations sur une date (EventOccurrence) sont comptées dans la jauge de la date
+        legacy = Ticket.objects.filter(
+            reservation__event=event,
+            reservation__occurrence__isnull=True,
+            reservation__seats_held=0,
+            status__in=[Ticket.NOT_SCANNED, Ticket.SCANNED],
+        ).count()
+        held = Reservation.objects.filter(event=event, occurrence__isnull=True) \
+                   .aggregate(held=Sum('seats_held'))['held'] or 0
+        return legacy + held
+
+    @classmethod
+    def counts(cls, event) -> dict:
+        tickets = Ticket.objects.filter(reservation__event=event)
+        return {
+            'held': cls.seed_count(event),
+            'sold': event.count_reservations(),
+            'scanned': tickets.filter(status=Ticket.SCANNED).count(),
+        }
+
+    @classmethod
+    def get_for_event(cls, event):
+        try:
+            return cls.objects.get(event=event)
+        except cls.DoesNotExist:
+            inventory, created = cls.objects.get_or_create(event=event, defaults=cls.counts(event))
+            return inventory
+
+    @classmethod
+    def recount(cls, event):
+        # Réparation : on repart des billets en base
+        inventory, created = cls.objects.update_or_create(event=event, defaults=cls.counts(event))
+        return inventory
+
+    @classmethod
+    def add_counts(cls, event_id, sold=0, scanned=0):
+        cls.objects.filter(event_id=event_id).update(
+            sold=Greatest(F('sold') + sold, 0),
+            scanned=Greatest(F('scanned') + scanned, 0),
+        )
+        # Jauge en direct : un message par évènement et par transaction pour tous les écrans connectés, une fois commité
+        from wsocket.gauge import schedule_push_gauge
+        schedule_push_gauge(event_id)
+        cls.schedule_index_refresh(event_id)
+
+    @staticmethod
+    def schedule_index_refresh(event_id):
+        # Places vendues / tenues : la carte de l'index public est rafraîchie un peu plus tard
+        from MetaBillet.models import PublicEventIndex
+        transaction.on_commit(lambda: PublicEventIndex.schedule_refresh(event_id))
+
+    @classmethod
+    def acquire(cls, event, qty: int, force=False) -> bool:
+        cls.get_for_event(event)
+        inventory = cls.objects.filter(event=event)
+        if not force:
+            # Condition sur la ligne elle même : postgres la réévalue après avoir attendu le verrou.
+            inventory = inventory.filter(held__lte=event.jauge_max - qty)
+        if inventory.update(held=F('held') + qty) != 1:
+            return False
+        cls.schedule_index_refresh(event.pk)
+        return True
+
+    @classmethod
+    def release(cls, event, qty: int):
+        cls.objects.filter(event=event).update(held=Greatest(F('held') - qty, 0))
+        cls.schedule_index_refresh(event.pk)
+
+    @classmethod
+    def available(cls, event) -> int:
+        return max(event.jauge_max - cls.get_for_event(event).held, 0)
+
+    def __str__(self):
+        return f"{self.event} : {self.held}/{self.event.jauge_max}"
+
+
+class EventOccurrence(models.Model):
+    """
+    Une date d'un évènement récurrent (Event.recurrent), avec sa propre jauge.
+    Générées à l'avance sur une fenêtre glissante de settings.OCCURRENCE_WINDOW_DAYS jours.
+    held : places tenues (paniers + billets vendus), même UPDATE conditionnel que EventInventory.
+    sold : billets actifs, maintenu par les transitions de Ticket.
+    """
+    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='occurrences')
+    datetime = models.DateTimeField(db_index=True)
+    capacity = models.PositiveSmallIntegerField(verbose_name=_("Jauge maximale"))
+    held = models.PositiveIntegerField(default=0)
+    sold = models.PositiveIntegerField(default=0)
+
+    OPEN, CLOSED, CANCELED = 'O', 'C', 'X'
+    STATUS_CHOICES = [
+        (OPEN, _('Ouverte')),
+        (CLOSED, _('Fermée')),
+        (CANCELED, _('Annulée')),
+    ]
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=OPEN)
+
+    @classmethod
+    def generate(cls, event) -> int:
+        # Crée les dates manquantes de la fenêtre, retire les dates futures qui ne sont plus dans la récurrence
+        # si personne n'y a réservé. Les dates déja créées gardent leur jauge (modifiable une par une).
+        today = timezone.localdate()
+        dates = event.occurrence_datetimes(today, today + timedelta(days=settings.OCCURRENCE_WINDOW_DAYS))
+        stale = cls.objects.filter(event=event, datetime__gte=timezone.now()).exclude(datetime__in=dates)
+        if not dates and not stale.exists():
+            # Évènement non récurrent (appelé à chaque sauvegarde d'Event) : rien à générer ni à retirer
+            return 0
+
+        # Reservation.occurrence et Ticket.occurrence sont en PROTECT : une date qui en a,
+        # même toutes annulées, est annulée plutôt que supprimée.
+        stale.filter(held=0, sold=0, reservations__isnull=True, tickets__isnull=True).delete()
+        stale.filter(held=0, sold=0).exclude(status=cls.CANCELED).update(status=cls.CANCELED)
+        existing = set(cls.objects.filter(event=event, datetime__in=dates).values_list('datetime', flat=True))
+        created = cls.objects.bulk_create(
+            [cls(event=event, datetime=date, capacity=event.jauge_max) for date in dates if date not in existing],
+            ignore_conflicts=True,
+        )
+        return len(created)
+
+    @classmethod
+    def generate_all(cls) -> int:
+        # Tous les évènements récurrents pas encore terminés du tenant
+        created = 0
+        for event in Event.objects.filter(recurrent__isnull=False, datetime__gte=timezone.now()) \
+                .distinct().prefetch_related('recurrent'):
+            created += cls.generate(event)
+        return created
+
+    @classmethod
+    def extend_window(cls):
+        # Fait avancer la fenêtre au premier appel de la journée (commande generate_occurrences sinon)
+        if cache.add(f"occurrences_window_{connection.schema_name}_{timezone.localdate()}", 1, 24 * 3600):
+            cls.generate_all()
+
+    @classmethod
+    def upcoming(cls):
+        # Dates ouvertes à venir avec les places restantes, en une requête
+        return cls.objects.filter(status=cls.OPEN, datetime__gte=timezone.now()).annotate(
+            available=Greatest(F('capacity') - F('held'), 0, output_field=models.IntegerField()),
+        ).select_related('event').order_by('datetime')
+
+    @classmethod
+    def acquire(cls, occurrence_id, qty: int, force=False) -> bool:
+        occurrence = cls.objects.filter(pk=occurrence_id)
+        if not force:
+            # La jauge est sur la ligne elle même : réévaluée par postgres après le verrou
+            occurrence = occurrence.filter(status=cls.OPEN, held__lte=F('capacity') - qty)
+        return occurrence.update(held=F('held') + qty) == 1
+
+    @classmethod
+    def release(cls, occurrence_id, qty: int):
+        cls.objects.filter(pk=occurrence_id).update(held=Greatest(F('held') - qty, 0))
+
+    @classmethod
+    def add_sold(cls, occurrence_id, sold: int):
+        cls.objects.filter(pk=occurrence_id).update(sold=Greatest(F('sold') + sold, 0))
+
+    def available(self) -> int:
+        return max(self.capacity - self.held, 0)
+
+    def __str__(self):
+        return f"{timezone.localtime(self.datetime).strftime('%d/%m %H:%M')} {self.event.name}"
+
+    class Meta:
+        unique_together = ('event', 'datetime')
+        ordering = ('datetime',)
+        verbose_name = _('Date')
+        verbose_name_plural = _('Dates')
+
+
 class Artist_on_event(models.Model):
     artist = models.ForeignKey(Client, on_delete=models.PROTECT)
     datetime = models.DateTimeField()
@@ -815,6 +1125,10 @@ class Artist_on_event(models.Model):
         with tenant_context(self.artist):
             return Configuration.get_solo()
 
+    def presentation(self):
+        # ConfigurationSerializer de l'artiste, copié dans MetaBillet.PlaceDirectory au save de sa Configuration
+        return PlaceDirectory.get_presentation(self.artist)
+
 
 @receiver(post_save, sender=Artist_on_event)
 def add_to_public_event_directory(sender, instance: Artist_on_event, created, **kwargs):
@@ -983,6 +1297,47 @@ class PriceSold(models.Model):
 
     def total(self):
         return Decimal(self.prix) * Decimal(self.qty_solded)
+
+    # qty_solded : quantité vendue ou en attente de paiement, maintenue à chaque vente.
+    # Limité par price.stock (None = illimité), compté par tarif et par évènement tous PriceSold confondus :
+    # un changement de prix crée un nouveau PriceSold (get_or_create_price_sold).
+    # Le verrou sur le Price sérialise les ventes concurrentes d'un tarif limité le temps de la somme.
+    def acquire_stock(self, qty: int, force=False) -> bool:
+        pricesold = PriceSold.objects.filter(pk=self.pk)
+        stock = Price.objects.filter(pk=self.price_id).values_list('stock', flat=True).first()
+        if stock is None or force:
+            acquired = pricesold.update(qty_solded=F('qty_solded') + qty) == 1
+        else:
+            with transaction.atomic():
+                stock = Price.objects.select_for_update().filter(
+                    pk=self.price_id).values_list('stock', flat=True).first()
+                if stock is not None:
+                    solded = PriceSold.objects.filter(
+                        price_id=self.price_id, productsold__event_id=self.productsold.event_id,
+                    ).aggregate(total=Sum('qty_solded'))['total'] or 0
+                    if solded + qty > stock:
+                        return False
+                acquired = pricesold.update(qty_solded=F('qty_solded') + qty) == 1
+
+        if acquired:
+            # Stock restant affiché sur la carte de l'index public
+            EventInventory.schedule_index_refresh(self.productsold.event_id)
+        return acquired
+
+    def release_stock(self, qty: int):
+        PriceSold.objects.filter(pk=self.pk).update(qty_solded=Greatest(F('qty_solded') - qty, 0))
+        EventInventory.schedule_index_refresh(self.productsold.event_id)
+
+    @staticmethod
+    def stocks_available(prices, event=None) -> dict:
+        # {price_uuid: places restantes} pour les tarifs à stock limité, en une requête.
+        limited = {price.pk: price.stock for price in prices if price.stock is not None}
+        if not limited:
+            return {}
+        solded = dict(PriceSold.objects.filter(
+            price__in=limited.keys(), productsold__event=event,
+        ).values('price_id').annotate(total=Sum('qty_solded')).values_list('price_id', 'total'))
+        return {pk: max(stock - solded.get(pk, 0), 0) for pk, stock in limited.items()}
     # class meta:
     #     unique_together = [['productsold', 'price']]
 
@@ -1037,12 +1392,46 @@ class Reservation(models.Model):
 
     options = models.ManyToManyField(OptionGenerale, blank=True)
 
+    # Date réservée pour les évènements récurrents : la jauge est alors celle de l'occurrence.
+    occurrence = models.ForeignKey(EventOccurrence, on_delete=models.PROTECT, blank=True, null=True,
+                                   related_name='reservations')
+
+    # Places tenues dans EventInventory (ou EventOccurrence) par cette réservation. 0 une fois rendues.
+    seats_held = models.PositiveSmallIntegerField(default=0)
+
     class Meta:
         ordering = ('-datetime',)
 
     def user_mail(self):
         return self.user_commande.email
 
+    def release_seats(self):
+        # Idempotent : seul l'appel qui remet seats_held à 0 rend les places à l'évènement.
+        qty = self.seats_held
+        if qty and Reservation.objects.filter(pk=self.pk, seats_held=qty).update(seats_held=0):
+            if self.occurrence_id:
+                EventOccurrence.release(self.occurrence_id, qty)
+            else:
+                EventInventory.release(self.event, qty)
+            logger.info(f"Reservation {self.pk} : {qty} places rendues sur {self.event}")
+        self.seats_held = 0
+
+    def ensure_seats(self):
+        # Paiement reçu sans place tenue (paiement après expiration, réservation antérieure au compteur) :
+        # l'argent est encaissé, on compte les billets même au-delà de la jauge.
+        if self.seats_held:
+            return
+        qty = self.tickets.count()
+        if qty and Reservation.objects.filter(pk=self.pk, seats_held=0).update(seats_held=qty):
+            if self.occurrence_id:
+                if not EventOccurrence.acquire(self.occurrence_id, qty):
+                    logger.warning(f"Reservation {self.pk} payée hors jauge sur {self.occurrence_id} : +{qty}")
+                    EventOccurrence.acquire(self.occurrence_id, qty, force=True)
+            elif not EventInventory.acquire(self.event, qty):
+                logger.warning(f"Reservation {self.pk} payée hors jauge sur {self.event} : +{qty}")
+                EventInventory.acquire(self.event, qty, force=True)
+            self.seats_held = qty
+
     def paiements_paid(self):
         return self.paiements.filter(
             Q(status=Paiement_stripe.PAID) | Q(status=Paiement_stripe.VALID)
@@ -1097,6 +1486,10 @@ class Ticket(models.Model):
 
     pricesold = models.ForeignKey(PriceSold, on_delete=models.CASCADE)
 
+    # Copie de reservation.occurrence : compteurs et scans par date sans jointure
+    occurrence = models.ForeignKey(EventOccurrence, on_delete=models.PROTECT, blank=True, null=True,
+                                   related_name='tickets')
+
     CREATED, NOT_ACTIV, NOT_SCANNED, SCANNED = 'C', 'N', 'K', 'S'
     SCAN_CHOICES = [
         (CREATED, _('Crée')),
@@ -1110,6 +1503,29 @@ class Ticket(models.Model):
 
     seat = models.CharField(max_length=20, default=_('L'))
 
+    # Code barre (Code128) imprimé sur le billet, le QR code porte l'uuid.
+    scan_code = models.CharField(max_length=32, unique=True, editable=False)
+
+    @staticmethod
+    def make_scan_code(ticket_uuid) -> str:
+        return force_str(urlsafe_base64_encode(force_bytes(f"{ticket_uuid}".split('-')[4])))
+
+    @staticmethod
+    def code_filter(codes) -> Q:
+        # Codes lus par un scanner : uuid (QR code) ou scan_code (code barre), deux index uniques.
+        uuids = []
+        for code in codes:
+            try:
+                uuids.append(uuid.UUID(f"{code}"))
+            except ValueError:
+                pass
+        return Q(pk__in=uuids) | Q(scan_code__in=[f"{code}" for code in codes])
+
+    def save(self, *args, **kwargs):
+        if not self.scan_code:
+            self.scan_code = self.make_scan_code(self.uuid)
+        super().save(*args, **kwargs)
+
     def pdf_filename(self):
         config = Configuration.get_solo()
         return f"{config.organisation.upper()} " \
@@ -1120,7 +1536,7 @@ class Ticket(models.Model):
                f".pdf"
 
     def pdf_url(self):
-        domain = connection.tenant.domains.all().first().domain
+        domain = connection.tenant.get_primary_domain().domain
         api_pdf = reverse("ticket_uuid_to_pdf", args=[f"{self.uuid}"])
         protocol = "https://"
         port = ""
@@ -1157,6 +1573,124 @@ class Ticket(models.Model):
         verbose_name_plural = _('Réservations')
 
 
+class TicketScan(models.Model):
+    """
+    Scan envoyé par un scanner de porte, en direct ou en lot au retour du réseau (ApiBillet ScanSync).
+    L'uuid est choisi par le scanner : renvoyer deux fois le même lot ne scanne pas deux fois.
+    Le premier scan d'un billet est accepté, les suivants sont gardés en conflit.
+    """
+    uuid = models.UUIDField(primary_key=True, editable=False)
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='scans')
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='scans', blank=True, null=True)
+    code = models.CharField(max_length=64)
+    device = models.CharField(max_length=100, blank=True)
+    scanned_at = models.DateTimeField()
+    received = models.DateTimeField(auto_now_add=True)
+
+    ACCEPTED, CONFLICT, INVALID, UNKNOWN = 'A', 'C', 'I', 'U'
+    RESULT_CHOICES = [
+        (ACCEPTED, _('Accepté')),
+        (CONFLICT, _('Déja scanné')),
+        (INVALID, _('Billet non valide')),
+        (UNKNOWN, _('Billet inconnu')),
+    ]
+    result = models.CharField(max_length=1, choices=RESULT_CHOICES)
+
+    @staticmethod
+    def manifest(event) -> list:
+        # Billets valides de l'évènement, format compact pour les scanners hors ligne
+        return [list(row) for row in Ticket.objects.filter(
+            reservation__event=event,
+            status__in=[Ticket.NOT_SCANNED, Ticket.SCANNED],
+        ).order_by('uuid').values_list('uuid', 'scan_code', 'status', 'first_name', 'last_name',
+                                       'pricesold__price__name')]
+
+    @classmethod
+    def sync(cls, event, scans: list) -> list:
+        """
+        scans : [{'uuid', 'code', 'scanned_at', 'device'}], code = QR code ou code barre du billet.
+        Une poignée de requêtes par lot, quelle que soit sa taille :
+        le passage en scanné est un UPDATE conditionnel, seul le premier scan d'un billet le gagne.
+        """
+        already = {scan.uuid: scan for scan in cls.objects.filter(uuid__in=[scan['uuid'] for scan in scans])}
+        # Un même scan peut apparaître deux fois dans un lot renvoyé : on le garde une fois
+        new_scans = sorted({scan['uuid']: scan for scan in scans if scan['uuid'] not in already}.values(),
+                           key=lambda scan: scan['scanned_at'])
+
+        # QR code (uuid) ou code barre (scan_code) : une requête sur les index uniques pour tout le lot
+        tickets, code_to_ticket = {}, {}
+        for pk, scan_code, status in Ticket.objects.filter(
+                Ticket.code_filter({f"{scan['code']}" for scan in new_scans}),
+                reservation__event=event,
+        ).values_list('pk', 'scan_code', 'status'):
+            tickets[pk] = status
+            code_to_ticket[f"{pk}"] = pk
+            code_to_ticket[scan_code] = pk
+
+        def ticket_of(code):
+            code = f"{code}"
+            if code in code_to_ticket:
+                return code_to_ticket[code]
+            try:
+                return code_to_ticket.get(f"{uuid.UUID(code)}")
+            except ValueError:
+                return None
+
+        with transaction.atomic():
+            # Billets non scannés de ce lot : un seul UPDATE, RETURNING donne ceux qu'on a vraiment scannés.
+            # Un autre lot qui arrive en même temps attend le verrou puis ne trouve plus ces billets en 'K'.
+            to_scan = [f"{pk}" for pk, status in tickets.items() if status == Ticket.NOT_SCANNED]
+            scanned = set()
+            if to_scan:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'UPDATE "{Ticket._meta.db_table}" SET status = %s '
+                        f'WHERE uuid = ANY(%s::uuid[]) AND status = %s RETURNING uuid',
+                        [Ticket.SCANNED, to_scan, Ticket.NOT_SCANNED])
+                    scanned = {uuid.UUID(f"{row[0]}") for row in cursor.fetchall()}
+                # UPDATE sans signaux : compteur de l'évènement à la main
+                EventInventory.add_counts(event.pk, scanned=len(scanned))
+
+            created = []
+            for scan in new_scans:
+                ticket_pk = ticket_of(scan['code'])
+                if ticket_pk is None:
+                    result, ticket_pk = cls.UNKNOWN, None
+                elif ticket_pk in scanned:
+                    # Premier scan du lot pour ce billet, les suivants sont en conflit
+                    result = cls.ACCEPTED
+                    scanned.discard(ticket_pk)
+                elif tickets[ticket_pk] in [Ticket.NOT_SCANNED, Ticket.SCANNED]:
+                    result = cls.CONFLICT
+                else:
+                    result = cls.INVALID
+                created.append(cls(
+                    uuid=scan['uuid'], event=event, ticket_id=ticket_pk, code=f"{scan['code']}"[:64],
+                    device=scan.get('device', '')[:100], scanned_at=scan['scanned_at'], result=result,
+                ))
+            cls.objects.bulk_create(created, ignore_conflicts=True)
+
+        # Pour les conflits : qui a scanné en premier, et quand
+        ticket_scans = {**already, **{scan.uuid: scan for scan in created}}
+        conflicts = [scan.ticket_id for scan in ticket_scans.values() if scan.result == cls.CONFLICT]
+        first_scans = {scan.ticket_id: scan for scan in cls.objects.filter(ticket__in=conflicts, result=cls.ACCEPTED)}
+
+        results = []
+        for scan in scans:
+            ticket_scan = ticket_scans[scan['uuid']]
+            data = {'uuid': f"{ticket_scan.uuid}", 'result': ticket_scan.result}
+            first = first_scans.get(ticket_scan.ticket_id)
+            if ticket_scan.result == cls.CONFLICT and first:
+                data['first_scan'] = {'device': first.device, 'scanned_at': first.scanned_at}
+            results.append(data)
+        return results
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ticket', 'result']),
+        ]
+
+
 class FedowTransaction(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False, db_index=False)
     hash = models.CharField(max_length=64, unique=True, editable=False)
@@ -1254,8 +1788,15 @@ class Paiement_stripe(models.Model):
             stripe_account=config.get_stripe_connect_account()
         )
 
+        # Session expirée : Stripe la renvoie toujours en "unpaid", on teste l'expiration en premier
+        # pour que la transition vers EXPIRE rende les places et le stock (BaseBillet.signals)
+        if checkout_session.payment_status != "paid" and (
+                checkout_session.status == "expired"
+                or datetime.now().timestamp() > checkout_session.expires_at):
+            self.status = Paiement_stripe.EXPIRE
+
         # Pas payé, on le met en attente
-        if checkout_session.payment_status == "unpaid":
+        elif checkout_session.payment_status == "unpaid":
             self.status = Paiement_stripe.PENDING
 
         elif checkout_session.payment_status == "paid":
@@ -1276,10 +1817,6 @@ class Paiement_stripe(models.Model):
                     )
                     self.invoice_stripe = subscription.latest_invoice
 
-        # Si le paiement est expiré
-        elif datetime.now().timestamp() > checkout_session.expires_at:
-            self.status = Paiement_stripe.EXPIRE
-
         self.save()
         return self.status
 
@@ -1315,9 +1852,30 @@ class LigneArticle(models.Model):
     status = models.CharField(max_length=3, choices=TYPE_CHOICES, default=CREATED,
                               verbose_name=_("Status de ligne article"))
 
+    # Quantité comptée dans pricesold.qty_solded par cette ligne. 0 une fois rendue.
+    stock_held = models.PositiveSmallIntegerField(default=0)
+
     class Meta:
         ordering = ('-datetime',)
 
+    def release_stock(self):
+        # Idempotent, même principe que Reservation.release_seats
+        qty = self.stock_held
+        if qty and LigneArticle.objects.filter(pk=self.pk, stock_held=qty).update(stock_held=0):
+            self.pricesold.release_stock(qty)
+        self.stock_held = 0
+
+    def ensure_stock(self):
+        # Paiement reçu pour une ligne dont le stock avait été rendu : on la recompte, même hors stock.
+        qty = int(self.qty)
+        if self.stock_held or qty <= 0:
+            return
+        if LigneArticle.objects.filter(pk=self.pk, stock_held=0).update(stock_held=qty):
+            if not self.pricesold.acquire_stock(qty):
+                logger.warning(f"LigneArticle {self.pk} payée hors stock : {self.pricesold} +{qty}")
+                self.pricesold.acquire_stock(qty, force=True)
+            self.stock_held = qty
+
     def total(self):
         return Decimal(self.pricesold.prix) * Decimal(self.qty)
 
@@ -1,17 +1,20 @@
 from django.db import connection
 import logging
 
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 
 from AuthBillet.models import TibilletUser
-from BaseBillet.models import Reservation, LigneArticle, Ticket, Paiement_stripe, Product, PriceSold, Price
+from BaseBillet.models import Reservation, LigneArticle, Ticket, Paiement_stripe, Product, PriceSold, Price, \
+    Configuration, Event, EventInventory, EventOccurrence
 from BaseBillet.tasks import ticket_celery_mailer, webhook_reservation
 from BaseBillet.triggers import ActionArticlePaidByCategorie
 from fedow_connect.fedow_api import AssetFedow
 from fedow_connect.models import FedowConfig
+from Customers.models import Client
+from MetaBillet.models import PlaceDirectory, PublicEventIndex
 
 logger = logging.getLogger(__name__)
 
@@ -35,11 +38,15 @@ def set_ligne_article_paid(old_instance, new_instance):
     lignes_article = new_instance.lignearticles.exclude(status=LigneArticle.VALID)
     for ligne_article in lignes_article:
         logger.info(f"            {ligne_article.pricesold} {ligne_article.status} to P")
+        # Paiement arrivé après expiration : le stock avait été rendu
+        ligne_article.ensure_stock()
         ligne_article.status = LigneArticle.PAID
         ligne_article.save()
 
     # s'il y a une réservation, on la met aussi en payée :
     if new_instance.reservation:
+        # Paiement arrivé après expiration : les places avaient été rendues
+        new_instance.reservation.ensure_seats()
         new_instance.reservation.status = Reservation.PAID
         new_instance.reservation.save()
     # except new_instance.reservation.RelatedObjectDoesNotExist:
@@ -47,7 +54,11 @@ def set_ligne_article_paid(old_instance, new_instance):
 
 def expire_paiement_stripe(old_instance, new_instance):
     logger.info(f"    SIGNAL PAIEMENT STRIPE expire_paiement_stripe {old_instance.status} to {new_instance.status}")
-    pass
+    # Les places et le stock des tarifs tenus pendant le paiement sont rendus
+    if new_instance.reservation:
+        new_instance.reservation.release_seats()
+    for ligne_article in new_instance.lignearticles.filter(stock_held__gt=0):
+        ligne_article.release_stock()
 
 
 def valide_stripe_paiement(old_instance, new_instance):
@@ -170,6 +181,59 @@ def activator_free_reservation(old_instance: TibilletUser, new_instance: Tibille
             resa.save()
 
 
+######################## SIGNAL TICKET ########################
+
+# Compteurs de billets de l'évènement (EventInventory.sold / scanned) :
+# plus de COUNT sur Ticket à chaque lecture de Event.reservations()
+SOLD_TICKET_STATUS = [Ticket.NOT_SCANNED, Ticket.SCANNED]
+
+
+def _count_ticket_delta(ticket: Ticket, sold, scanned):
+    if sold or scanned:
+        event_id, occurrence_id = ticket.reservation.event_id, ticket.occurrence_id
+
+        # Après commit : un save annulé ne doit pas bouger le compteur
+        def count():
+            EventInventory.add_counts(event_id, sold=sold, scanned=scanned)
+            if occurrence_id and sold:
+                EventOccurrence.add_sold(occurrence_id, sold)
+
+        transaction.on_commit(count)
+
+
+def count_ticket_transition(old_instance: Ticket, new_instance: Ticket):
+    sold = (new_instance.status in SOLD_TICKET_STATUS) - (old_instance.status in SOLD_TICKET_STATUS)
+    scanned = (new_instance.status == Ticket.SCANNED) - (old_instance.status == Ticket.SCANNED)
+    _count_ticket_delta(new_instance, sold, scanned)
+
+
+@receiver(post_save, sender=Ticket)
+def count_created_ticket(sender, instance: Ticket, created, **kwargs):
+    # Les transitions ne passent que par le pre_save d'une instance existante
+    if created and instance.status in SOLD_TICKET_STATUS:
+        _count_ticket_delta(instance, 1, int(instance.status == Ticket.SCANNED))
+
+
+@receiver(post_delete, sender=Ticket)
+def count_deleted_ticket(sender, instance: Ticket, **kwargs):
+    if instance.status in SOLD_TICKET_STATUS:
+        _count_ticket_delta(instance, -1, -int(instance.status == Ticket.SCANNED))
+
+
+@receiver(post_save, sender=Event)
+def create_event_inventory(sender, instance: Event, created, **kwargs):
+    if created:
+        EventInventory.objects.get_or_create(event=instance)
+    # Date ou heure modifiée : on régénère les dates des évènements récurrents
+    EventOccurrence.generate(instance)
+
+
+@receiver(m2m_changed, sender=Event.recurrent.through)
+def generate_event_occurrences(sender, instance: Event, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear'] and isinstance(instance, Event):
+        EventOccurrence.generate(instance)
+
+
 ######################## MOTEUR SIGNAL ########################
 
 def error_regression(old_instance, new_instance):
@@ -188,6 +252,12 @@ def test_signal(old_instance, new_instance):
 
 PRE_SAVE_TRANSITIONS = {
     'PAIEMENT_STRIPE': {
+        # Session jamais revenue de Stripe : check_checkout_expiration interroge aussi les paiements OPEN
+        Paiement_stripe.OPEN: {
+            Paiement_stripe.PAID: set_ligne_article_paid,
+            Paiement_stripe.EXPIRE: expire_paiement_stripe,
+            Paiement_stripe.CANCELED: expire_paiement_stripe,
+        },
         Paiement_stripe.PENDING: {
             Paiement_stripe.PAID: set_ligne_article_paid,
             Paiement_stripe.EXPIRE: expire_paiement_stripe,
@@ -253,6 +323,13 @@ PRE_SAVE_TRANSITIONS = {
             True: activator_free_reservation,
         }
     },
+
+    'TICKET': {
+        Ticket.CREATED: {'_all_': count_ticket_transition},
+        Ticket.NOT_ACTIV: {'_all_': count_ticket_transition},
+        Ticket.NOT_SCANNED: {'_all_': count_ticket_transition},
+        Ticket.SCANNED: {'_all_': count_ticket_transition},
+    },
 }
 
 
@@ -319,4 +396,76 @@ def send_membership_and_badge_product_to_fedow(sender, instance: Product, create
 def price_if_free_set_t_1(sender, instance: Price, **kwargs):
     if instance.free_price:
         # Quantité unitaire pour caisse enregistreuse
-        instance.prix=1
\ No newline at end of file
+        instance.prix=1
+
+
+######################## ANNUAIRE DES LIEUX ########################
+
+def _current_tenant():
+    tenant = connection.tenant
+    if not isinstance(tenant, Client) or tenant.schema_name == 'public':
+        # FakeTenant (tests, celery sans tenant) ou schéma public : rien à publier
+        return None
+    return tenant
+
+
+@receiver(post_save, sender=Configuration)
+def update_place_directory_from_configuration(sender, instance: Configuration, **kwargs):
+    tenant = _current_tenant()
+    if tenant:
+        try:
+            PlaceDirectory.update_place(tenant, config=instance)
+        except Exception as e:
+            logger.error(f"update_place_directory_from_configuration {tenant} : {e}")
+
+
+@receiver(post_save, sender=FedowConfig)
+def update_place_directory_from_fedow_config(sender, instance: FedowConfig, **kwargs):
+    tenant = _current_tenant()
+    if tenant:
+        try:
+            PlaceDirectory.update_place(tenant, fedow_config=instance)
+        except Exception as e:
+            logger.error(f"update_place_directory_from_fedow_config {tenant} : {e}")
+
+
+######################## INDEX PUBLIC DES EVENEMENTS ########################
+
+def _index_events(events):
+    if not _current_tenant():
+        return
+    for event in events:
+        try:
+            PublicEventIndex.index_event(event)
+        except Exception as e:
+            logger.error(f"PublicEventIndex.index_event {event} : {e}")
+
+
+@receiver(post_save, sender=Event)
+def index_event_on_save(sender, instance: Event, **kwargs):
+    _index_events([instance])
+
+
+@receiver(m2m_changed, sender=Event.products.through)
+@receiver(m2m_changed, sender=Event.tag.through)
+@receiver(m2m_changed, sender=Event.recurrent.through)
+def index_event_on_m2m(sender, instance, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear'] and isinstance(instance, Event):
+        _index_events([instance])
+
+
+@receiver(post_delete, sender=Event)
+def unindex_event_on_delete(sender, instance: Event, **kwargs):
+    if _current_tenant():
+        PublicEventIndex.unindex_event(instance.uuid)
+
+
+@receiver(post_save, sender=Product)
+def index_events_of_product(sender, instance: Product, **kwargs):
+    _index_events(Event.objects.filter(products=instance, published=True))
+
+
+@receiver(post_save, sender=Price)
+@receiver(post_delete, sender=Price)
+def index_events_of_price(sender, instance: Price, **kwargs):
+    _index_events(Event.objects.filter(products=instance.product_id, published=True))
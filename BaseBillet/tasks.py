@@ -15,26 +15,26 @@ from celery.exceptions import MaxRetriesExceededError
 from django.conf import settings
 from django.contrib.auth import get_user_model
 # from django.contrib.auth.tokens import default_token_generator
+from django.core.cache import cache
 from django.core.mail import EmailMultiAlternatives
 from django.core.signing import Signer, TimestampSigner
 from django.db import connection
 from django.template.loader import render_to_string, get_template
 from django.utils import timezone
-from django.utils.encoding import force_bytes, force_str
+from django.utils.encoding import force_str
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from weasyprint import HTML, CSS
 from weasyprint.text.fonts import FontConfiguration
 
-from BaseBillet.models import Reservation, Ticket, Configuration, Membership, Webhook, Paiement_stripe
+from BaseBillet.models import Reservation, Ticket, Configuration, Membership, Webhook, Paiement_stripe, Event
 from Customers.models import Client
+from MetaBillet.models import PublicEventIndex
 from TiBillet.celery import app
+from root_billet.metrics import instrumented_request, INTEGRATION_LABOUTIK, INTEGRATION_WEBHOOK, INTEGRATION_GHOST
 
 logger = logging.getLogger(__name__)
 
 
-def encode_uid(pk):
-    return force_str(urlsafe_base64_encode(force_bytes(pk)))
-
 def decode_uid(pk):
     return force_str(urlsafe_base64_decode(pk))
 
@@ -201,7 +201,7 @@ def create_ticket_pdf(ticket: Ticket):
     # Pour faire le barcode
     CODE128 = barcode.get_barcode_class('code128')
     bar_svg = BytesIO()
-    bar_secret = encode_uid(f"{ticket.uuid}".split('-')[4])
+    bar_secret = ticket.scan_code
     bar = CODE128(f"{bar_secret}")
     options = {
         'module_height': 30,
@@ -611,7 +611,7 @@ def webhook_reservation(reservation_pk):
 
         for webhook in webhooks:
             try:
-                response = requests.request("POST", webhook.url, data=json, timeout=2)
+                response = instrumented_request(INTEGRATION_WEBHOOK, "POST", webhook.url, data=json, timeout=2)
                 webhook.last_response = f"{timezone.now()} - status code {response.status_code} - {response.text}"
             except Exception as e:
                 logger.error(f"webhook_reservation ERROR : {reservation_pk} {timezone.now()} {e}")
@@ -619,6 +619,28 @@ def webhook_reservation(reservation_pk):
             webhook.save()
 
 
+@app.task
+def check_checkout_expiration(paiement_stripe_uuid):
+    # Lancée à l'expiration de la session Stripe d'une réservation ou d'une adhésion.
+    # Si le paiement est toujours en attente, update_checkout_status le passe en EXPIRE
+    # et le pre_save BaseBillet.signals rend les places à l'évènement et le stock des tarifs.
+    paiement_stripe = Paiement_stripe.objects.get(uuid=paiement_stripe_uuid)
+    if paiement_stripe.status in [Paiement_stripe.PENDING, Paiement_stripe.OPEN]:
+        status = paiement_stripe.update_checkout_status()
+        logger.info(f"check_checkout_expiration : {paiement_stripe_uuid} -> {status}")
+
+
+@app.task
+def refresh_event_index(event_uuid):
+    # Compteurs de la carte de l'index public, programmée par PublicEventIndex.schedule_refresh.
+    # La clé est retirée avant la lecture : un changement pendant le rafraîchissement en programme un autre.
+    cache.delete(PublicEventIndex.refresh_key(connection.schema_name, event_uuid))
+    event = Event.objects.with_counters().filter(pk=event_uuid).prefetch_related(
+        'products__prices', 'recurrent').first()
+    if event:
+        PublicEventIndex.refresh_live(event)
+
+
 @app.task
 def send_to_ghost(membership_pk):
     membership = Membership.objects.get(pk=membership_pk)
@@ -670,7 +692,8 @@ def send_to_ghost(membership_pk):
         headers = {'Authorization': f'Ghost {token}'}
 
         # Récupérer la liste des membres de l'instance Ghost
-        response = requests.get(ghost_url + "/ghost/api/admin/members/", params=filter, headers=headers)
+        response = instrumented_request(INTEGRATION_GHOST, "GET", ghost_url + "/ghost/api/admin/members/",
+                                        params=filter, headers=headers)
 
         # Vérifier que la réponse de l'API est valide
         if response.status_code == 200:
@@ -692,7 +715,8 @@ def send_to_ghost(membership_pk):
                 }
 
                 # Ajouter le nouveau membre à l'instance Ghost
-                response = requests.post(ghost_url + "/ghost/api/admin/members/", json=member_data, headers=headers)
+                response = instrumented_request(INTEGRATION_GHOST, "POST", ghost_url + "/ghost/api/admin/members/",
+                                                json=member_data, headers=headers)
 
                 # Vérifier que la réponse de l'API est valide
                 if response.status_code == 201:
@@ -724,7 +748,9 @@ def celery_post_request(self, url, headers, data):
     MAX_RETRY_TIME = 86400  # 24 * 60 * 60 seconds = 24 h
     try :
         logger.info(f"start celery_post_request to {url}")
-        response = requests.post(
+        response = instrumented_request(
+            INTEGRATION_LABOUTIK,
+            'POST',
             f'{url}',
             headers=headers,
             data=data,
@@ -1,9 +1,15 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.core.serializers.json import DjangoJSONEncoder
-from django.test import TestCase, tag
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, tag
+from django.utils import timezone
+from django_tenants.utils import schema_context, tenant_context
 
 from AuthBillet.utils import get_or_create_user
 
@@ -55,4 +61,233 @@ class BaseBilletTest(TestCase):
 
 # test = BaseBilletTest()
 # test.setUp()
-# test.test_admin_post()
\ No newline at end of file
+# test.test_admin_post()
+
+
+class EventInventoryStressTest(TransactionTestCase):
+    # TransactionTestCase : les threads doivent voir les données commitées.
+
+    def setUp(self):
+        from Customers.models import Client
+        from BaseBillet.models import Event
+        with schema_context('public'):
+            call_command('install')
+            self.tenant = Client.objects.filter(categorie=Client.SALLE_SPECTACLE).first()
+        with tenant_context(self.tenant):
+            self.event = Event.objects.create(
+                name="Stress test jauge",
+                datetime=timezone.now() + timedelta(days=7),
+                jauge_max=50,
+            )
+
+    @tag('stress')
+    def test_no_oversell_under_concurrency(self):
+        from BaseBillet.models import Event, EventInventory
+
+        def book(i):
+            try:
+                with tenant_context(self.tenant):
+                    event = Event.objects.get(pk=self.event.pk)
+                    return EventInventory.acquire(event, 1 + i % 2)
+            finally:
+                connection.close()
+
+        attempts = 400
+        with ThreadPoolExecutor(max_workers=48) as executor:
+            results = list(executor.map(book, range(attempts)))
+
+        with tenant_context(self.tenant):
+            held = EventInventory.objects.get(event=self.event).held
+            expected = sum(1 + i % 2 for i, ok in enumerate(results) if ok)
+            self.assertEqual(held, expected)
+            self.assertEqual(held, self.event.jauge_max)
+
+            EventInventory.release(self.event, 3)
+            self.assertEqual(EventInventory.available(self.event), 3)
+            self.assertFalse(EventInventory.acquire(self.event, 4))
+            self.assertTrue(EventInventory.acquire(self.event, 3))
+
+
+class ReservationExpiryTest(TransactionTestCase):
+    # Parcours complet : ReservationValidator tient les places et le stock,
+    # l'expiration de la session Stripe (check_checkout_expiration) les rend.
+
+    def setUp(self):
+        from Customers.models import Client
+        from BaseBillet.models import Event, Product, Price
+        with schema_context('public'):
+            call_command('install')
+            self.tenant = Client.objects.filter(categorie=Client.SALLE_SPECTACLE).first()
+        with tenant_context(self.tenant):
+            self.event = Event.objects.create(
+                name="Expiration checkout",
+                datetime=timezone.now() + timedelta(days=7),
+                jauge_max=10,
+            )
+            product = Product.objects.create(name="Billet expiration", categorie_article=Product.BILLET)
+            self.price = Price.objects.create(product=product, name="Plein tarif", prix=10, stock=5)
+            self.event.products.add(product)
+
+    def reserve(self, qty):
+        from unittest import mock
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from ApiBillet.serializers import ReservationValidator
+        from BaseBillet.models import LigneArticle, Paiement_stripe, PriceSold, ProductSold
+
+        def fake_checkout(user, liste_ligne_article, reservation, **kwargs):
+            paiement = Paiement_stripe.objects.create(
+                user=user, reservation=reservation, status=Paiement_stripe.PENDING,
+                checkout_session_id_stripe="cs_test_expiration")
+            LigneArticle.objects.filter(pk__in=[line.pk for line in liste_ligne_article]) \
+                .update(paiement_stripe=paiement)
+            return mock.Mock(is_valid=lambda: True, paiement_stripe_db=paiement,
+                             checkout_session=mock.Mock(url="https://stripe.test", stripe_id="cs_test_expiration"))
+
+        request = RequestFactory().post('/api/reservations/')
+        request.user = AnonymousUser()
+        with mock.patch('ApiBillet.serializers.CreationPaiementStripe', side_effect=fake_checkout), \
+                mock.patch('ApiBillet.serializers.check_checkout_expiration'), \
+                mock.patch.object(ProductSold, 'get_id_product_stripe'), \
+                mock.patch.object(PriceSold, 'get_id_price_stripe'):
+            validator = ReservationValidator(data={
+                'email': 'expiration@test.test',
+                'event': f"{self.event.pk}",
+                'options': [],
+                'prices': [{'uuid': f"{self.price.pk}", 'qty': qty}],
+            }, context={'request': request})
+            return validator.is_valid(), validator
+
+    def test_expired_checkout_releases_seats_and_stock(self):
+        from unittest import mock
+        from BaseBillet.models import EventInventory, Paiement_stripe, PriceSold, Configuration
+        from BaseBillet.tasks import check_checkout_expiration
+        from root_billet.models import RootConfiguration
+
+        with tenant_context(self.tenant):
+            valid, validator = self.reserve(3)
+            self.assertTrue(valid, validator.errors)
+            self.assertEqual(EventInventory.objects.get(event=self.event).held, 3)
+            self.assertEqual(PriceSold.stocks_available([self.price], event=self.event)[self.price.pk], 2)
+
+            # Plus assez de stock sur le tarif : refusé, et les places tenues sont rendues
+            valid, validator = self.reserve(3)
+            self.assertFalse(valid)
+            self.assertEqual(EventInventory.objects.get(event=self.event).held, 3)
+
+            # Stripe renvoie une session expirée toujours en "unpaid"
+            expired = mock.Mock(payment_status="unpaid", status="expired",
+                                expires_at=timezone.now().timestamp() - 10)
+            paiement = Paiement_stripe.objects.get(checkout_session_id_stripe="cs_test_expiration")
+            with mock.patch('stripe.checkout.Session.retrieve', return_value=expired), \
+                    mock.patch.object(RootConfiguration, 'get_stripe_api', return_value='sk_test'), \
+                    mock.patch.object(Configuration, 'get_stripe_connect_account', return_value='acct_test'):
+                check_checkout_expiration(f"{paiement.uuid}")
+                # Rejouer la tâche ne rend rien de plus
+                check_checkout_expiration(f"{paiement.uuid}")
+
+            paiement.refresh_from_db()
+            self.assertEqual(paiement.status, Paiement_stripe.EXPIRE)
+            self.assertEqual(EventInventory.objects.get(event=self.event).held, 0)
+            self.assertEqual(PriceSold.stocks_available([self.price], event=self.event)[self.price.pk], 5)
+
+    def test_price_change_keeps_stock_limit(self):
+        from BaseBillet.models import PriceSold
+
+        with tenant_context(self.tenant):
+            valid, validator = self.reserve(3)
+            self.assertTrue(valid, validator.errors)
+
+            # Un changement de prix crée un nouveau PriceSold : le stock reste compté sur le tarif
+            self.price.prix = 12
+            self.price.save()
+            valid, validator = self.reserve(3)
+            self.assertFalse(valid)
+            valid, validator = self.reserve(2)
+            self.assertTrue(valid, validator.errors)
+
+            self.assertEqual(PriceSold.objects.filter(price=self.price).count(), 2)
+            self.assertEqual(PriceSold.stocks_available([self.price], event=self.event)[self.price.pk], 0)
+
+
+class TicketScanSyncTest(TransactionTestCase):
+    # Synchronisation des scanners de porte : lots rejoués, scans concurrents, codes inconnus.
+
+    def setUp(self):
+        from Customers.models import Client
+        from BaseBillet.models import Event, Product, Price, ProductSold, PriceSold, Reservation, Ticket
+        with schema_context('public'):
+            call_command('install')
+            self.tenant = Client.objects.filter(categorie=Client.SALLE_SPECTACLE).first()
+        with tenant_context(self.tenant):
+            self.event = Event.objects.create(
+                name="Scan porte",
+                datetime=timezone.now() + timedelta(hours=2),
+                jauge_max=10,
+            )
+            product = Product.objects.create(name="Billet scan", categorie_article=Product.BILLET)
+            price = Price.objects.create(product=product, name="Plein tarif", prix=10)
+            pricesold = PriceSold.objects.create(
+                productsold=ProductSold.objects.create(product=product, event=self.event),
+                price=price, prix=10)
+            user = get_or_create_user(email="scan@test.test", send_mail=False)
+            reservation = Reservation.objects.create(user_commande=user, event=self.event)
+            self.tickets = [Ticket.objects.create(
+                first_name="Scan", last_name=f"{i}", reservation=reservation, pricesold=pricesold,
+                status=Ticket.NOT_SCANNED,
+            ) for i in range(2)]
+
+    def scan(self, code, device, minutes=0):
+        from uuid import uuid4
+        return {'uuid': uuid4(), 'code': f"{code}", 'device': device,
+                'scanned_at': timezone.now() + timedelta(minutes=minutes)}
+
+    def scanned_count(self):
+        from BaseBillet.models import EventInventory
+        return EventInventory.objects.get(event=self.event).scanned
+
+    def test_replayed_batch_is_not_counted_twice(self):
+        from BaseBillet.models import TicketScan, Ticket
+        with tenant_context(self.tenant):
+            # QR code (uuid) et code barre (scan_code)
+            batch = [self.scan(self.tickets[0].pk, 'porte-1'), self.scan(self.tickets[1].scan_code, 'porte-1')]
+            results = TicketScan.sync(self.event, batch)
+            self.assertEqual([result['result'] for result in results], [TicketScan.ACCEPTED] * 2)
+            self.assertEqual(self.scanned_count(), 2)
+
+            # Réseau coupé, le scanner renvoie le même lot : même réponse, rien de compté en plus
+            self.assertEqual(TicketScan.sync(self.event, batch), results)
+            self.assertEqual(self.scanned_count(), 2)
+            self.assertEqual(TicketScan.objects.filter(event=self.event).count(), 2)
+            self.assertEqual(Ticket.objects.filter(status=Ticket.SCANNED).count(), 2)
+
+    def test_same_ticket_scanned_by_two_devices(self):
+        from BaseBillet.models import TicketScan
+        with tenant_context(self.tenant):
+            ticket = self.tickets[0]
+            first = TicketScan.sync(self.event, [self.scan(ticket.pk, 'porte-1')])
+            self.assertEqual(first[0]['result'], TicketScan.ACCEPTED)
+
+            # Deuxième porte, hors ligne au moment du premier scan
+            second = TicketScan.sync(self.event, [self.scan(ticket.scan_code, 'porte-2', minutes=1)])
+            self.assertEqual(second[0]['result'], TicketScan.CONFLICT)
+            self.assertEqual(second[0]['first_scan']['device'], 'porte-1')
+
+            # Dans un même lot : le premier scan dans le temps gagne
+            ticket = self.tickets[1]
+            results = TicketScan.sync(self.event, [
+                self.scan(ticket.pk, 'porte-2', minutes=2),
+                self.scan(ticket.pk, 'porte-1', minutes=1),
+            ])
+            self.assertEqual([result['result'] for result in results], [TicketScan.CONFLICT, TicketScan.ACCEPTED])
+            self.assertEqual(results[0]['first_scan']['device'], 'porte-1')
+            self.assertEqual(self.scanned_count(), 2)
+
+    def test_unknown_scan_code(self):
+        from uuid import uuid4
+        from BaseBillet.models import TicketScan
+        with tenant_context(self.tenant):
+            results = TicketScan.sync(self.event, [self.scan('INCONNU', 'porte-1'), self.scan(uuid4(), 'porte-1')])
+            self.assertEqual([result['result'] for result in results], [TicketScan.UNKNOWN] * 2)
+            self.assertFalse(TicketScan.objects.filter(ticket__isnull=False).exists())
+            self.assertEqual(self.scanned_count(), 0)
@@ -12,7 +12,7 @@ from AuthBillet.serializers import MembershipSerializer
 from BaseBillet.models import LigneArticle, Product, Membership, Price, Configuration, Paiement_stripe, PriceSold
 from BaseBillet.tasks import send_to_ghost, send_email_generique, create_invoice_pdf, celery_post_request
 from BaseBillet.templatetags.tibitags import dround
-from fedow_connect.fedow_api import FedowAPI
+from fedow_connect.fedow_api import get_fedow_api
 from fedow_connect.models import FedowConfig
 from root_billet.models import RootConfiguration
 
@@ -161,6 +161,17 @@ def send_sale_from_membership_to_laboutik(membership: Membership):
                     send_sale_to_laboutik(ligne_article)
 
 
+def send_all_membership_sales_to_laboutik(tenant=None):
+    """
+    Sur toute l'instance, en parallèle :
+    ./manage.py for_each_tenant BaseBillet.triggers.send_all_membership_sales_to_laboutik
+    """
+    memberships = Membership.objects.filter(stripe_paiement__isnull=False).distinct()
+    for membership in memberships:
+        send_sale_from_membership_to_laboutik(membership)
+    return memberships.count()
+
+
 ### END SEND TO LABOUTIK
 
 class ActionArticlePaidByCategorie:
@@ -229,7 +240,7 @@ class ActionArticlePaidByCategorie:
         logger.info(f"TRIGGER ADHESION PAID -> envoi à Fedow")
         # L'adhésion possède désormais une transaction fedow associé
         # Attention, réalise membership.save()
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         serialized_transaction = fedowAPI.membership.create(membership=membership)
 
         logger.info(f"TRIGGER ADHESION PAID -> envoi à LaBoutik")
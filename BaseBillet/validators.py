@@ -1,6 +1,7 @@
 import os
 
 import stripe
+from django.conf import settings
 from django.db import connection
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
@@ -11,9 +12,10 @@ from ApiBillet.serializers import get_or_create_price_sold
 from AuthBillet.models import TibilletUser
 from AuthBillet.utils import get_or_create_user
 from BaseBillet.models import Price, Product, OptionGenerale, Membership, Paiement_stripe, LigneArticle
+from BaseBillet.tasks import check_checkout_expiration
 from Customers.models import Client, Domain
 from MetaBillet.models import WaitingConfiguration
-from PaiementStripe.views import CreationPaiementStripe
+from PaiementStripe.views import CreationPaiementStripe, CHECKOUT_EXPIRATION_MARGIN
 from root_billet.models import RootConfiguration
 
 
@@ -72,9 +74,11 @@ class MembershipValidator(serializers.Serializer):
         }
 
         ligne_article_adhesion = LigneArticle.objects.create(
-            pricesold=get_or_create_price_sold(price),
+            pricesold=self.pricesold,
             qty=1,
+            stock_held=1 if self.stock_held else 0,
         )
+        self.ligne_article_adhesion = ligne_article_adhesion
 
         # Création de l'objet paiement stripe en base de donnée
         new_paiement_stripe = CreationPaiementStripe(
@@ -95,6 +99,13 @@ class MembershipValidator(serializers.Serializer):
         paiement_stripe: Paiement_stripe = new_paiement_stripe.paiement_stripe_db
         paiement_stripe.lignearticles.all().update(status=LigneArticle.UNPAID)
 
+        # Le stock du tarif est tenu : si personne ne revient de Stripe, on le rend à l'expiration
+        if self.stock_held:
+            check_checkout_expiration.apply_async(
+                (f"{paiement_stripe.uuid}",),
+                countdown=settings.RESERVATION_CHECKOUT_EXPIRATION + 2 * CHECKOUT_EXPIRATION_MARGIN,
+            )
+
         # On ajoute le paiement dans l'objet membership
         membership.stripe_paiement.add(paiement_stripe)
 
@@ -103,6 +114,23 @@ class MembershipValidator(serializers.Serializer):
         return checkout_stripe_url
 
     def validate(self, attrs):
+        # Stock d'un tarif limité tenu avant de créer la fiche membre, rendu si la suite échoue.
+        # Tarif illimité : rien à tenir, l'adhésion est comptée au paiement (ensure_stock).
+        self.pricesold = get_or_create_price_sold(self.price)
+        self.stock_held = self.price.stock is not None
+        if self.stock_held and not self.pricesold.acquire_stock(1):
+            raise serializers.ValidationError(_('Plus de place disponible pour ce tarif'))
+
+        try:
+            return self.create_membership(attrs)
+        except Exception:
+            if getattr(self, 'ligne_article_adhesion', None):
+                self.ligne_article_adhesion.release_stock()
+            elif self.stock_held:
+                self.pricesold.release_stock(1)
+            raise
+
+    def create_membership(self, attrs):
         ### CREATION DE LA FICHE MEMBRE
         # Il peut y avoir plusieurs adhésions pour le même user (ex : parent/enfant)
         membership = Membership.objects.create(
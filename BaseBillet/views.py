@@ -10,12 +10,13 @@ from django.contrib import messages
 from django.contrib.auth import logout, login
 from django.contrib.messages import MessageFailure
 from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.utils import timezone
+from datetime import timedelta
 from django.db import connection
 from django.http import HttpResponse, HttpRequest, Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template.response import TemplateResponse
-from django.utils.encoding import force_str, force_bytes
-from django.utils.http import urlsafe_base64_encode
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.http import require_GET
 from django_extensions.templatetags.debugger_tags import ipdb
@@ -39,19 +40,15 @@ from BaseBillet.models import Configuration, Ticket, OptionGenerale, Product, Ev
 from BaseBillet.tasks import create_invoice_pdf
 from BaseBillet.validators import LoginEmailValidator, MembershipValidator, LinkQrCodeValidator, TenantCreateValidator
 from Customers.models import Client, Domain
-from MetaBillet.models import WaitingConfiguration
+from MetaBillet.models import WaitingConfiguration, PlaceDirectory, PublicEventIndex
 from PaiementStripe.views import CreationPaiementStripe
-from fedow_connect.fedow_api import FedowAPI
+from fedow_connect.fedow_api import get_fedow_api, FedowUnavailable
 from fedow_connect.models import FedowConfig
 from root_billet.models import RootConfiguration
 
 logger = logging.getLogger(__name__)
 
 
-def encode_uid(pk):
-    return force_str(urlsafe_base64_encode(force_bytes(pk)))
-
-
 def get_context(request):
     config = Configuration.get_solo()
     logger.debug("request.htmx") if request.htmx else None
@@ -98,7 +95,7 @@ class Ticket_html_view(APIView):
 
         CODE128 = barcode.get_barcode_class("code128")
         buffer_barcode_SVG = BytesIO()
-        bar_secret = encode_uid(f"{ticket.uuid}".split("-")[4])
+        bar_secret = ticket.scan_code
 
         bar = CODE128(f"{bar_secret}")
         options = {
@@ -192,8 +189,14 @@ class ScanQrCode(viewsets.ViewSet):
         if tenant.categorie != Client.SALLE_SPECTACLE:
             tenant = Client.objects.filter(categorie=Client.SALLE_SPECTACLE).first()
         with tenant_context(tenant):
-            fedowAPI = FedowAPI()
-            serialized_qrcode_card = fedowAPI.NFCcard.qr_retrieve(qrcode_uuid)
+            fedowAPI = get_fedow_api()
+            try:
+                serialized_qrcode_card = fedowAPI.NFCcard.qr_retrieve(qrcode_uuid)
+            except FedowUnavailable as e:
+                logger.error(f"ScanQrCode {qrcode_uuid} : {e}")
+                messages.add_message(request, messages.WARNING,
+                                     _("Card service temporarily unavailable, please scan your card again in a few minutes."))
+                return redirect('home')
             if not serialized_qrcode_card:
                 raise Http404("Unknow qrcode_uuid")
 
@@ -267,7 +270,7 @@ class ScanQrCode(viewsets.ViewSet):
             user.first_name = validator.data.get('firstname')
         user.save()
 
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         wallet, created = fedowAPI.wallet.get_or_create_wallet(user)
         # Si l'user possède déja un wallet et une carte référencée dans Fedow,
 
@@ -365,8 +368,18 @@ class MyAccount(viewsets.ViewSet):
 
     @action(detail=False, methods=['GET'])
     def my_cards(self, request):
-        fedowAPI = FedowAPI()
-        cards = fedowAPI.NFCcard.retrieve_card_by_signature(request.user)
+        fedowAPI = get_fedow_api()
+        cards_cache_key = f"cards_user_{request.user.pk}"
+        try:
+            cards = fedowAPI.NFCcard.retrieve_card_by_signature(request.user)
+            cache.set(cards_cache_key, cards, 3600 * 24)
+        except FedowUnavailable as e:
+            # Mode dégradé : dernière liste de cartes connue
+            logger.warning(f"my_cards : {e}")
+            cards = cache.get(cards_cache_key)
+            if cards is None:
+                return render(request, "htmx/components/fedow_unavailable.html", context={})
+
         context = {
             'cards': cards
         }
@@ -384,7 +397,7 @@ class MyAccount(viewsets.ViewSet):
     @action(detail=True, methods=['GET'])
     def lost_my_card(self, request, pk):
         if request.user.email_valid:
-            fedowAPI = FedowAPI()
+            fedowAPI = get_fedow_api()
             lost_card_report = fedowAPI.NFCcard.lost_my_card_by_signature(request.user, number_printed=pk)
             if lost_card_report:
                 messages.add_message(request, messages.SUCCESS,
@@ -400,7 +413,7 @@ class MyAccount(viewsets.ViewSet):
     @action(detail=False, methods=['GET'])
     def refund_online(self, request):
         user = request.user
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         wallet = fedowAPI.wallet.cached_retrieve_by_signature(user).validated_data
         token_fed = [token for token in wallet.get('tokens') if token['asset']['is_stripe_primary'] == True]
         if len(token_fed) != 1 :
@@ -417,8 +430,6 @@ class MyAccount(viewsets.ViewSet):
         #TODO: Mettre ça dans retour depuis un lien envoyé par email :
         status_code, result = fedowAPI.wallet.refund_fed_by_signature(user)
         if status_code == 202 :
-            # On clear le cache du wallet
-            cache.delete(f"wallet_user_{user.wallet.uuid}")
             messages.add_message(request, messages.INFO,
                                  _("Un email vous a été envoyé pour finaliser votre remboursement. Merci de regarder dans vos spams si vous ne l'avez pas reçu !"))
             return HttpResponseClientRedirect('/my_account/')
@@ -430,33 +441,19 @@ class MyAccount(viewsets.ViewSet):
 
     @staticmethod
     def get_place_cached_info(place_uuid):
-        # Recherche des infos dans le cache :
-        place_info = cache.get(f"place_uuid")
-        if place_info:
-            logger.info("place info from cache GET")
-            return place_info.get(place_uuid)
-        else:
-            # Va chercher dans toute les configs de tous les tenants de l'instance
-            place_info = {}
-            for tenant in Client.objects.filter(categorie=Client.SALLE_SPECTACLE):
-                with tenant_context(tenant):
-                    fedow_config = FedowConfig.get_solo()
-                    this_place_uuid = fedow_config.fedow_place_uuid
-                    config = Configuration.get_solo()
-                    place_info[this_place_uuid] = {
-                        'organisation': config.organisation,
-                        'logo': config.logo,
-                    }
-
-            logger.info("place info to cache SET")
-            cache.set(f"place_uuid", place_info, 3600)
-        return place_info.get(place_uuid)
+        # Annuaire public des lieux, maintenu par signaux : une requête indexée au pire, aucun changement de schéma.
+        return PlaceDirectory.get_place_info(place_uuid) or {}
 
     @action(detail=False, methods=['GET'])
     def tokens_table(self, request):
         config = Configuration.get_solo()
-        fedowAPI = FedowAPI()
-        wallet = fedowAPI.wallet.cached_retrieve_by_signature(request.user).validated_data
+        fedowAPI = get_fedow_api()
+        try:
+            # Si Fedow ne répond pas, le cache sert le dernier wallet connu
+            wallet = fedowAPI.wallet.cached_retrieve_by_signature(request.user).validated_data
+        except FedowUnavailable as e:
+            logger.warning(f"tokens_table : {e}")
+            return render(request, "htmx/components/fedow_unavailable.html", context={})
 
         # On retire les adhésions, on les affiche dans l'autre table
         tokens = [token for token in wallet.get('tokens') if token.get('asset_category') not in ['SUB', 'BDG']]
@@ -489,11 +486,15 @@ class MyAccount(viewsets.ViewSet):
     @action(detail=False, methods=['GET'])
     def transactions_table(self, request):
         config = Configuration.get_solo()
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         # On utilise ici .data plutot que validated_data pour executer les to_representation (celui du WalletSerializer)
         # et les serializer.methodtruc
-        paginated_list_by_wallet_signature = fedowAPI.transaction.paginated_list_by_wallet_signature(
-            request.user).validated_data
+        try:
+            paginated_list_by_wallet_signature = fedowAPI.transaction.paginated_list_by_wallet_signature(
+                request.user).validated_data
+        except FedowUnavailable as e:
+            logger.warning(f"transactions_table : {e}")
+            return render(request, "htmx/components/fedow_unavailable.html", context={})
 
         transactions = paginated_list_by_wallet_signature.get('results')
         next_url = paginated_list_by_wallet_signature.get('next')
@@ -516,8 +517,13 @@ class MyAccount(viewsets.ViewSet):
     @action(detail=False, methods=['GET'])
     def membership_table(self, request):
         config = Configuration.get_solo()
-        fedowAPI = FedowAPI()
-        wallet = fedowAPI.wallet.cached_retrieve_by_signature(request.user).validated_data
+        fedowAPI = get_fedow_api()
+        try:
+            # Si Fedow ne répond pas, le cache sert le dernier wallet connu
+            wallet = fedowAPI.wallet.cached_retrieve_by_signature(request.user).validated_data
+        except FedowUnavailable as e:
+            logger.warning(f"membership_table : {e}")
+            return render(request, "htmx/components/fedow_unavailable.html", context={})
         # On ne garde que les adhésions
         tokens = [token for token in wallet.get('tokens') if token.get('asset_category') == 'SUB']
 
@@ -553,7 +559,7 @@ class MyAccount(viewsets.ViewSet):
     @action(detail=False, methods=['GET'])
     def refill_wallet(self, request):
         user = request.user
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         # C'est fedow qui génère la demande de paiement à Stripe.
         # Il ajoute dans les metadonnée les infos du wallet, et le signe.
         # Lors du retour du paiement, la signature est vérifiée pour être sur que la demande de paiement vient bien de Fedow.
@@ -572,7 +578,7 @@ class MyAccount(viewsets.ViewSet):
         # Fedow vérifie la signature du paiement dans les metada Stripe
         # C'est Fedow entré le metadata signé, c'est lui qui vérifie.
         user = request.user
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
 
         try:
             wallet = fedowAPI.wallet.retrieve_from_refill_checkout(user, pk)
@@ -598,7 +604,16 @@ def home(request):
 @require_GET
 def agenda(request):
     template_context = get_context(request)
-    template_context['events'] = Event.objects.all()
+    if connection.tenant.categorie == Client.META:
+        # Agenda fédéré : index public des évènements de tous les lieux, une requête paginée
+        indexed_events = PublicEventIndex.objects.filter(
+            place__categorie__in=PublicEventIndex.INDEXED_PLACES,
+            datetime__gte=timezone.now() - timedelta(hours=4),
+        ).order_by('datetime')
+        template_context['indexed_events'] = Paginator(indexed_events, 30).get_page(request.GET.get('page'))
+        return render(request, "htmx/views/home.html", context=template_context)
+
+    template_context['events'] = Event.objects.with_counters().prefetch_related('products', 'artists')
     return render(request, "htmx/views/home.html", context=template_context)
 
 
@@ -652,9 +667,17 @@ class Badge(viewsets.ViewSet):
     def badge_in(self, request: HttpRequest, pk):
         product = get_object_or_404(Product, uuid=pk)
         user = request.user
-        fedowAPI = FedowAPI()
-        transaction = fedowAPI.badge.badge_in(user, product)
-        
+        fedowAPI = get_fedow_api()
+        try:
+            transaction = fedowAPI.badge.badge_in(user, product)
+        except FedowUnavailable as e:
+            logger.error(f"badge_in : {e}")
+            return JsonResponse({
+                'icon': 'error',
+                'swal_title': _('Unavailable'),
+                'swal_message': _('The badge service is temporarily unavailable. Please try again in a few minutes.'),
+            })
+
         return JsonResponse({
             'icon': 'success',
             'swal_title': _('Badged !'),
@@ -665,7 +688,7 @@ class Badge(viewsets.ViewSet):
     @action(detail=False, methods=['GET'])
     def check_out(self, request: HttpRequest):
         template_context = get_context(request)
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         messages.add_message(request, messages.WARNING, _(f"Check OUT OK"))
         return HttpResponseClientRedirect(request.headers['Referer'])
 
@@ -0,0 +1,133 @@
+"""
+File d'attente virtuelle des mises en vente (Event.waiting_room).
+
+Quand la file est active, ReservationValidator exige un jeton d'admission :
+- join : on prend un numéro (HINCRBY dans Redis) et on reçoit un jeton de place signé.
+- status : polling léger, uniquement Redis + signature, pas de requête Postgres.
+  La file avance au débit de l'évènement (Event.waiting_room_rate admissions par minute).
+  Quand notre numéro est passé, on reçoit un jeton d'admission signé et limité dans le temps.
+
+Le jeton d'admission porte le numéro de la place et il est à usage unique : la réservation le consomme
+dans Redis (SET NX), il est rendu si elle est refusée. Un jeton partagé ne sert donc qu'une fois.
+"""
+
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PLACE_SALT = 'waiting_room_place'
+ADMISSION_SALT = 'waiting_room_admission'
+
+_redis = None
+_redis_lock = threading.Lock()
+
+# Fait avancer la file au débit demandé, sans jamais admettre plus de monde qu'il n'y en a dans la file :
+# une file restée vide ne stocke pas d'admissions pour le prochain pic.
+# KEYS[1] : hash de la file / ARGV : now, admissions par seconde, incrément de la file (0 ou 1), ttl
+ADVANCE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or ARGV[1])
+local admitted = tonumber(redis.call('HGET', KEYS[1], 'admitted') or '0')
+local last = tonumber(redis.call('HGET', KEYS[1], 'last') or '0')
+admitted = math.min(admitted + math.max(now - updated, 0) * tonumber(ARGV[2]), last)
+last = last + tonumber(ARGV[3])
+redis.call('HSET', KEYS[1], 'updated', ARGV[1], 'admitted', tostring(admitted), 'last', last)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {math.floor(admitted), last}
+"""
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                _redis = redis.Redis.from_url(
+                    settings.WAITING_ROOM_REDIS_URL,
+                    socket_timeout=0.5,
+                    socket_connect_timeout=0.5,
+                )
+    return _redis
+
+
+def _queue_key(event_uuid):
+    return f"tibillet:waiting_room:{connection.schema_name}:{event_uuid}"
+
+
+def _advance(event_uuid, rate: int, join=False):
+    admitted, last = _get_redis().eval(
+        ADVANCE_SCRIPT, 1, _queue_key(event_uuid),
+        time.time(), rate / 60, int(join), settings.WAITING_ROOM_PLACE_MAX_AGE,
+    )
+    return int(admitted), int(last)
+
+
+def _status(event_uuid, position: int, admitted: int, rate: int) -> dict:
+    ahead = max(position - admitted, 0)
+    data = {
+        'position': position,
+        'ahead': ahead,
+        'wait': int(ahead * 60 / rate),
+        # Fréquence de polling conseillée : plus on est loin, moins on demande
+        'retry_after': min(max(2, int(ahead * 30 / rate)), 30),
+        'admission': None,
+    }
+    if not ahead:
+        # Le même numéro à chaque polling : une place ne donne qu'une admission
+        data['admission'] = signing.dumps(
+            {'schema': connection.schema_name, 'event': f"{event_uuid}", 'position': position}, salt=ADMISSION_SALT)
+    return data
+
+
+def join(event) -> dict:
+    rate = event.waiting_room_rate
+    admitted, position = _advance(event.uuid, rate, join=True)
+    # Le débit est gardé avec la place : le polling n'a pas besoin de relire l'évènement
+    place = signing.dumps(
+        {'schema': connection.schema_name, 'event': f"{event.uuid}", 'position': position, 'rate': rate},
+        salt=PLACE_SALT)
+    return {'place': place, **_status(event.uuid, position, admitted, rate)}
+
+
+def status(event_uuid, place: str) -> dict:
+    # Exception signing.BadSignature si le jeton de place est invalide, expiré ou pour un autre évènement
+    data = signing.loads(place, salt=PLACE_SALT, max_age=settings.WAITING_ROOM_PLACE_MAX_AGE)
+    if data['schema'] != connection.schema_name or data['event'] != f"{event_uuid}":
+        raise signing.BadSignature("Place pour un autre évènement")
+    admitted, last = _advance(event_uuid, data['rate'])
+    return {'place': place, **_status(event_uuid, data['position'], admitted, data['rate'])}
+
+
+def _admission_key(event_uuid, position):
+    return f"{_queue_key(event_uuid)}:admission:{position}"
+
+
+def check_admission(event, token: str):
+    # Numéro de place admise si le jeton est valide pour cet évènement, None sinon
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=ADMISSION_SALT, max_age=settings.WAITING_ROOM_ADMISSION_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if data['schema'] != connection.schema_name or data['event'] != f"{event.uuid}" or 'position' not in data:
+        return None
+    return data['position']
+
+
+def consume_admission(event, position) -> bool:
+    # Le premier qui présente le jeton le consomme, jusqu'à son expiration
+    return bool(_get_redis().set(
+        _admission_key(event.uuid, position), 1, nx=True, ex=settings.WAITING_ROOM_ADMISSION_MAX_AGE))
+
+
+def release_admission(event, position):
+    # Réservation refusée (formulaire invalide, plus de place) : le jeton peut resservir
+    _get_redis().delete(_admission_key(event.uuid, position))
@@ -0,0 +1,111 @@
+"""
+Agrégats en lecture seule sur tous les schémas tenant, en une seule requête.
+
+Plutôt que de boucler sur tenant_context (un aller-retour par tenant), on compile
+le queryset une fois, on préfixe les tables tenant par le schéma, et on colle
+les schémas ensemble avec UNION ALL. Chaque ligne est étiquetée par schema_name.
+
+Exemple :
+    rows = cross_schema_aggregate(
+        Ticket.objects.filter(status__in=[Ticket.NOT_SCANNED, Ticket.SCANNED]),
+        {'tickets': Count('uuid')},
+    )
+    -> [{'schema_name': 'demo', 'tickets': 42}, ...]
+
+Les tables des apps partagées (AuthBillet, MetaBillet, ...) ne sont pas préfixées :
+elles restent résolues par le search_path, donc dans le schéma public.
+"""
+import hashlib
+import logging
+import re
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Value
+
+from Customers.models import Client
+
+logger = logging.getLogger(__name__)
+
+
+def _tenant_tables():
+    tables = set()
+    for model in apps.get_models():
+        if model._meta.app_config.name in settings.TENANT_APPS:
+            tables.add(model._meta.db_table)
+    return tables
+
+
+def _schema_sql(sql, tables, schema_name):
+    # Seules les clauses FROM / JOIN sont préfixées : les colonnes "table"."col"
+    # continuent de pointer sur le nom exposé par le FROM.
+    for table in tables:
+        sql = re.sub(rf'(FROM|JOIN) "{re.escape(table)}"', rf'\1 "{schema_name}"."{table}"', sql)
+    return sql
+
+
+def compile_aggregate(queryset, aggregates: dict, group_by=()):
+    # Renvoie le SQL (non préfixé) et ses paramètres pour un seul schéma
+    queryset = queryset.order_by()
+    if group_by:
+        queryset = queryset.values(*group_by).annotate(**aggregates)
+    else:
+        # Value() n'entre pas dans le GROUP BY : on obtient un agrégat global sur la table.
+        queryset = queryset.annotate(_cross_schema=Value(1)).values('_cross_schema') \
+            .annotate(**aggregates).values(*aggregates)
+
+    query = queryset.query
+    tables = {alias.table_name for alias in query.alias_map.values()} & _tenant_tables()
+    sql, params = query.sql_with_params()
+    return sql, tuple(params), tables
+
+
+def cross_schema_aggregate(queryset, aggregates: dict, group_by=(), tenants=None,
+                           chunk_size=None, cache_timeout=None):
+    """
+    queryset : queryset d'un modèle tenant (filtres compris), construit dans n'importe quel schéma.
+    aggregates : {'nom': Sum(...) / Count(...) ...}
+    group_by : champs de regroupement optionnels, en plus du schéma.
+    tenants : queryset / liste de Client. Par défaut tous les tenants sauf public.
+    """
+    chunk_size = chunk_size or settings.CROSS_SCHEMA_CHUNK_SIZE
+    cache_timeout = settings.CROSS_SCHEMA_CACHE_TIMEOUT if cache_timeout is None else cache_timeout
+
+    if tenants is None:
+        tenants = Client.objects.exclude(schema_name='public')
+    schemas = sorted(tenant.schema_name for tenant in tenants)
+    if not schemas:
+        return []
+
+    sql, params, tables = compile_aggregate(queryset, aggregates, group_by)
+
+    cache_key = None
+    if cache_timeout:
+        digest = hashlib.sha256(f"{sql}{params}{schemas}".encode('utf-8')).hexdigest()
+        cache_key = f"cross_schema_aggregate_{digest}"
+        rows = cache.get(cache_key)
+        if rows is not None:
+            return rows
+
+    rows = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(schemas), chunk_size):
+            chunk = schemas[start:start + chunk_size]
+            union = " UNION ALL ".join(
+                f'SELECT %s AS schema_name, sub.* FROM ({_schema_sql(sql, tables, schema_name)}) AS sub'
+                for schema_name in chunk
+            )
+            union_params = []
+            for schema_name in chunk:
+                union_params += [schema_name, *params]
+
+            cursor.execute(union, union_params)
+            columns = [col[0] for col in cursor.description]
+            rows += [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    logger.debug(f"cross_schema_aggregate : {len(schemas)} schémas, {len(rows)} lignes")
+    if cache_key:
+        cache.set(cache_key, rows, cache_timeout)
+    return rows
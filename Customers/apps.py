@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CustomersConfig(AppConfig):
     name = 'Customers'
+
+    def ready(self):
+        import Customers.signals
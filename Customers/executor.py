@@ -0,0 +1,89 @@
+"""
+Lance une fonction sur chaque tenant en parallèle, pour les scripts de maintenance.
+
+    from Customers.executor import run_per_tenant
+    results = run_per_tenant(ma_fonction, tenants=Client.objects.filter(categorie='S'), workers=8)
+
+ma_fonction(tenant) est appelée dans le tenant_context du tenant.
+- mode 'thread' : chaque thread a sa propre connexion Django (thread local) et son search_path.
+- mode 'process' : fork, la connexion du parent est fermée avant, chaque process ouvre la sienne.
+  La fonction doit être importable (définie au niveau d'un module) pour être picklée.
+
+Une erreur sur un tenant n'arrête pas les autres : elle est capturée dans son TenantResult.
+"""
+import logging
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from typing import NamedTuple, Any
+
+from django.conf import settings
+from django.db import connection, connections
+from django_tenants.utils import tenant_context
+
+from Customers.models import Client
+
+logger = logging.getLogger(__name__)
+
+THREAD, PROCESS = 'thread', 'process'
+
+
+class TenantResult(NamedTuple):
+    schema_name: str
+    ok: bool
+    result: Any
+    error: str
+    duration: float
+
+
+def _run_one(func, tenant_pk):
+    start = time.perf_counter()
+    schema_name = f"{tenant_pk}"
+    try:
+        tenant = Client.objects.get(pk=tenant_pk)
+        schema_name = tenant.schema_name
+        with tenant_context(tenant):
+            result = func(tenant)
+        return TenantResult(schema_name, True, result, None, time.perf_counter() - start)
+    except Exception as e:
+        logger.error(f"run_per_tenant {schema_name} : {e}")
+        return TenantResult(schema_name, False, None, traceback.format_exc(), time.perf_counter() - start)
+    finally:
+        # Thread ou process du pool : on rend la connexion
+        connection.close()
+
+
+def run_per_tenant(func, tenants=None, workers=None, mode=THREAD, progress=None):
+    """
+    func : callable(tenant) -> résultat
+    tenants : queryset / liste de Client. Par défaut tous les tenants sauf public.
+    workers : concurrence max, TENANT_EXECUTOR_WORKERS par défaut.
+    progress : callable(done, total, TenantResult) appelé à chaque tenant terminé.
+    Renvoie la liste des TenantResult, dans l'ordre de fin d'exécution.
+    """
+    if tenants is None:
+        tenants = Client.objects.exclude(schema_name='public')
+    tenant_pks = [tenant.pk for tenant in tenants]
+    total = len(tenant_pks)
+    workers = min(workers or settings.TENANT_EXECUTOR_WORKERS, total) or 1
+
+    if mode == PROCESS:
+        # Un process forké ne doit pas réutiliser la socket postgres du parent
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    elif mode == THREAD:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise Exception(f"run_per_tenant : mode {mode} inconnu")
+
+    results = []
+    with executor:
+        futures = [executor.submit(_run_one, func, tenant_pk) for tenant_pk in tenant_pks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if progress:
+                progress(len(results), total, result)
+
+    return results
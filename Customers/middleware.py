@@ -0,0 +1,9 @@
+from django_tenants.middleware.main import TenantMainMiddleware
+
+from Customers.tenant_cache import get_tenant_from_hostname
+
+
+class CachedTenantMiddleware(TenantMainMiddleware):
+    # Même comportement que TenantMainMiddleware, sans requête Domain à chaque appel.
+    def get_tenant(self, domain_model, hostname):
+        return get_tenant_from_hostname(hostname)
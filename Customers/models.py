@@ -33,5 +33,10 @@ class Client(TenantMixin):
     def __str__(self):
         return f"{self.name} {self.get_categorie_display()}"
 
+    def get_primary_domain(self):
+        # Mis en cache par process, invalidé au save de Client / Domain (Customers.tenant_cache)
+        from Customers.tenant_cache import get_primary_domain
+        return get_primary_domain(self)
+
 class Domain(DomainMixin):
     pass
\ No newline at end of file
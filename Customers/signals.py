@@ -0,0 +1,17 @@
+import logging
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from Customers.models import Client, Domain
+from Customers.tenant_cache import bump_tenant_domain_version
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Client)
+@receiver(post_delete, sender=Client)
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+def invalidate_tenant_domain_cache(sender, instance, **kwargs):
+    bump_tenant_domain_version()
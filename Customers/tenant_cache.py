@@ -0,0 +1,84 @@
+"""
+Cache en mémoire du process : hostname -> tenant, tenant -> domaine principal.
+
+Le middleware et les nombreux appels à get_primary_domain() (Event.url, EventSerializer,
+Ticket.pdf_url, mails, ...) faisaient une requête Domain à chaque fois.
+
+Invalidation : tout save / delete de Client ou Domain change un jeton de version dans le
+cache partagé (Customers.signals). Chaque process compare son jeton avant de servir une entrée.
+Les objets servis sont des copies : le middleware modifie le tenant (domain_url).
+"""
+import copy
+import logging
+import threading
+import time
+from uuid import uuid4
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "tenant_domain_version"
+MAX_AGE = 300  # Au cas où le jeton de version serait évincé du cache
+VERSION_CHECK_INTERVAL = 2  # Secondes entre deux lectures du jeton : 100 évènements sérialisés = 1 lecture
+
+_hostnames = {}
+_primary_domains = {}
+_version_checked = {'at': 0, 'version': None}
+_lock = threading.Lock()
+
+
+def bump_tenant_domain_version():
+    try:
+        cache.set(VERSION_KEY, uuid4().hex, None)
+    except Exception as e:
+        logger.error(f"bump_tenant_domain_version : {e}")
+    # Le process courant n'attend pas le cache partagé
+    with _lock:
+        _hostnames.clear()
+        _primary_domains.clear()
+        _version_checked['at'] = 0
+
+
+def _current_version():
+    now = time.monotonic()
+    if _version_checked['at'] + VERSION_CHECK_INTERVAL > now:
+        return _version_checked['version']
+    try:
+        version = cache.get(VERSION_KEY)
+    except Exception:
+        return None
+    _version_checked['at'], _version_checked['version'] = now, version
+    return version
+
+
+def _cached(store, key, loader):
+    version = _current_version()
+    entry = store.get(key)
+    if entry and version is not None:
+        stored_version, built_at, obj = entry
+        if stored_version == version and built_at + MAX_AGE > time.monotonic():
+            return copy.copy(obj)
+
+    obj = loader()
+    if version is None:
+        # Pas de jeton (cache vide ou injoignable) : on en pose un pour les prochains appels
+        bump_tenant_domain_version()
+        version = _current_version()
+    with _lock:
+        store[key] = (version, time.monotonic(), obj)
+    return copy.copy(obj)
+
+
+def get_tenant_from_hostname(hostname):
+    # Lève Domain.DoesNotExist comme la requête d'origine du middleware
+    from Customers.models import Domain
+    return _cached(_hostnames, hostname,
+                   lambda: Domain.objects.select_related('tenant').get(domain=hostname).tenant)
+
+
+def get_primary_domain(tenant):
+    # Domain ou None, comme TenantMixin.get_primary_domain
+    from Customers.models import Domain
+    return _cached(_primary_domains, tenant.pk,
+                   lambda: Domain.objects.filter(tenant_id=tenant.pk, is_primary=True).first())
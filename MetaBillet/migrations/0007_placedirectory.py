@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Customers', '0002_alter_client_categorie'),
+        ('MetaBillet', '0006_waitingconfiguration_dns_choice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlaceDirectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fedow_place_uuid', models.UUIDField(blank=True, null=True, unique=True)),
+                ('organisation', models.CharField(blank=True, max_length=50, null=True)),
+                ('domain', models.CharField(blank=True, max_length=253, null=True)),
+                ('logo_variations', models.JSONField(blank=True, default=dict)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('place', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='place_directory', to='Customers.client')),
+            ],
+            options={
+                'verbose_name': 'Annuaire des lieux',
+                'verbose_name_plural': 'Annuaire des lieux',
+            },
+        ),
+    ]
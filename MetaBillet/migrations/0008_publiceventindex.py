@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:15
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Customers', '0002_alter_client_categorie'),
+        ('MetaBillet', '0007_placedirectory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublicEventIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_uuid', models.UUIDField()),
+                ('datetime', models.DateTimeField(db_index=True)),
+                ('name', models.CharField(max_length=200)),
+                ('slug', models.SlugField(blank=True, max_length=250, null=True)),
+                ('categorie', models.CharField(blank=True, max_length=3, null=True)),
+                ('tags', models.JSONField(blank=True, default=list)),
+                ('card', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='indexed_events', to='Customers.client')),
+            ],
+            options={
+                'ordering': ('datetime',),
+                'indexes': [models.Index(fields=['categorie', 'datetime'], name='MetaBillet__categor_2bb439_idx')],
+                'unique_together': {('place', 'event_uuid')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:15
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('MetaBillet', '0008_publiceventindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='placedirectory',
+            name='categorie',
+            field=models.CharField(blank=True, choices=[('A', 'Artiste'), ('S', 'Lieu de spectacle vivant'), ('F', 'Festival'), ('T', 'Tourneur'), ('P', 'Producteur'), ('M', 'Agenda culturel'), ('R', 'Tenant public root')], db_index=True, max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='placedirectory',
+            name='serialized',
+            field=models.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder),
+        ),
+    ]
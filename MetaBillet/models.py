@@ -1,8 +1,17 @@
+import hashlib
+import json
+import logging
+from urllib.parse import urljoin
+
 from django.utils.text import slugify
 from uuid import uuid4
 from django.utils.translation import gettext_lazy as _
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models, connection
+from django_tenants.utils import tenant_context
 
 # Create your models here.
 from solo.models import SingletonModel
@@ -11,6 +20,8 @@ from stdimage.validators import MaxSizeValidator, MinSizeValidator
 
 from Customers.models import Client
 
+logger = logging.getLogger(__name__)
+
 '''
 # Besoin du model de config pour email celery génral
 class Configuration(SingletonModel):
@@ -40,6 +51,236 @@ class ProductDirectory(models.Model):
 
 
 
+# Index public des évènements à venir de tous les lieux.
+# Maintenu par les signaux Event / Price / Product (BaseBillet.signals), reconstruit par
+# ./manage.py rebuild_event_index
+# Les compteurs de la carte suivent les ventes (refresh_live, tâche BaseBillet.tasks.refresh_event_index),
+# la prochaine date des évènements récurrents est rafraîchie chaque jour par ./manage.py generate_occurrences
+# L'agenda fédéré (META) devient une seule requête sur cette table, sans changement de schéma.
+class PublicEventIndex(models.Model):
+    place = models.ForeignKey(Client, on_delete=models.CASCADE, related_name="indexed_events")
+    event_uuid = models.UUIDField()
+    datetime = models.DateTimeField(db_index=True)
+    name = models.CharField(max_length=200)
+    slug = models.SlugField(max_length=250, blank=True, null=True)
+    categorie = models.CharField(max_length=3, blank=True, null=True)
+    tags = models.JSONField(default=list, blank=True)
+    # Sortie de ApiBillet.serializers.EventSerializer, telle que renvoyée par l'api
+    card = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    last_update = models.DateTimeField(auto_now=True)
+
+    # Lieux agrégés par l'agenda fédéré : indexation et lecture filtrent tous deux sur cette liste
+    INDEXED_PLACES = [Client.SALLE_SPECTACLE]
+
+    @classmethod
+    def index_event(cls, event, tenant: Client = None):
+        # A lancer dans le schéma du lieu (signal, commande de rebuild).
+        # event : BaseBillet.Event
+        from ApiBillet.serializers import EventSerializer
+        tenant = tenant or connection.tenant
+        if not isinstance(tenant, Client) or tenant.categorie not in cls.INDEXED_PLACES:
+            return None
+
+        if not event.published:
+            cls.unindex_event(event.uuid, tenant)
+            return None
+
+        card = EventSerializer(event).data
+        next_datetimes = event.next_datetime()
+        return cls.objects.update_or_create(
+            place=tenant,
+            event_uuid=event.uuid,
+            defaults={
+                'datetime': next_datetimes[0] if next_datetimes else event.datetime,
+                'name': event.name,
+                'slug': event.slug,
+                'categorie': event.categorie,
+                'tags': [tag.name for tag in event.tag.all()],
+                'card': card,
+            }
+        )[0]
+
+    # Les compteurs de la carte (places, complet, stocks, prochaine date) bougent à chaque vente :
+    # rafraîchis sans resérialiser l'évènement, au plus EVENT_INDEX_REFRESH_DELAY secondes après le changement.
+    @classmethod
+    def refresh_key(cls, schema_name, event_uuid):
+        return f"event_index_refresh_{schema_name}_{event_uuid}"
+
+    @classmethod
+    def schedule_refresh(cls, event_uuid):
+        # Une seule tâche par évènement sur la période, quelque soit le nombre de ventes
+        tenant = connection.tenant
+        if not event_uuid or not isinstance(tenant, Client) or tenant.categorie not in cls.INDEXED_PLACES:
+            return
+        delay = settings.EVENT_INDEX_REFRESH_DELAY
+        try:
+            if not cache.add(cls.refresh_key(tenant.schema_name, event_uuid), 1, delay * 2):
+                return
+            from BaseBillet.tasks import refresh_event_index
+            refresh_event_index.apply_async((f"{event_uuid}",), countdown=delay)
+        except Exception as e:
+            logger.error(f"PublicEventIndex.schedule_refresh {event_uuid} : {e}")
+
+    @classmethod
+    def refresh_live(cls, event, tenant: Client = None):
+        # A lancer dans le schéma du lieu. event : BaseBillet.Event
+        from ApiBillet.serializers import set_event_live_fields
+        tenant = tenant or connection.tenant
+        indexed = cls.objects.filter(place=tenant, event_uuid=event.uuid).first()
+        if not indexed:
+            return None
+
+        next_datetimes = event.next_datetime()
+        indexed.datetime = next_datetimes[0] if next_datetimes else event.datetime
+        indexed.card = set_event_live_fields(indexed.card, event)
+        indexed.save(update_fields=['datetime', 'card', 'last_update'])
+        return indexed
+
+    @classmethod
+    def unindex_event(cls, event_uuid, tenant: Client = None):
+        tenant = tenant or connection.tenant
+        if isinstance(tenant, Client):
+            cls.objects.filter(place=tenant, event_uuid=event_uuid).delete()
+
+    class Meta:
+        unique_together = ('place', 'event_uuid')
+        ordering = ('datetime',)
+        indexes = [
+            models.Index(fields=['categorie', 'datetime']),
+        ]
+
+
+class DomainRequest():
+    # Tient lieu de request pour un serializer hors requête (signal, commande) :
+    # les FileField de DRF renvoient une url absolue sur le domaine du lieu, comme quand l'api passait sa request.
+    def __init__(self, domain):
+        self.domain = domain
+
+    def build_absolute_uri(self, location=None):
+        return urljoin(f"https://{self.domain}/", location or '')
+
+
+# Annuaire public des lieux connus de Fedow.
+# Une ligne par tenant, maintenue par les signaux post_save de Configuration et FedowConfig (BaseBillet.signals).
+# Permet de retrouver nom, logo et domaine d'un lieu à partir de son uuid Fedow sans changer de schéma.
+class PlaceDirectory(models.Model):
+    place = models.OneToOneField(Client, on_delete=models.CASCADE, related_name="place_directory")
+    fedow_place_uuid = models.UUIDField(blank=True, null=True, unique=True)
+    organisation = models.CharField(max_length=50, blank=True, null=True)
+    domain = models.CharField(max_length=253, blank=True, null=True)
+    logo_variations = models.JSONField(default=dict, blank=True)
+    categorie = models.CharField(max_length=3, choices=Client.CATEGORIE_CHOICES, blank=True, null=True,
+                                 db_index=True)
+    # Sortie de ConfigurationSerializer (+ uuid du tenant) : ce que renvoie l'api /place et /artist
+    serialized = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    last_update = models.DateTimeField(auto_now=True)
+
+    LISTINGS = {
+        'place': [Client.SALLE_SPECTACLE, Client.FESTIVAL],
+        'artist': [Client.ARTISTE],
+    }
+
+    @classmethod
+    def cache_key(cls, fedow_place_uuid):
+        return f"place_directory_{fedow_place_uuid}"
+
+    @classmethod
+    def listing_cache_key(cls, listing):
+        return f"place_directory_listing_{listing}"
+
+    @staticmethod
+    def make_etag(payload):
+        return f'"{hashlib.md5(json.dumps(payload, cls=DjangoJSONEncoder, sort_keys=True).encode()).hexdigest()}"'
+
+    @classmethod
+    def get_listing(cls, listing):
+        # listing : 'place' ou 'artist'. Renvoie (etag, data).
+        # Une seule requête dans le schéma public, quel que soit le nombre de tenants, puis cache jusqu'au prochain save.
+        key = cls.listing_cache_key(listing)
+        cached = cache.get(key)
+        if cached is None:
+            data = list(cls.objects.filter(
+                categorie__in=cls.LISTINGS[listing],
+            ).exclude(serialized={}).order_by('organisation').values_list('serialized', flat=True))
+            cached = (cls.make_etag(data), data)
+            cache.set(key, cached, 3600)
+        return cached
+
+    @classmethod
+    def get_place_info(cls, fedow_place_uuid):
+        # Lecture mémoïsée : un cache par uuid, sinon une seule requête indexée dans le schéma public.
+        if not fedow_place_uuid:
+            return None
+        key = cls.cache_key(fedow_place_uuid)
+        place_info = cache.get(key)
+        if place_info is None:
+            place_dir = cls.objects.filter(fedow_place_uuid=fedow_place_uuid).first()
+            if not place_dir:
+                return None
+            place_info = {
+                'organisation': place_dir.organisation,
+                'logo': place_dir.logo_variations,
+                'domain': place_dir.domain,
+                'tenant': place_dir.place_id,
+            }
+            cache.set(key, place_info, 3600)
+        return place_info
+
+    @classmethod
+    def presentation_cache_key(cls, tenant_pk):
+        return f"place_directory_presentation_{tenant_pk}"
+
+    @classmethod
+    def get_presentation(cls, tenant: Client):
+        # Sortie de ConfigurationSerializer d'un autre tenant (artiste sur un évènement) sans changer de schéma.
+        key = cls.presentation_cache_key(tenant.pk)
+        presentation = cache.get(key)
+        if presentation is None:
+            presentation = cls.objects.filter(place=tenant).values_list('serialized', flat=True).first()
+            if not presentation:
+                # Pas encore dans l'annuaire : une seule fois, on va le chercher dans son schéma.
+                from BaseBillet.models import Configuration
+                with tenant_context(tenant):
+                    presentation = cls.update_place(tenant, config=Configuration.get_solo()).serialized
+            cache.set(key, presentation, 3600)
+        return presentation
+
+    @classmethod
+    def update_place(cls, tenant: Client, config=None, fedow_config=None):
+        # config : BaseBillet.Configuration, fedow_config : fedow_connect.FedowConfig
+        # Le schéma public est dans le search_path de chaque tenant : pas besoin de schema_context.
+        defaults = {}
+        primary_domain = tenant.get_primary_domain()
+        defaults['domain'] = primary_domain.domain if primary_domain else None
+        if config is not None:
+            from ApiBillet.serializers import ConfigurationSerializer
+            defaults['organisation'] = config.organisation
+            defaults['logo_variations'] = config.logo_variations() or {}
+            serialized = {'uuid': f"{tenant.uuid}"}
+            # map_img et carte_restaurant en url absolue : l'annuaire est lu depuis d'autres domaines
+            context = {'request': DomainRequest(defaults['domain'])} if defaults['domain'] else {}
+            serialized.update(ConfigurationSerializer(config, context=context).data)
+            defaults['serialized'] = serialized
+        defaults['categorie'] = tenant.categorie
+        if fedow_config is not None:
+            defaults['fedow_place_uuid'] = fedow_config.fedow_place_uuid
+
+        old = cls.objects.filter(place=tenant).values_list('fedow_place_uuid', flat=True).first()
+        place_dir, created = cls.objects.update_or_create(place=tenant, defaults=defaults)
+
+        if old:
+            cache.delete(cls.cache_key(old))
+        if place_dir.fedow_place_uuid:
+            cache.delete(cls.cache_key(place_dir.fedow_place_uuid))
+        cache.delete_many([cls.listing_cache_key(listing) for listing in cls.LISTINGS]
+                          + [cls.presentation_cache_key(tenant.pk)])
+        return place_dir
+
+    class Meta:
+        verbose_name = _('Annuaire des lieux')
+        verbose_name_plural = _('Annuaire des lieux')
+
+
 class WaitingConfiguration(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False, unique=True, db_index=False)
     email = models.EmailField()
@@ -1,8 +1,10 @@
 import json
 import logging
+import time
 from decimal import Decimal
 
 import stripe
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import connection
 from django.http import HttpResponseRedirect
@@ -14,6 +16,9 @@ from BaseBillet.models import Configuration, LigneArticle, Paiement_stripe, Rese
 from root_billet.models import RootConfiguration
 
 logger = logging.getLogger(__name__)
+
+# Secondes ajoutées à expires_at, et au délai de vérification de l'expiration (check_checkout_expiration)
+CHECKOUT_EXPIRATION_MARGIN = 60
 User = get_user_model()
 
 
@@ -159,6 +164,13 @@ class CreationPaiementStripe():
             'stripe_account': f'{self.stripe_connect_account}',
         }
 
+        if self.reservation or any(ligne.stock_held for ligne in self.liste_ligne_article):
+            # Les places (ou le stock d'un tarif limité) sont tenues pendant le paiement : la session expire au bout de
+            # RESERVATION_CHECKOUT_EXPIRATION (30 minutes minimum chez Stripe, comptées à la création de la session :
+            # marge de CHECKOUT_EXPIRATION_MARGIN car le timestamp est calculé avant l'appel)
+            data_checkout['expires_at'] = int(time.time()) + settings.RESERVATION_CHECKOUT_EXPIRATION \
+                                          + CHECKOUT_EXPIRATION_MARGIN
+
         return data_checkout
 
     def _checkout_session(self):
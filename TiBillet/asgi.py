@@ -5,17 +5,23 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-from wsocket.routing import websocket_urlpatterns
-# from wsocket.middlewares import WebSocketJWTAuthMiddleware
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'TiBillet.settings')
 
 django_asgi_app = get_asgi_application()
+
+# Après get_asgi_application : les consumers et middlewares importent des modèles
+from wsocket.routing import websocket_urlpatterns
+from wsocket.middlewares import WebSocketJWTAuthMiddleware, WebSocketTenantMiddleware
+
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+            WebSocketTenantMiddleware(
+                AuthMiddlewareStack(
+                    WebSocketJWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+                )
+            )
         ),
     }
 )
@@ -25,6 +25,24 @@ SECRET_KEY = os.environ.get('DJANGO_SECRET')
 FERNET_KEY = os.environ.get('FERNET_KEY')
 
 FEDOW = True
+# Transport HTTP vers Fedow : une session avec pool de connexion keep-alive par process
+FEDOW_POOL_SIZE = int(os.environ.get('FEDOW_POOL_SIZE', 10))
+FEDOW_CONNECT_TIMEOUT = float(os.environ.get('FEDOW_CONNECT_TIMEOUT', 3))
+FEDOW_READ_TIMEOUT = float(os.environ.get('FEDOW_READ_TIMEOUT', 10))
+FEDOW_GET_RETRIES = int(os.environ.get('FEDOW_GET_RETRIES', 2))
+# Disjoncteur Fedow : THRESHOLD échecs en WINDOW secondes -> plus d'appel pendant COOLDOWN secondes
+FEDOW_CIRCUIT_THRESHOLD = int(os.environ.get('FEDOW_CIRCUIT_THRESHOLD', 5))
+FEDOW_CIRCUIT_WINDOW = int(os.environ.get('FEDOW_CIRCUIT_WINDOW', 30))
+FEDOW_CIRCUIT_COOLDOWN = int(os.environ.get('FEDOW_CIRCUIT_COOLDOWN', 30))
+# Cache des wallets : frais pendant FRESH secondes, servi périmé jusqu'à STALE secondes pendant le rafraichissement
+FEDOW_WALLET_CACHE_FRESH = int(os.environ.get('FEDOW_WALLET_CACHE_FRESH', 60))
+FEDOW_WALLET_CACHE_STALE = int(os.environ.get('FEDOW_WALLET_CACHE_STALE', 900))
+FEDOW_WALLET_CACHE_LOCK = int(os.environ.get('FEDOW_WALLET_CACHE_LOCK', 5))
+# Auto vérification des signatures envoyées à Fedow : toujours en DEBUG, échantillonnée sinon (0.0 -> 1.0)
+FEDOW_SIGNATURE_SELF_CHECK_RATE = float(os.environ.get('FEDOW_SIGNATURE_SELF_CHECK_RATE', 0.01))
+# Cache mémoire des clés RSA déchiffrées
+RSA_KEY_CACHE_SIZE = int(os.environ.get('RSA_KEY_CACHE_SIZE', 1024))
+RSA_KEY_CACHE_TTL = int(os.environ.get('RSA_KEY_CACHE_TTL', 900))
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DEBUG') == '1'
 
@@ -144,7 +162,7 @@ CACHES = {
 }
 
 MIDDLEWARE = [
-    'django_tenants.middleware.main.TenantMainMiddleware',
+    'Customers.middleware.CachedTenantMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -301,6 +319,27 @@ CELERY_TASK_TIME_LIMIT = 30 * 60
 BROKER_URL = os.environ.get('CELERY_BROKER', 'redis://redis:6379/0')
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('CELERY_BACKEND', 'redis://redis:6379/0')
+
+# Métriques des appels sortants (root_billet.metrics). Scrape sur /metrics/ avec "Authorization: Bearer METRICS_TOKEN"
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_REDIS_URL = os.environ.get('METRICS_REDIS_URL', os.environ.get('CELERY_BROKER', 'redis://redis:6379/0'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Agrégats multi-schéma (Customers.aggregates) : nombre de schéma par requête UNION ALL, durée du cache en secondes
+CROSS_SCHEMA_CHUNK_SIZE = int(os.environ.get('CROSS_SCHEMA_CHUNK_SIZE', 100))
+CROSS_SCHEMA_CACHE_TIMEOUT = int(os.environ.get('CROSS_SCHEMA_CACHE_TIMEOUT', 300))
+# Durée de vie des sessions Stripe des réservations, places tenues pendant ce temps (1800 minimum chez Stripe)
+RESERVATION_CHECKOUT_EXPIRATION = int(os.environ.get('RESERVATION_CHECKOUT_EXPIRATION', 1800))
+# File d'attente des mises en vente (BaseBillet.waiting_room) : durée de vie des jetons de place et d'admission en secondes
+WAITING_ROOM_REDIS_URL = os.environ.get('WAITING_ROOM_REDIS_URL', os.environ.get('CELERY_BROKER', 'redis://redis:6379/0'))
+WAITING_ROOM_PLACE_MAX_AGE = int(os.environ.get('WAITING_ROOM_PLACE_MAX_AGE', 6 * 3600))
+WAITING_ROOM_ADMISSION_MAX_AGE = int(os.environ.get('WAITING_ROOM_ADMISSION_MAX_AGE', 900))
+# Evènements récurrents : nombre de jours de dates (BaseBillet.EventOccurrence) générées à l'avance
+OCCURRENCE_WINDOW_DAYS = int(os.environ.get('OCCURRENCE_WINDOW_DAYS', 60))
+# Index public des évènements (MetaBillet.PublicEventIndex) : retard maximum des compteurs de la carte en secondes
+EVENT_INDEX_REFRESH_DELAY = int(os.environ.get('EVENT_INDEX_REFRESH_DELAY', 30))
+# Exécution parallèle par tenant (Customers.executor) : nombre de worker par défaut
+TENANT_EXECUTOR_WORKERS = int(os.environ.get('TENANT_EXECUTOR_WORKERS', 4))
 # DJANGO_CELERY_BEAT_TZ_AWARE=False
 
 # CHANNELS
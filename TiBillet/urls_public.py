@@ -5,6 +5,7 @@ from Administration.admin_public import public_admin_site
 # on modifie la creation du token pour rajouter access_token dans la réponse pour Postman
 # from AuthBillet.views import TokenCreateView_custom
 from ApiBillet.views import Webhook_stripe
+from root_billet.views import metrics
 from TiBillet import settings
 
 urlpatterns = [
@@ -16,6 +17,7 @@ urlpatterns = [
 
     path('admin/', public_admin_site.urls, name="public_admin_url"),
     path('api/webhook_stripe/', Webhook_stripe.as_view()),
+    path('metrics/', metrics, name="metrics"),
     # re_path(r'^api/user/terminal/(?P<token>[0-9]{6})/$', validate_token_terminal.as_view(), name='validate_token_terminal'),
     # path('api/user/terminal/', create_terminal_user.as_view(), name='create_terminal_user'),
     re_path(r'api/user/', include('AuthBillet.urls')),
@@ -1,10 +1,16 @@
 import json
 import logging
+import os
+import random
+import threading
+import time
 import uuid
 from datetime import datetime
 from uuid import UUID, uuid4
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
@@ -15,21 +21,179 @@ from django_tenants.postgresql_backend.base import FakeTenant
 
 from AuthBillet.models import TibilletUser, Wallet
 from BaseBillet.models import Configuration, Membership, Product
-from fedow_connect.models import FedowConfig
+from fedow_connect.models import FedowConfig, get_cached_for_schema
 from fedow_connect.utils import sign_message, data_to_b64, verify_signature, rsa_decrypt_string
+from root_billet.metrics import measure, INTEGRATION_FEDOW
+from fedow_connect.wallet_cache import get_wallet_cached, invalidate_wallet_cache
 from fedow_connect.validators import WalletValidator, AssetValidator, TransactionValidator, \
-    PaginatedTransactionValidator, CardValidator, QrCardValidator
+    PaginatedTransactionValidator, CardValidator, QrCardValidator, persist_fedow_objects
 
 logger = logging.getLogger(__name__)
 
 
+### TRANSPORT ###
+# Une session requests par process et par domaine fedow.
+# Le pool garde les connexions TCP/TLS ouvertes (keep-alive) entre deux appels :
+# une page "Mon compte" ne refait plus 3 à 5 handshakes TLS.
+# La clé contient le pid : après un fork (gunicorn, celery), chaque process recrée son pool.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class FedowUnavailable(Exception):
+    # Fedow ne répond pas (timeout, connexion refusée, 5xx) ou le disjoncteur est ouvert.
+    # Les vues l'attrapent pour passer en mode dégradé.
+    pass
+
+
+# Timeout de lecture par endpoint (préfixe du path). Les pages "Mon compte" doivent répondre vite,
+# la création d'un lieu ou d'un asset peut prendre plus de temps coté Fedow.
+FEDOW_READ_TIMEOUTS = {
+    'wallet/retrieve_by_signature': 4,
+    'card/retrieve_card_by_signature': 4,
+    'card/': 3,
+    'transaction/paginated_list_by_wallet_signature': 5,
+    'place': 30,
+    'asset/': 15,
+    'transaction/create_membership': 15,
+}
+
+
+def _timeout(path: str = ""):
+    read_timeout = settings.FEDOW_READ_TIMEOUT
+    for prefix, timeout in FEDOW_READ_TIMEOUTS.items():
+        if path.startswith(prefix):
+            read_timeout = timeout
+            break
+    return (settings.FEDOW_CONNECT_TIMEOUT, read_timeout)
+
+
+### DISJONCTEUR ###
+# Partagé entre tous les workers via le cache.
+# Après FEDOW_CIRCUIT_THRESHOLD échecs dans la fenêtre, le circuit s'ouvre FEDOW_CIRCUIT_COOLDOWN secondes :
+# les appels échouent immédiatement au lieu de bloquer un worker gunicorn jusqu'au timeout.
+# A la fin du cooldown, les appels repartent (semi-ouvert) : un nouvel échec rouvre le circuit.
+
+def _circuit_keys(fedow_domain):
+    return f"fedow_circuit_failures_{fedow_domain}", f"fedow_circuit_open_{fedow_domain}"
+
+
+def circuit_is_open(fedow_domain: str) -> bool:
+    failures_key, open_key = _circuit_keys(fedow_domain)
+    try:
+        return bool(cache.get(open_key))
+    except Exception:
+        return False
+
+
+def _circuit_failure(fedow_domain):
+    failures_key, open_key = _circuit_keys(fedow_domain)
+    try:
+        cache.add(failures_key, 0, settings.FEDOW_CIRCUIT_WINDOW)
+        failures = cache.incr(failures_key)
+        if failures >= settings.FEDOW_CIRCUIT_THRESHOLD:
+            logger.error(f"Fedow {fedow_domain} : {failures} échecs, ouverture du disjoncteur "
+                         f"pour {settings.FEDOW_CIRCUIT_COOLDOWN}s")
+            cache.set(open_key, True, settings.FEDOW_CIRCUIT_COOLDOWN)
+            cache.delete(failures_key)
+    except Exception as e:
+        logger.warning(f"_circuit_failure cache error : {e}")
+
+
+def _circuit_success(fedow_domain):
+    failures_key, open_key = _circuit_keys(fedow_domain)
+    try:
+        cache.delete(failures_key)
+    except Exception as e:
+        logger.warning(f"_circuit_success cache error : {e}")
+
+
+def _send(method: str, fedow_domain: str, path: str, **kwargs):
+    if circuit_is_open(fedow_domain):
+        raise FedowUnavailable(f"Fedow {fedow_domain} circuit open")
+
+    session = get_fedow_session(fedow_domain)
+    try:
+        with measure(INTEGRATION_FEDOW, path) as metric:
+            response = session.request(
+                method,
+                f"https://{fedow_domain}/{path}/",
+                timeout=_timeout(path),
+                **kwargs,
+            )
+            metric['status'] = response.status_code
+            metric['retries'] = len(response.raw.retries.history) if response.raw.retries else 0
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        logger.error(f"Fedow {method} {path} : {type(e).__name__} {e}")
+        _circuit_failure(fedow_domain)
+        raise FedowUnavailable(f"Fedow {method} {path} : {type(e).__name__}")
+
+    if response.status_code >= 500:
+        logger.error(f"Fedow {method} {path} : {response.status_code}")
+        _circuit_failure(fedow_domain)
+        raise FedowUnavailable(f"Fedow {method} {path} : {response.status_code}")
+
+    _circuit_success(fedow_domain)
+    return response
+
+
+def get_fedow_session(fedow_domain: str) -> requests.Session:
+    key = (os.getpid(), fedow_domain)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # On ne rejoue que les GET (idempotents). Un POST peut avoir été traité par Fedow
+            # même si la réponse n'est jamais arrivée.
+            retry = Retry(
+                total=settings.FEDOW_GET_RETRIES,
+                connect=settings.FEDOW_GET_RETRIES,
+                read=settings.FEDOW_GET_RETRIES,
+                status=0,
+                backoff_factor=0.2,
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.FEDOW_POOL_SIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount(f"https://{fedow_domain}/", adapter)
+            session.verify = bool(not settings.DEBUG)
+            _sessions[key] = session
+            logger.info(f"Nouvelle session fedow pour {fedow_domain} (pid {os.getpid()})")
+    return session
+
+
+def close_fedow_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _self_verify_signature():
+    # L'auto vérification recharge la clé publique et refait un calcul RSA.
+    # Toujours en DEBUG, sur un échantillon en prod.
+    if settings.DEBUG:
+        return True
+    return random.random() < settings.FEDOW_SIGNATURE_SELF_CHECK_RATE
+
+
 ### GENERIC GET AND POST ###
 def _post(fedow_config: FedowConfig = None,
           user: TibilletUser = None,
           data: dict = None,
           path: str = None,
           apikey: str = None):
-    fedow_domain = fedow_config.fedow_domain()
+    # Domaine et clé du lieu déja résolus : ni requête sur le schéma public, ni déchiffrement
+    profile = fedow_config.profile()
+    fedow_domain = profile.domain
     now = f"{datetime.now().isoformat()}"
 
     # Pour la création, on prend la clé api de Root. On rempli apikey
@@ -37,7 +201,7 @@ def _post(fedow_config: FedowConfig = None,
     if apikey is None:
         # Pour la création, on prend la clé api de Root. apikey est donné en arguement.
         # Si vide, on prend la clé du lieu du tenant
-        apikey = fedow_config.get_fedow_place_admin_apikey()
+        apikey = profile.apikey
     headers = {
         "Date": f"{now}",
         'Authorization': f'Api-Key {apikey}',
@@ -55,27 +219,26 @@ def _post(fedow_config: FedowConfig = None,
         # Ici, on s'autovérifie :
         # Assert volontaire. Si non effectué en prod, ce n'est pas grave.
         # logger.debug("_post verify_signature start")
-        if not verify_signature(user.get_public_key(),
-                                data_to_b64(data),
-                                signature):
-            raise Exception("Signature auto verification failed")
+        if _self_verify_signature():
+            if not verify_signature(user.get_public_key(),
+                                    data_to_b64(data),
+                                    signature):
+                raise Exception("Signature auto verification failed")
 
         headers.update({
             "Wallet": f"{user.wallet.uuid}" if user.wallet else "",
             "Signature": f"{signature}",
         })
 
-    session = requests.Session()
-    request_fedow = session.post(
-        f"https://{fedow_domain}/{path}/",
+    request_fedow = _send(
+        'POST',
+        fedow_domain,
+        path,
         headers=headers,
         data=json.dumps(data),
-        verify=bool(not settings.DEBUG),
     )
 
     # TODO: Vérifier la signature de FEDOW avec root_config.fedow_primary_pub_pem
-
-    session.close()
     return request_fedow
 
 
@@ -83,13 +246,14 @@ def _get(fedow_config: FedowConfig = None,
          user: TibilletUser = None,
          path: str = None,
          apikey: str = None):
-    fedow_domain = fedow_config.fedow_domain()
+    profile = fedow_config.profile()
+    fedow_domain = profile.domain
     now = f"{datetime.now().isoformat()}"
 
     if apikey is None:
         # Pour la création, on prend la clé api de Root. apikey est donné en arguement.
         # Si vide, on prend la clé du lieu du tenant
-        apikey = fedow_config.get_fedow_place_admin_apikey()
+        apikey = profile.apikey
     headers = {
         "Date": f"{now}",
         'Authorization': f'Api-Key {apikey}',
@@ -105,23 +269,23 @@ def _get(fedow_config: FedowConfig = None,
         ).decode('utf-8')
 
         # Ici, on s'autovérifie :
-        if not verify_signature(user.get_public_key(),
-                                message.encode('utf8'),
-                                signature):
-            raise Exception("Signature auto verification failed")
+        if _self_verify_signature():
+            if not verify_signature(user.get_public_key(),
+                                    message.encode('utf8'),
+                                    signature):
+                raise Exception("Signature auto verification failed")
 
         headers.update({
             "Wallet": f"{user.wallet.uuid}",
             "Signature": f"{signature}",
         })
 
-    session = requests.Session()
-    request_fedow = session.get(
-        f"https://{fedow_domain}/{path}/",
+    request_fedow = _send(
+        'GET',
+        fedow_domain,
+        path,
         headers=headers,
-        verify=bool(not settings.DEBUG),
     )
-    session.close()
 
     # TODO: Vérifier la signature de réponse FEDOW
     return request_fedow
@@ -206,6 +370,7 @@ class BadgeFedow():
             logger.error(f"badge_in ERRORS : {response_badge.status_code}")
             raise Exception(f"badge_in ERRORS : {response_badge.status_code}")
 
+        invalidate_wallet_cache(user.wallet.uuid)
         transaction_serialized = TransactionValidator(data=response_badge.json())
         if transaction_serialized.is_valid():
             return transaction_serialized.validated_data
@@ -273,6 +438,7 @@ class MembershipFedow():
         )
 
         if response_subscription.status_code == 201:
+            invalidate_wallet_cache(receiver)
             serialized_transaction = TransactionValidator(data=response_subscription.json())
             if serialized_transaction.is_valid():
                 fedow_transaction = serialized_transaction.fedow_transaction
@@ -306,24 +472,11 @@ class WalletFedow():
     def cached_retrieve_by_signature(self, user):
         if not user.wallet:
             wallet = self.get_or_create_wallet(user)
-        try:
-            # get_or_set va toujours faire la fonction callable avant de vérifier le cache.
-            # Solution : soit retirer les () dans le callable, soit utiliser cache.lambda
-            serialized_wallet = cache.get_or_set(f"wallet_user_{user.wallet.uuid}",
-                                                 lambda: self.retrieve_by_signature(user), 10)
-        except KeyError as e:
-            # Exception soulevé parfois : AttributeError: 'NoneType' object has no attribute 'recv'
-            # A investiguer, peut être que l'écriture du cache est en concurence avec une autre écriture
-            # réalisée en même temps, avec les requetes async
-            logger.warning(f"cached_retrieve_by_signature : {e} - fetch from fedow without cache.")
-            serialized_wallet = self.retrieve_by_signature(user)
-        except Exception as e:
-            logger.error(f"cached_retrieve_by_signature : {e}")
-            raise e
-
-        return serialized_wallet
+        # Stale while revalidate : voir fedow_connect.wallet_cache
+        return get_wallet_cached(user.wallet.uuid, lambda: self.retrieve_by_signature(user))
 
-    def retrieve_by_signature(self, user):
+    def retrieve_by_signature(self, user, persist=False):
+        # Lecture seule par défaut : aucune écriture en base pour afficher un wallet.
         response_link = _get(
             self.fedow_config,
             user=user,
@@ -334,8 +487,10 @@ class WalletFedow():
             logger.error(f"retrieve_by_signature ERRORS : {response_link.status_code}")
             raise Exception(f"retrieve_by_signature ERRORS : {response_link.status_code}")
 
-        wallet_serialized = WalletValidator(data=response_link.json())
+        wallet_serialized = WalletValidator(data=response_link.json(), context={'read_only': True})
         if wallet_serialized.is_valid():
+            if persist:
+                persist_fedow_objects(wallet_serialized)
             return wallet_serialized
         else:
             logger.error(f"retrieve_by_signature wallet_serialized ERRORS : {wallet_serialized.errors}")
@@ -352,6 +507,7 @@ class WalletFedow():
             logger.error(f"retrieve_by_signature ERRORS : {response_refund_fed.status_code}")
             return (response_refund_fed.status_code, response_refund_fed.json())
 
+        invalidate_wallet_cache(user.wallet.uuid)
         wallet_serialized = WalletValidator(data=response_refund_fed.json())
         if wallet_serialized.is_valid():
             return response_refund_fed.status_code, wallet_serialized
@@ -424,6 +580,7 @@ class WalletFedow():
             raise Exception(
                 f"retrieve_from_refill_checkout ERRORS : {response_checkout.status_code} - {response_checkout.json()}")
 
+        invalidate_wallet_cache(user.wallet.uuid)
         wallet_serialized = WalletValidator(data=response_checkout.json())
         if not wallet_serialized.is_valid():
             logger.error(f"retrieve_by_signature wallet_serialized ERRORS : {wallet_serialized.errors}")
@@ -438,7 +595,7 @@ class PlaceFedow():
         if not fedow_config:
             self.fedow_config = FedowConfig.get_solo()
 
-        if not fedow_config.can_fedow():
+        if not self.fedow_config.can_fedow():
             # Premier contact entre une nouvelle place (nouveau tenant) et Fedow
             self.create_place(admin=admin)
 
@@ -524,9 +681,9 @@ class NFCcardFedow():
     def __init__(self, fedow_config: FedowConfig or None = None):
         self.fedow_config: FedowConfig = fedow_config
         if fedow_config is None:
-            self.config = FedowConfig.get_solo()
+            self.fedow_config = FedowConfig.get_solo()
 
-    def retrieve_card_by_signature(self, user: TibilletUser):
+    def retrieve_card_by_signature(self, user: TibilletUser, persist=False):
         response_get_card = _get(
             self.fedow_config,
             user=user,
@@ -537,8 +694,10 @@ class NFCcardFedow():
             logger.error(f"retrieve_by_signature ERRORS : {response_get_card.status_code}")
             raise Exception(f"retrieve_by_signature ERRORS : {response_get_card.status_code}")
 
-        card_serialized = CardValidator(data=response_get_card.json(), many=True)
+        card_serialized = CardValidator(data=response_get_card.json(), many=True, context={'read_only': True})
         if card_serialized.is_valid():
+            if persist:
+                persist_fedow_objects(card_serialized)
             return card_serialized.validated_data
         else:
             logger.error(f"retrieve_by_signature card_serialized ERRORS : {card_serialized.errors}")
@@ -555,6 +714,7 @@ class NFCcardFedow():
         if not response_lost_my_card.status_code == 200:
             logger.error(f"retrieve_by_signature ERRORS : {response_lost_my_card.status_code}")
             raise Exception(f"retrieve_by_signature ERRORS : {response_lost_my_card.status_code}")
+        invalidate_wallet_cache(user.wallet.uuid)
         return True
 
     def qr_retrieve(self, qrcode_uuid: uuid4):
@@ -587,6 +747,7 @@ class NFCcardFedow():
         if response_link.status_code != 200:
             logger.error(f"linkwallet_cardqrcode : {response_link.status_code} {response_link.json()}")
             return False
+        invalidate_wallet_cache(user.wallet.uuid)
 
         validated_card = CardValidator(data=response_link.json())
         if not validated_card.is_valid():
@@ -600,7 +761,7 @@ class TransactionFedow():
     def __init__(self, fedow_config: FedowConfig or None = None):
         self.fedow_config: FedowConfig = fedow_config
         if fedow_config is None:
-            self.config = FedowConfig.get_solo()
+            self.fedow_config = FedowConfig.get_solo()
 
 
     def retrieve(self, uuid):
@@ -631,7 +792,7 @@ class TransactionFedow():
             logger.error(response_hash.json())
             return response_hash.status_code
 
-    def paginated_list_by_wallet_signature(self, user):
+    def paginated_list_by_wallet_signature(self, user, persist=False):
         response_link = _get(
             self.fedow_config,
             user=user,
@@ -642,9 +803,12 @@ class TransactionFedow():
             logger.error(f"paginated_list_by_wallet_signature ERRORS : {response_link.status_code}")
             raise Exception(f"paginated_list_by_wallet_signature ERRORS : {response_link.status_code}")
 
-        paginated_transactions_serialized = PaginatedTransactionValidator(data=response_link.json())
+        paginated_transactions_serialized = PaginatedTransactionValidator(data=response_link.json(),
+                                                                          context={'read_only': True})
 
         if paginated_transactions_serialized.is_valid():
+            if persist:
+                persist_fedow_objects(paginated_transactions_serialized)
             return paginated_transactions_serialized
         else:
             logger.error(f"retrieve_by_signature wallet_serialized ERRORS : {paginated_transactions_serialized.errors}")
@@ -671,3 +835,24 @@ class FedowAPI():
 
     def handshake(self):
         pass
+
+
+# Un FedowAPI par process et par tenant, reconstruit quand FedowConfig ou RootConfiguration change.
+# Les sous clients n'ont pas d'état propre : on peut les partager entre requêtes et threads.
+# from fedow_connect.fedow_api import get_fedow_api
+_fedow_apis = {}
+_fedow_apis_lock = threading.Lock()
+
+
+def get_fedow_api() -> FedowAPI:
+    schema_name = connection.schema_name
+    fedow_api, versions = get_cached_for_schema(_fedow_apis, schema_name)
+    if fedow_api is not None:
+        return fedow_api
+
+    fedow_api = FedowAPI()
+    # Tant que le lieu n'est pas lié à Fedow, on ne garde rien
+    if fedow_api.fedow_config.can_fedow():
+        with _fedow_apis_lock:
+            _fedow_apis[schema_name] = (versions, time.monotonic(), fedow_api)
+    return fedow_api
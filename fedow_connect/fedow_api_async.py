@@ -0,0 +1,90 @@
+"""
+Jumeau asynchrone de FedowAPI.
+
+Les appels réseau passent par le transport poolé de fedow_api (_get / _post),
+la signature et les validateurs sont exactement les mêmes que la version synchrone.
+Chaque appel tourne dans un thread du pool d'asyncio : la boucle n'est jamais bloquée
+et plusieurs appels Fedow partent en même temps.
+
+Les lectures ne persistent rien (validateurs en read_only), mais elles lisent la base du tenant
+(FedowConfig, utilisateur, wallet) et cached_retrieve_by_signature peut créer le wallet :
+chaque thread se place dans le schéma du tenant qui a construit l'objet, puis rend sa connexion.
+
+Exemple dans une vue synchrone, pour des appels rendus dans la même réponse :
+    fedowAPI = AsyncFedowAPI()
+    wallet, cards = fedow_gather(
+        fedowAPI.wallet.cached_retrieve_by_signature(user),
+        fedowAPI.NFCcard.retrieve_card_by_signature(user),
+    )
+
+Exemple dans une coroutine (consumer channels, vue async) :
+    wallet, transactions = await asyncio.gather(
+        fedowAPI.wallet.retrieve_by_signature(user),
+        fedowAPI.transaction.paginated_list_by_wallet_signature(user),
+    )
+"""
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async, async_to_sync
+from django.db import connection, close_old_connections
+from django_tenants.utils import tenant_context
+
+from fedow_connect.fedow_api import WalletFedow, NFCcardFedow, TransactionFedow, BadgeFedow, MembershipFedow
+from fedow_connect.models import FedowConfig
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFedowClient():
+    # Enveloppe un sous client synchrone (WalletFedow, NFCcardFedow, ...)
+    # Toutes ses méthodes publiques deviennent des coroutines.
+    def __init__(self, sync_client, tenant):
+        self.sync_client = sync_client
+        self.tenant = tenant
+
+    def _run_in_tenant(self, method, *args, **kwargs):
+        try:
+            with tenant_context(self.tenant):
+                return method(*args, **kwargs)
+        finally:
+            # Thread du pool : on ne garde pas de connexion ouverte derrière nous
+            close_old_connections()
+            connection.close()
+
+    def __getattr__(self, name):
+        method = getattr(self.sync_client, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        async def coroutine(*args, **kwargs):
+            return await sync_to_async(self._run_in_tenant, thread_sensitive=False)(method, *args, **kwargs)
+
+        coroutine.__name__ = name
+        return coroutine
+
+
+class AsyncFedowAPI():
+    def __init__(self, fedow_config: FedowConfig = None):
+        self.fedow_config = fedow_config
+        if fedow_config is None:
+            self.fedow_config = FedowConfig.get_solo()
+        tenant = connection.tenant
+
+        # Pas de PlaceFedow ni d'AssetFedow : création de lieu et d'asset restent synchrones.
+        self.wallet = AsyncFedowClient(WalletFedow(fedow_config=self.fedow_config), tenant)
+        self.NFCcard = AsyncFedowClient(NFCcardFedow(fedow_config=self.fedow_config), tenant)
+        self.transaction = AsyncFedowClient(TransactionFedow(fedow_config=self.fedow_config), tenant)
+        self.badge = AsyncFedowClient(BadgeFedow(fedow_config=self.fedow_config), tenant)
+        self.membership = AsyncFedowClient(MembershipFedow(fedow_config=self.fedow_config), tenant)
+
+
+async def _gather(*coroutines, return_exceptions=False):
+    return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+
+def fedow_gather(*coroutines, return_exceptions=False):
+    # Pour les vues synchrones (gunicorn) : lance toutes les coroutines en même temps
+    # et renvoie les résultats dans le même ordre.
+    # Le temps total est celui de l'appel le plus long, pas la somme.
+    return async_to_sync(_gather)(*coroutines, return_exceptions=return_exceptions)
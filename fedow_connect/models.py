@@ -1,6 +1,12 @@
+import logging
+import threading
+import time
+from typing import NamedTuple
+from uuid import UUID, uuid4
+
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import models, connection
 from django_tenants.utils import schema_context
 from solo.models import SingletonModel
 
@@ -8,6 +14,84 @@ from fedow_connect.utils import fernet_decrypt, fernet_encrypt
 from root_billet.models import RootConfiguration
 
 
+logger = logging.getLogger(__name__)
+
+
+### PROFIL FEDOW ###
+# Tout ce dont _get / _post ont besoin, résolu une fois par process et par tenant :
+# domaine (RootConfiguration dans le schéma public) et clé api du lieu (déchiffrement Fernet).
+# Invalidation : FedowConfig.save et RootConfiguration.save changent un jeton de version dans le cache partagé.
+# Chaque process compare ses jetons (un seul get_many) avant de servir son profil.
+
+ROOT_VERSION_KEY = "fedow_profile_version_root"
+PROFILE_MAX_AGE = 300  # Au cas où un jeton de version serait évincé du cache
+
+
+def _tenant_version_key(schema_name):
+    return f"fedow_profile_version_{schema_name}"
+
+
+def bump_fedow_profile_version(schema_name=None):
+    # schema_name None : la config root a changé, tous les tenants sont concernés
+    key = ROOT_VERSION_KEY if schema_name is None else _tenant_version_key(schema_name)
+    try:
+        cache.set(key, uuid4().hex, None)
+    except Exception as e:
+        # On ne bloque pas une sauvegarde pour le cache. Les profils expirent au bout de PROFILE_MAX_AGE.
+        logger.error(f"bump_fedow_profile_version {key} : {e}")
+
+
+def _current_versions(schema_name):
+    try:
+        versions = cache.get_many([ROOT_VERSION_KEY, _tenant_version_key(schema_name)])
+    except Exception:
+        return None
+    return versions.get(ROOT_VERSION_KEY), versions.get(_tenant_version_key(schema_name))
+
+
+class FedowProfile(NamedTuple):
+    schema_name: str
+    domain: str
+    apikey: str
+    place_uuid: UUID
+    place_wallet_uuid: UUID
+
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def get_cached_for_schema(store: dict, schema_name: str):
+    # Renvoie l'objet stocké pour ce schéma si les versions n'ont pas bougé, sinon None
+    versions = _current_versions(schema_name)
+    entry = store.get(schema_name)
+    if entry and versions is not None:
+        stored_versions, built_at, obj = entry
+        if stored_versions == versions and built_at + PROFILE_MAX_AGE > time.monotonic():
+            return obj, versions
+    return None, versions
+
+
+def get_fedow_profile(fedow_config=None) -> FedowProfile:
+    schema_name = connection.schema_name
+    profile, versions = get_cached_for_schema(_profiles, schema_name)
+    if profile is not None:
+        return profile
+
+    if fedow_config is None:
+        fedow_config = FedowConfig.get_solo()
+    profile = FedowProfile(
+        schema_name=schema_name,
+        domain=fedow_config.fedow_domain(),
+        apikey=fedow_config.get_fedow_place_admin_apikey() if fedow_config.fedow_place_admin_apikey else None,
+        place_uuid=fedow_config.fedow_place_uuid,
+        place_wallet_uuid=fedow_config.fedow_place_wallet_uuid,
+    )
+    with _profiles_lock:
+        _profiles[schema_name] = (versions, time.monotonic(), profile)
+    return profile
+
+
 class FedowConfig(SingletonModel):
     fedow_place_uuid = models.UUIDField(blank=True, null=True, editable=False)
     fedow_place_admin_apikey = models.CharField(max_length=200, blank=True, null=True, editable=False)
@@ -28,6 +112,13 @@ class FedowConfig(SingletonModel):
     def get_fedow_place_admin_apikey(self):
         return fernet_decrypt(self.fedow_place_admin_apikey)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_fedow_profile_version(connection.schema_name)
+
+    def profile(self) -> FedowProfile:
+        return get_fedow_profile(self)
+
     def get_conf_root(self):
         with schema_context('public'):
             conf_root = RootConfiguration.get_solo()
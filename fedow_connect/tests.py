@@ -1,12 +1,14 @@
 import json
 import os
+import time
+from unittest import mock
 from uuid import UUID, uuid4
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
 from django.db import connection
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from django.utils import timezone
 from django_tenants.utils import get_tenant_model, schema_context, get_public_schema_name
 from faker import Faker
@@ -347,3 +349,72 @@ class InstallCreationTest(TestCase):
             # TODO: tester le display_name des wallet avec des tenant différents
 
             # TODO: Tester link wallet/card avec wallet sans user -> False
+
+
+class FedowTransportTest(SimpleTestCase):
+    # Transport et disjoncteur, sans serveur Fedow
+
+    def test_send_raises_on_5xx(self):
+        from fedow_connect import fedow_api
+
+        response = mock.Mock(status_code=502)
+        response.raw.retries = None
+        session = mock.Mock(request=mock.Mock(return_value=response))
+        with mock.patch.object(fedow_api, 'get_fedow_session', return_value=session), \
+                mock.patch.object(fedow_api, 'circuit_is_open', return_value=False), \
+                mock.patch.object(fedow_api, '_circuit_failure') as failure, \
+                mock.patch.object(fedow_api, '_circuit_success') as success:
+            with self.assertRaises(fedow_api.FedowUnavailable):
+                fedow_api._send('GET', 'fedow.test', 'wallet/retrieve_by_signature')
+            failure.assert_called_once_with('fedow.test')
+            success.assert_not_called()
+
+            # Une erreur métier (4xx) est renvoyée à l'appelant et ne compte pas comme une panne
+            response.status_code = 404
+            self.assertIs(fedow_api._send('GET', 'fedow.test', 'wallet/retrieve_by_signature'), response)
+            success.assert_called_once_with('fedow.test')
+
+
+class AsyncFedowTest(SimpleTestCase):
+    # fedow_gather et AsyncFedowClient avec un faux client synchrone, sans serveur Fedow
+
+    class SlowClient():
+        def retrieve(self, value, delay=0.3):
+            time.sleep(delay)
+            return value, connection.schema_name
+
+        def fail(self):
+            raise RuntimeError("Fedow error")
+
+    def setUp(self):
+        from types import SimpleNamespace
+        from fedow_connect.fedow_api_async import AsyncFedowClient
+        self.tenant = SimpleNamespace(schema_name='lespass')
+        self.fedow_client = AsyncFedowClient(self.SlowClient(), self.tenant)
+
+    def test_gather_runs_calls_concurrently(self):
+        from fedow_connect.fedow_api_async import fedow_gather
+        start = time.monotonic()
+        results = fedow_gather(
+            self.fedow_client.retrieve('wallet'),
+            self.fedow_client.retrieve('cards', delay=0.1),
+            self.fedow_client.retrieve('transactions'),
+        )
+        # Le temps de l'appel le plus long, pas la somme, et les résultats dans l'ordre des appels
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertEqual([value for value, schema in results], ['wallet', 'cards', 'transactions'])
+        # Chaque thread travaille dans le schéma du tenant qui a construit le client
+        self.assertEqual({schema for value, schema in results}, {'lespass'})
+
+    def test_gather_return_exceptions(self):
+        from fedow_connect.fedow_api_async import fedow_gather
+        wallet, error = fedow_gather(
+            self.fedow_client.retrieve('wallet', delay=0),
+            self.fedow_client.fail(),
+            return_exceptions=True,
+        )
+        self.assertEqual(wallet[0], 'wallet')
+        self.assertIsInstance(error, RuntimeError)
+
+        with self.assertRaises(RuntimeError):
+            fedow_gather(self.fedow_client.retrieve('wallet', delay=0), self.fedow_client.fail())
@@ -4,6 +4,38 @@ from AuthBillet.models import Wallet
 from BaseBillet.models import FedowTransaction
 
 
+### MODE LECTURE SEULE ###
+# Par défaut, les validateurs enregistrent en base les transactions et wallets reçus de Fedow (get_or_create).
+# Avec context={'read_only': True}, ils ne font aucune requête : les objets sont construits en mémoire
+# et collectés dans le context du serializer racine (partagé avec tous les serializers imbriqués).
+# Si l'appelant en a besoin, persist_fedow_objects les écrit en un seul bulk_create par modèle.
+
+def _read_only(serializer):
+    return serializer.context.get('read_only', False)
+
+
+def _collect(serializer, obj):
+    serializer.context.setdefault('fedow_objects_to_save', {}).setdefault(type(obj), {})[obj.pk] = obj
+
+
+def persist_fedow_objects(serializer):
+    to_save = serializer.context.get('fedow_objects_to_save', {})
+    for model, objects in to_save.items():
+        model.objects.bulk_create(objects.values(), ignore_conflicts=True)
+    serializer.context['fedow_objects_to_save'] = {}
+
+
+def _fedow_transaction(serializer, attrs):
+    if _read_only(serializer):
+        fedow_transaction = FedowTransaction(uuid=attrs['uuid'], hash=attrs['hash'], datetime=attrs['datetime'])
+        _collect(serializer, fedow_transaction)
+        return fedow_transaction
+
+    fedow_transaction, created = FedowTransaction.objects.get_or_create(uuid=attrs['uuid'], hash=attrs['hash'],
+                                                                        datetime=attrs['datetime'])
+    return fedow_transaction
+
+
 class PlaceValidator(serializers.Serializer):
     uuid = serializers.UUIDField()
     name = serializers.CharField()
@@ -95,11 +127,7 @@ class TransactionSimpleValidator(serializers.Serializer):
     verify_hash = serializers.BooleanField()
 
     def validate(self, attrs):
-        uuid = attrs['uuid']
-        hash = attrs['hash']
-        datetime = attrs['datetime']
-        self.fedow_transaction, created = FedowTransaction.objects.get_or_create(uuid=uuid, hash=hash,
-                                                                                 datetime=datetime)
+        self.fedow_transaction = _fedow_transaction(self, attrs)
         return attrs
 
 class TokenValidator(serializers.Serializer):
@@ -137,6 +165,10 @@ class WalletValidator(serializers.Serializer):
     has_user_card = serializers.BooleanField()
 
     def validate(self, attrs):
+        if _read_only(self):
+            self.wallet = Wallet(uuid=attrs['uuid'])
+            _collect(self, self.wallet)
+            return attrs
         self.wallet, created = Wallet.objects.get_or_create(uuid=attrs['uuid'])
         return attrs
 
@@ -199,11 +231,7 @@ class TransactionValidator(serializers.Serializer):
     verify_hash = serializers.BooleanField()
 
     def validate(self, attrs):
-        uuid = attrs['uuid']
-        hash = attrs['hash']
-        datetime = attrs['datetime']
-        self.fedow_transaction, created = FedowTransaction.objects.get_or_create(uuid=uuid, hash=hash,
-                                                                                 datetime=datetime)
+        self.fedow_transaction = _fedow_transaction(self, attrs)
         return attrs
 
 
@@ -11,7 +11,8 @@ from rest_framework.response import Response
 from AuthBillet.models import Wallet, TibilletUser
 from BaseBillet.models import Membership, FedowTransaction, Product, Price
 from BaseBillet.templatetags.tibitags import dround
-from fedow_connect.fedow_api import FedowAPI
+from fedow_connect.fedow_api import get_fedow_api
+from fedow_connect.wallet_cache import invalidate_wallet_cache
 from django.utils.translation import gettext_lazy as _
 
 logger = logging.getLogger(__name__)
@@ -28,9 +29,11 @@ class Membership_fwh(viewsets.ViewSet):
         # pk correspond à l'uuid de la transaction
         transaction_uuid = UUID(pk)
         # Récupération des infos de la transaction
-        fedowAPI = FedowAPI()
+        fedowAPI = get_fedow_api()
         transaction_serialized = fedowAPI.transaction.retrieve(transaction_uuid)
         transaction = FedowTransaction.objects.get(pk=transaction_serialized['uuid'])
+        # Le wallet a bougé coté Fedow : on ne sert plus le cache
+        invalidate_wallet_cache(transaction_serialized.get('receiver'))
 
         if Membership.objects.filter(fedow_transactions=transaction).exists():
             # Déja enregistré !
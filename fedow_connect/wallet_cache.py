@@ -0,0 +1,93 @@
+"""
+Cache des wallets Fedow : stale-while-revalidate + single flight.
+
+Chaque entrée garde la réponse et une date de fraîcheur :
+- fraîche : on la sert directement.
+- périmée : un seul worker (verrou court via cache.add, atomique sur memcached) rafraîchit,
+  les autres servent l'ancienne valeur en attendant.
+- absente : le worker qui a le verrou va chercher chez Fedow, les autres attendent un peu
+  la valeur avant d'y aller eux-mêmes.
+
+Toute action connue qui modifie le wallet (webhook Fedow, remboursement, recharge, carte liée/perdue, badge)
+doit appeler invalidate_wallet_cache : on ne sert jamais un solde périmé après un changement connu.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+def _wallet_key(wallet_uuid):
+    return f"wallet_user_{wallet_uuid}"
+
+
+def _lock_key(wallet_uuid):
+    return f"wallet_user_{wallet_uuid}_lock"
+
+
+def _store(wallet_uuid, data):
+    cache.set(_wallet_key(wallet_uuid), {
+        'data': data,
+        'fresh_until': time.time() + settings.FEDOW_WALLET_CACHE_FRESH,
+    }, settings.FEDOW_WALLET_CACHE_STALE)
+
+
+def _refresh(wallet_uuid, fetch):
+    try:
+        data = fetch()
+        _store(wallet_uuid, data)
+        return data
+    finally:
+        cache.delete(_lock_key(wallet_uuid))
+
+
+def get_wallet_cached(wallet_uuid, fetch):
+    # fetch : callable sans argument qui interroge Fedow et renvoie la donnée à mettre en cache
+    try:
+        entry = cache.get(_wallet_key(wallet_uuid))
+        if entry and entry['fresh_until'] > time.time():
+            return entry['data']
+
+        got_lock = cache.add(_lock_key(wallet_uuid), 1, settings.FEDOW_WALLET_CACHE_LOCK)
+
+        if entry:
+            if got_lock:
+                logger.debug(f"wallet {wallet_uuid} périmé, rafraichissement")
+                try:
+                    return _refresh(wallet_uuid, fetch)
+                except Exception as e:
+                    # Fedow ne répond pas : on sert la dernière valeur connue
+                    logger.warning(f"get_wallet_cached refresh error {wallet_uuid} : {e} -> stale")
+                    return entry['data']
+            # Un autre worker rafraichit : on sert la valeur périmée
+            return entry['data']
+
+        if got_lock:
+            return _refresh(wallet_uuid, fetch)
+
+        # Un autre worker est déja parti chez Fedow, on attend sa réponse
+        waited = 0
+        while waited < settings.FEDOW_WALLET_CACHE_LOCK:
+            time.sleep(0.1)
+            waited += 0.1
+            entry = cache.get(_wallet_key(wallet_uuid))
+            if entry:
+                return entry['data']
+
+    except KeyError as e:
+        # Exception soulevée parfois par pymemcache en cas d'écritures concurentes
+        logger.warning(f"get_wallet_cached : {e} - fetch from fedow without cache.")
+
+    return fetch()
+
+
+def invalidate_wallet_cache(wallet_uuid):
+    if not wallet_uuid:
+        return
+    try:
+        cache.delete(_wallet_key(wallet_uuid))
+    except Exception as e:
+        logger.error(f"invalidate_wallet_cache {wallet_uuid} : {e}")
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class RootBilletConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'root_billet'
+
+    def ready(self):
+        from root_billet.metrics import install_stripe_instrumentation
+        install_stripe_instrumentation()
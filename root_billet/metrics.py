@@ -0,0 +1,197 @@
+"""
+Métriques des appels sortants : Fedow, Stripe, LaBoutik (server_cashless), Ghost, webhooks.
+
+Les compteurs sont dans un hash Redis partagé par tous les process (gunicorn, daphne, celery).
+Par intégration, endpoint, tenant :
+- nombre d'appels par code retour (ou timeout / error)
+- histogramme des latences
+- nombre de retry (urllib3)
+
+Exposition au format texte Prometheus : root_billet.views.metrics -> /metrics/ sur le schéma public.
+Une erreur de métrique ne doit jamais casser l'appel mesuré : tout est dans des try/except.
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import redis
+import requests
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+METRICS_KEY = "tibillet:metrics:outbound"
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+INTEGRATION_FEDOW = 'fedow'
+INTEGRATION_STRIPE = 'stripe'
+INTEGRATION_LABOUTIK = 'laboutik'
+INTEGRATION_GHOST = 'ghost'
+INTEGRATION_WEBHOOK = 'webhook'
+
+_redis = None
+_redis_lock = threading.Lock()
+
+# uuid, hash sha256, nombres : on les remplace pour ne pas exploser le nombre de séries
+_ID_RE = re.compile(r'^([0-9a-fA-F-]{32,64}|\d+|[0-9a-fA-F]{8})$')
+
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                _redis = redis.Redis.from_url(
+                    settings.METRICS_REDIS_URL,
+                    socket_timeout=0.2,
+                    socket_connect_timeout=0.2,
+                )
+    return _redis
+
+
+def normalize_endpoint(url_or_path: str) -> str:
+    path = urlparse(url_or_path).path if '://' in url_or_path else url_or_path
+    segments = [':id' if _ID_RE.match(segment) else segment for segment in path.strip('/').split('/')]
+    return '/'.join(segments).replace('|', '_')[:120]
+
+
+def _tenant_label():
+    try:
+        return connection.schema_name
+    except Exception:
+        return 'unknown'
+
+
+def observe(integration: str, endpoint: str, status, duration: float, retries: int = 0, tenant: str = None):
+    if not settings.METRICS_ENABLED:
+        return
+    try:
+        labels = f"{integration}|{normalize_endpoint(endpoint)}|{tenant or _tenant_label()}"
+        pipe = _get_redis().pipeline(transaction=False)
+        pipe.hincrby(METRICS_KEY, f"count|{labels}|{status}", 1)
+        pipe.hincrbyfloat(METRICS_KEY, f"sum|{labels}", duration)
+        for bucket in BUCKETS:
+            if duration <= bucket:
+                pipe.hincrby(METRICS_KEY, f"bucket|{labels}|{bucket}", 1)
+        pipe.hincrby(METRICS_KEY, f"bucket|{labels}|+Inf", 1)
+        if retries:
+            pipe.hincrby(METRICS_KEY, f"retries|{labels}", retries)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"metrics observe error : {e}")
+
+
+def _retries_of(response):
+    # urllib3 garde l'historique des retry sur la réponse brute
+    try:
+        return len(response.raw.retries.history)
+    except Exception:
+        return 0
+
+
+@contextmanager
+def measure(integration: str, endpoint: str):
+    """
+    with measure(INTEGRATION_GHOST, url) as m:
+        response = requests.get(url)
+        m['status'] = response.status_code
+    """
+    result = {'status': 'error', 'retries': 0}
+    start = time.perf_counter()
+    try:
+        yield result
+    except requests.exceptions.Timeout:
+        result['status'] = 'timeout'
+        raise
+    finally:
+        observe(integration, endpoint, result['status'], time.perf_counter() - start, result['retries'])
+
+
+def instrumented_request(integration: str, method: str, url: str, session=None, **kwargs):
+    # Remplace requests.request / session.request en mesurant l'appel
+    with measure(integration, url) as result:
+        requester = session.request if session else requests.request
+        response = requester(method, url, **kwargs)
+        result['status'] = response.status_code
+        result['retries'] = _retries_of(response)
+    return response
+
+
+def escape_label(value) -> str:
+    # Format texte Prometheus : antislash, guillemet et retour à la ligne échappés dans les valeurs de label
+    return f"{value}".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus() -> str:
+    raw = _get_redis().hgetall(METRICS_KEY)
+    counts, sums, buckets, retries = {}, {}, {}, {}
+    for field, value in raw.items():
+        field = field.decode('utf-8')
+        value = value.decode('utf-8')
+        kind, integration, endpoint, tenant, *rest = field.split('|')
+        labels = (integration, endpoint, tenant)
+        if kind == 'count':
+            counts[labels + (rest[0],)] = int(value)
+        elif kind == 'sum':
+            sums[labels] = float(value)
+        elif kind == 'bucket':
+            buckets.setdefault(labels, {})[rest[0]] = int(value)
+        elif kind == 'retries':
+            retries[labels] = int(value)
+
+    def fmt(labels, **extra):
+        names = ['integration', 'endpoint', 'tenant']
+        pairs = zip(names + list(extra.keys()), list(labels) + list(extra.values()))
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    lines = [
+        "# HELP tibillet_outbound_requests_total Appels sortants par code retour",
+        "# TYPE tibillet_outbound_requests_total counter",
+    ]
+    for (integration, endpoint, tenant, status), value in sorted(counts.items()):
+        lines.append(f"tibillet_outbound_requests_total{fmt((integration, endpoint, tenant), status=status)} {value}")
+
+    lines += [
+        "# HELP tibillet_outbound_request_duration_seconds Latence des appels sortants",
+        "# TYPE tibillet_outbound_request_duration_seconds histogram",
+    ]
+    for labels, label_buckets in sorted(buckets.items()):
+        for bucket in [str(b) for b in BUCKETS] + ['+Inf']:
+            lines.append(f"tibillet_outbound_request_duration_seconds_bucket{fmt(labels, le=bucket)} "
+                         f"{label_buckets.get(bucket, 0)}")
+        lines.append(f"tibillet_outbound_request_duration_seconds_sum{fmt(labels)} {sums.get(labels, 0)}")
+        lines.append(f"tibillet_outbound_request_duration_seconds_count{fmt(labels)} {label_buckets.get('+Inf', 0)}")
+
+    lines += [
+        "# HELP tibillet_outbound_retries_total Retry effectués par urllib3",
+        "# TYPE tibillet_outbound_retries_total counter",
+    ]
+    for labels, value in sorted(retries.items()):
+        lines.append(f"tibillet_outbound_retries_total{fmt(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+### STRIPE ###
+# La lib stripe passe par son propre client http : on le remplace par un client mesuré.
+def install_stripe_instrumentation():
+    try:
+        import stripe
+        from stripe import _http_client
+
+        class InstrumentedStripeClient(_http_client.RequestsClient):
+            def request(self, method, url, headers, post_data=None):
+                with measure(INTEGRATION_STRIPE, url) as result:
+                    content, status_code, response_headers = super().request(method, url, headers, post_data)
+                    result['status'] = status_code
+                return content, status_code, response_headers
+
+        stripe.default_http_client = InstrumentedStripeClient()
+    except Exception as e:
+        logger.warning(f"install_stripe_instrumentation : {e}")
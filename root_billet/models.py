@@ -38,6 +38,12 @@ class RootConfiguration(SingletonModel):
     fedow_create_place_apikey = models.CharField(max_length=200, blank=True, null=True, editable=False)
     fedow_primary_pub_pem = models.CharField(max_length=500, blank=True, null=True, editable=False)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Le domaine Fedow a pu changer : les profils Fedow des tenants sont à reconstruire
+        from fedow_connect.models import bump_fedow_profile_version
+        bump_fedow_profile_version()
+
     def get_stripe_api(self):
         if self.stripe_mode_test:
             return os.environ.get('STRIPE_KEY_TEST')
@@ -0,0 +1,28 @@
+import hmac
+import logging
+
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.views.decorators.http import require_GET
+
+from root_billet.metrics import render_prometheus
+
+logger = logging.getLogger(__name__)
+
+
+@require_GET
+def metrics(request):
+    # Scrape Prometheus. Désactivé tant que METRICS_TOKEN n'est pas renseigné dans le .env
+    if not settings.METRICS_TOKEN:
+        raise Http404()
+
+    token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not hmac.compare_digest(token, settings.METRICS_TOKEN):
+        return HttpResponse(status=403)
+
+    try:
+        content = render_prometheus()
+    except Exception as e:
+        logger.error(f"metrics : {e}")
+        return HttpResponse(status=503)
+    return HttpResponse(content, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,7 +1,12 @@
 # chat/consumers.py
 import json
 
-from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer, AsyncJsonWebsocketConsumer
+from django_tenants.utils import tenant_context
+
+from AuthBillet.models import is_tenant_admin
+from wsocket.gauge import gauge_group, gauge_data
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -33,4 +38,36 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = event["message"]
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({"message": message}))
\ No newline at end of file
+        await self.send(text_data=json.dumps({"message": message}))
+
+class GaugeConsumer(AsyncJsonWebsocketConsumer):
+    # Jauge en direct d'un évènement, pour les écrans de porte (wsocket.gauge).
+    # Admin du tenant uniquement : jeton JWT (WebSocketJWTAuthMiddleware) ou session.
+    async def connect(self):
+        self.tenant = self.scope.get("tenant")
+        self.event_uuid = self.scope["url_route"]["kwargs"]["event_uuid"]
+        if not self.tenant or not await self.allowed():
+            await self.close()
+            return
+
+        self.group_name = gauge_group(self.tenant.schema_name, self.event_uuid)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        # Etat courant à la connexion, ensuite uniquement les changements
+        await self.send_json(await self.snapshot())
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    @database_sync_to_async
+    def allowed(self):
+        return is_tenant_admin(self.scope["user"], self.tenant)
+
+    @database_sync_to_async
+    def snapshot(self):
+        with tenant_context(self.tenant):
+            return gauge_data(self.event_uuid)
+
+    async def gauge_update(self, event):
+        await self.send_json(event["gauge"])
@@ -0,0 +1,57 @@
+"""
+Jauge en direct par évènement (wsocket.consumers.GaugeConsumer).
+
+Un groupe channels par tenant et par évènement. Chaque changement des compteurs
+(EventInventory.add_counts : transitions de Ticket, scans en lot) envoie un seul message au groupe,
+quel que soit le nombre d'écrans connectés, et un seul par évènement et par transaction
+(schedule_push_gauge). Plus de polling de /api/gauge/.
+"""
+import logging
+from functools import partial
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def gauge_group(schema_name, event_uuid):
+    return f"gauge_{schema_name}_{event_uuid}"
+
+
+def gauge_data(event_uuid) -> dict:
+    from BaseBillet.models import Event
+    event = Event.objects.with_counters().filter(pk=event_uuid).values(
+        'jauge_max', 'sold_count', 'scanned_count').first()
+    if not event:
+        return {}
+    return {
+        'event': f"{event_uuid}",
+        'gauge_max': event['jauge_max'],
+        'all_tickets': event['sold_count'],
+        'scanned_tickets': event['scanned_count'],
+    }
+
+
+def push_gauge(event_uuid):
+    # Une erreur de diffusion ne doit jamais casser la vente ou le scan
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            gauge_group(connection.schema_name, event_uuid),
+            {'type': 'gauge.update', 'gauge': gauge_data(event_uuid)},
+        )
+    except Exception as e:
+        logger.error(f"push_gauge {event_uuid} : {e}")
+
+
+def schedule_push_gauge(event_uuid):
+    # Un push au commit, même si la transaction change le statut de n billets de l'évènement.
+    # Le callback en attente sert de marqueur : Django le jette au rollback, rien à nettoyer.
+    event_uuid = f"{event_uuid}"
+    for sids, callback, *robust in transaction.get_connection().run_on_commit:
+        if getattr(callback, 'gauge_event', None) == event_uuid:
+            return
+    callback = partial(push_gauge, event_uuid)
+    callback.gauge_event = event_uuid
+    transaction.on_commit(callback)
@@ -1,8 +1,12 @@
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django_tenants.utils import remove_www
 from rest_framework_simplejwt.tokens import AccessToken, TokenError
 
+from Customers.models import Domain
+from Customers.tenant_cache import get_tenant_from_hostname
+
 User = get_user_model()
 
 import logging
@@ -23,7 +27,8 @@ class WebSocketJWTAuthMiddleware:
         self.app = app
 
     async def __call__(self, scope, receive, send):
-        scope["user"] = AnonymousUser()
+        # Sans jeton, on garde l'utilisateur de la session (AuthMiddlewareStack) s'il y en a un
+        scope.setdefault("user", AnonymousUser())
         token = None
         headers = dict(scope.get('headers'))
         if headers:
@@ -37,3 +42,25 @@ class WebSocketJWTAuthMiddleware:
                 logger.info('WebSocketJWTAuthMiddleware BAD TOKEN')
 
         return await self.app(scope, receive, send)
+
+
+@database_sync_to_async
+def get_tenant(hostname):
+    try:
+        return get_tenant_from_hostname(hostname)
+    except Domain.DoesNotExist:
+        return None
+
+
+class WebSocketTenantMiddleware:
+    # Les websockets ne passent pas par le middleware de django-tenants :
+    # on retrouve le tenant depuis le Host, avec le même cache que CachedTenantMiddleware.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        headers = dict(scope.get('headers'))
+        hostname = remove_www(headers.get(b'host', b'').decode('utf-8').split(':')[0])
+        scope["tenant"] = await get_tenant(hostname)
+        return await self.app(scope, receive, send)
@@ -5,4 +5,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_name>\w+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/gauge/(?P<event_uuid>[0-9a-f-]{36})/$', consumers.GaugeConsumer.as_asgi()),
 ]
\ No newline at end of file